@@ -0,0 +1,221 @@
+# admission.py
+"""Admission control for bot commands: rate limits, bounded lanes and load shedding.
+
+Every command goes through `admission.slot(command, user_id, guild_id)`
+before its handler runs:
+
+1. Per-user and per-guild token buckets cap how fast commands are accepted.
+2. Each command class has its own lane, with a concurrency limit and a
+   bounded FIFO queue. Playback controls (`!pause`, `!resume`, `!next`)
+   have their own fast lane, so they never queue behind LLM-backed work.
+3. A user can have at most ADMISSION_USER_INFLIGHT slow commands running
+   or queued at once.
+
+When any of these is exhausted the command is rejected straight away with
+`Busy`, whose `reply` tells the user to try again. Nothing piles up.
+"""
+import os
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+import metrics
+from ratelimit import TokenBucket, token_bucket, take_all_async
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") != "0"
+# Commands per second per user / per guild, and how many can arrive at once
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "0.2"))
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "5"))
+ADMISSION_GUILD_RATE = float(os.getenv("ADMISSION_GUILD_RATE", "2"))
+ADMISSION_GUILD_BURST = float(os.getenv("ADMISSION_GUILD_BURST", "20"))
+# Slow commands one user may have running or queued at the same time
+ADMISSION_USER_INFLIGHT = int(os.getenv("ADMISSION_USER_INFLIGHT", "2"))
+# Buckets kept for this many recently seen users/guilds
+ADMISSION_MAX_TRACKED = int(os.getenv("ADMISSION_MAX_TRACKED", "10000"))
+
+PLAYBACK_LANE = "playback"
+DEFAULT_LANE = "default"
+
+COMMAND_LANES = {
+    "pause": PLAYBACK_LANE,
+    "resume": PLAYBACK_LANE,
+    "next": PLAYBACK_LANE,
+    "ask": "llm",
+    "remind": "llm",
+    "play": "play",
+    "news": "news",
+}
+
+# lane -> (concurrency, queue size, bucket tokens per command)
+LANE_DEFAULTS = {
+    PLAYBACK_LANE: (16, 64, 0.25),
+    "llm": (4, 8, 1.0),  # the LLM gateway itself runs LLM_MAX_CONCURRENCY at a time
+    "play": (8, 16, 1.0),
+    "news": (8, 32, 1.0),
+    DEFAULT_LANE: (8, 32, 1.0),
+}
+
+shed_total = metrics.counter("bot_admission_shed_total", "Commands rejected by admission control",
+                             ("lane", "reason"))
+
+
+class Busy(Exception):
+    """A command was rejected; `reply` is what to tell the user."""
+
+    def __init__(self, reason: str, retry_after: float = 0.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def reply(self) -> str:
+        if self.reason == "overloaded":
+            return "⏳ I'm busy right now. Please try again in a moment."
+        return f"⏳ Slow down a little. Try again in {max(self.retry_after, 1):.0f}s."
+
+
+class Lane:
+    """Concurrency limit with a bounded FIFO queue; a full queue raises Busy."""
+
+    def __init__(self, name: str, concurrency: int, max_queue: int, cost: float = 1.0):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.cost = cost
+        self.running = 0
+        self._waiters = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        if self.running < self.concurrency and not self._waiters:
+            self.running += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise Busy("overloaded")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we were cancelled; pass it on
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self):
+        # Hand the slot straight to the next waiter, so `running` is unchanged
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+
+class Admission:
+    def __init__(self):
+        self.lanes = {}
+        for name, (concurrency, max_queue, cost) in LANE_DEFAULTS.items():
+            prefix = f"ADMISSION_{name.upper()}"
+            self.lanes[name] = Lane(
+                name,
+                int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+                int(os.getenv(f"{prefix}_QUEUE", str(max_queue))),
+                cost,
+            )
+        self._users = OrderedDict()   # user_id -> TokenBucket
+        self._guilds = OrderedDict()  # guild_id -> TokenBucket
+        self._inflight = {}           # user_id -> slow commands running or queued
+
+    def lane_for(self, command: str) -> Lane:
+        return self.lanes[COMMAND_LANES.get(command, DEFAULT_LANE)]
+
+    def _bucket(self, table: OrderedDict, key, rate: float, burst: float, shared: bool = False) -> TokenBucket:
+        bucket = table.get(key)
+        if bucket is None:
+            bucket = table[key] = token_bucket(key, rate, burst) if shared else TokenBucket(rate, capacity=burst)
+            while len(table) > ADMISSION_MAX_TRACKED:
+                table.popitem(last=False)
+        table.move_to_end(key)
+        return bucket
+
+    def _shed(self, lane: Lane, busy: Busy):
+        shed_total.inc(lane=lane.name, reason=busy.reason)
+        raise busy
+
+    async def _check_rate(self, lane: Lane, user_id: str, guild_id: str = None):
+        # A user can reach several shard processes (guilds on different shards,
+        # DMs), so their bucket is shared; a guild only ever talks to one shard
+        buckets = [self._bucket(self._users, f"user:{user_id}", ADMISSION_USER_RATE, ADMISSION_USER_BURST,
+                                shared=True)]
+        if guild_id is not None:
+            buckets.append(self._bucket(self._guilds, guild_id, ADMISSION_GUILD_RATE, ADMISSION_GUILD_BURST))
+        # All or nothing, so a rejection costs nothing; one transaction when sharded
+        wait = await take_all_async(buckets, lane.cost)
+        if wait > 0:
+            self._shed(lane, Busy("rate_limited", wait))
+
+    @asynccontextmanager
+    async def slot(self, command: str, user_id: str, guild_id: str = None):
+        """Admit one command or raise Busy; the lane slot is held until the block exits."""
+        if not ADMISSION_ENABLED:
+            yield
+            return
+        lane = self.lane_for(command)
+        slow = lane.name != PLAYBACK_LANE
+        if slow and self._inflight.get(user_id, 0) >= ADMISSION_USER_INFLIGHT:
+            self._shed(lane, Busy("user_inflight"))
+        if slow:
+            # Counted before the rate check awaits, so concurrent commands see it
+            self._inflight[user_id] = self._inflight.get(user_id, 0) + 1
+        try:
+            await self._check_rate(lane, user_id, guild_id)
+            try:
+                await lane.acquire()
+            except Busy as busy:
+                self._shed(lane, busy)
+            try:
+                yield
+            finally:
+                lane.release()
+        finally:
+            if slow:
+                left = self._inflight.get(user_id, 0) - 1
+                if left > 0:
+                    self._inflight[user_id] = left
+                else:
+                    self._inflight.pop(user_id, None)
+
+    def get_stats(self) -> dict:
+        return {
+            "lanes": {name: {"running": lane.running, "queued": lane.queued,
+                             "concurrency": lane.concurrency, "max_queue": lane.max_queue}
+                      for name, lane in self.lanes.items()},
+            "users_tracked": len(self._users),
+            "guilds_tracked": len(self._guilds),
+            "users_inflight": len(self._inflight),
+        }
+
+    def summary(self) -> str:
+        """One line for !stats: running/queued per lane."""
+        parts = [f"{name} {lane.running}/{lane.concurrency} +{lane.queued}" for name, lane in self.lanes.items()]
+        return "**Admission** (running/limit +queued) " + ", ".join(parts)
+
+
+admission = Admission()
+
+
+def _collect_metrics() -> dict:
+    out = {}
+    for name, lane in admission.lanes.items():
+        out[("bot_admission_running", (("lane", name),))] = lane.running
+        out[("bot_admission_queued", (("lane", name),))] = lane.queued
+    return out
+
+
+metrics.add_collector(_collect_metrics)
@@ -0,0 +1,223 @@
+# calendar_client.py
+import os
+import asyncio
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from google.auth.transport.requests import Request
+from google.auth.credentials import AnonymousCredentials
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+from googleapiclient.http import BatchHttpRequest
+
+import metrics
+import resilience
+
+# Google Calendar config
+SCOPES = ['https://www.googleapis.com/auth/calendar']
+GOOGLE_CRED_FILE = 'credentials.json'
+GOOGLE_TOKEN_FILE = 'token.json'
+# Calendar-compatible server to use instead of Google, without OAuth
+# (e.g. "http://127.0.0.1:8765/calendar/v3/" for bench/stubs.py)
+CALENDAR_API_ENDPOINT = os.getenv("CALENDAR_API_ENDPOINT")
+
+# Inserts arriving within this window share one batch request (Calendar caps batches at 50)
+CALENDAR_BATCH_WINDOW = float(os.getenv("CALENDAR_BATCH_WINDOW", "0.25"))
+CALENDAR_BATCH_MAX = min(int(os.getenv("CALENDAR_BATCH_MAX", "50")), 50)
+# Refresh credentials this many seconds before they expire
+CALENDAR_REFRESH_AHEAD = float(os.getenv("CALENDAR_REFRESH_AHEAD", "300"))
+
+
+def authenticate_google_calendar(interactive: bool = False) -> Credentials:
+    """Credentials from token.json; only `interactive` runs the browser OAuth flow to create it."""
+    creds = None
+    if os.path.exists(GOOGLE_TOKEN_FILE):
+        creds = Credentials.from_authorized_user_file(GOOGLE_TOKEN_FILE, SCOPES)
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            if not interactive:
+                # The bot runs headless: waiting on a browser would hang the calendar thread
+                raise RuntimeError(f"Google Calendar is not authorized; run `python -m agents.calendar_client` "
+                                   f"once to create {GOOGLE_TOKEN_FILE}")
+            flow = InstalledAppFlow.from_client_secrets_file(GOOGLE_CRED_FILE, SCOPES)
+            creds = flow.run_local_server(port=0)
+        _save_credentials(creds)
+    return creds
+
+
+def _save_credentials(creds: Credentials):
+    with open(GOOGLE_TOKEN_FILE, 'w') as token:
+        token.write(creds.to_json())
+
+
+def _server_error(error: Exception) -> bool:
+    """True unless `error` is a 4xx reply, i.e. Calendar answered and refused this one insert."""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "resp", None), "status", None)
+    try:
+        return int(status) >= 500
+    except (TypeError, ValueError):
+        return True
+
+
+class CalendarClient:
+    """Long-lived Calendar service with background credential refresh and batched inserts.
+
+    The discovery document is parsed once. All google-api-python-client
+    calls run on one worker thread, because the underlying httplib2 objects
+    are not thread-safe.
+    """
+
+    def __init__(self, calendar_id: str = 'primary'):
+        self.calendar_id = calendar_id
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="calendar")
+        self._creds = None
+        self._service = None
+        self._pending = []       # (event, future) waiting for the next batch
+        self._flush_task = None
+        self._refresh_task = None
+        self._sending = set()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _build(self):
+        if self._service is None:
+            if CALENDAR_API_ENDPOINT:
+                self._creds = AnonymousCredentials()
+                self._service = build('calendar', 'v3', credentials=self._creds, cache_discovery=False,
+                                      client_options={"api_endpoint": CALENDAR_API_ENDPOINT})
+            else:
+                self._creds = authenticate_google_calendar()
+                self._service = build('calendar', 'v3', credentials=self._creds, cache_discovery=False)
+        return self._service
+
+    def _new_batch(self, service, callback) -> BatchHttpRequest:
+        if CALENDAR_API_ENDPOINT:
+            # The batch URI comes from the discovery document's rootUrl, which
+            # api_endpoint doesn't override
+            root = CALENDAR_API_ENDPOINT.rstrip("/").rsplit("/calendar/", 1)[0]
+            return BatchHttpRequest(callback=callback, batch_uri=f"{root}/batch/calendar/v3")
+        return service.new_batch_http_request(callback=callback)
+
+    async def service(self):
+        service = await self._run(self._build)
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh_loop())
+        return service
+
+    # ---- credentials ----
+
+    def _refresh_credentials(self):
+        self._creds.refresh(Request())
+        _save_credentials(self._creds)
+
+    async def _refresh_loop(self):
+        while True:
+            delay = 60.0
+            expiry = getattr(self._creds, "expiry", None)
+            if expiry is not None:
+                # google-auth keeps expiry as a naive UTC datetime
+                now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+                delay = max((expiry - now).total_seconds() - CALENDAR_REFRESH_AHEAD, 0)
+            await asyncio.sleep(delay)
+            if not getattr(self._creds, "refresh_token", None):
+                continue
+            try:
+                await self._run(self._refresh_credentials)
+            except Exception as e:
+                logging.warning(f"[calendar] Background credential refresh failed: {e}")
+                await asyncio.sleep(30)
+
+    # ---- batched inserts ----
+
+    async def insert_event(self, event: dict) -> dict:
+        """Queue an insert; inserts close together go out as one batch request."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((event, future))
+        if len(self._pending) >= CALENDAR_BATCH_MAX:
+            self._flush_now()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(CALENDAR_BATCH_WINDOW)
+        self._flush_task = None
+        self._flush_now()
+
+    def _flush_now(self):
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+            self._flush_task = None
+        batch, self._pending = self._pending[:CALENDAR_BATCH_MAX], self._pending[CALENDAR_BATCH_MAX:]
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+        if self._pending and self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _send(self, batch: list):
+        results = None
+        try:
+            await self.service()
+            endpoint = "events.insert" if len(batch) == 1 else "batch"
+            with resilience.guard("calendar"), metrics.track_call("calendar", endpoint):
+                results = await self._run(self._execute_batch, [event for event, _ in batch])
+                # Per-insert errors come back as results; raise here so the breaker
+                # and metrics see them when nothing got through or Calendar itself failed
+                errors = [result for result in results if isinstance(result, Exception)]
+                if errors and (len(errors) == len(results) or any(_server_error(e) for e in errors)):
+                    raise next((e for e in errors if _server_error(e)), errors[0])
+        except Exception as e:
+            if results is None:
+                results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _execute_batch(self, events: list) -> list:
+        service = self._build()
+        if len(events) == 1:
+            try:
+                return [service.events().insert(calendarId=self.calendar_id, body=events[0]).execute()]
+            except Exception as e:
+                return [e]
+        results = [None] * len(events)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = exception if exception is not None else response
+
+        batch = self._new_batch(service, callback)
+        for i, event in enumerate(events):
+            batch.add(service.events().insert(calendarId=self.calendar_id, body=event), request_id=str(i))
+        batch.execute()
+        return results
+
+    async def close(self):
+        """Send anything still queued, then stop the background tasks."""
+        while self._pending:
+            self._flush_now()
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        for task in (self._flush_task, self._refresh_task):
+            if task is not None:
+                task.cancel()
+        self._executor.shutdown(wait=False)
+
+
+calendar = CalendarClient()
+
+
+if __name__ == "__main__":
+    # One-time setup: authorize with credentials.json in a browser and save token.json
+    authenticate_google_calendar(interactive=True)
+    print(f"Saved {GOOGLE_TOKEN_FILE}; the bot will now mirror reminders to Google Calendar.")
@@ -1,40 +1,67 @@
 import os
-import requests
 import logging
-from dotenv import load_dotenv
 
-load_dotenv()
+import http_client
+import metrics
+import resilience
+from cache import TTLCache, normalize_key
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_CX_ID = os.getenv("GOOGLE_CSE_ID")
+GOOGLE_SEARCH_URL = os.getenv("GOOGLE_SEARCH_URL", "https://www.googleapis.com/customsearch/v1")
+metrics.name_upstream(GOOGLE_SEARCH_URL, "google_search")
+# Without a key the API answers 400/403, which still proves it is reachable
+resilience.add_probe("google_search", GOOGLE_SEARCH_URL, idle=False)
+
+# Result cache: fresh for NEWS_CACHE_TTL, then served stale (while one
+# background refresh runs) for up to NEWS_CACHE_STALE more seconds
+NEWS_CACHE_TTL = float(os.getenv("NEWS_CACHE_TTL", "600"))
+NEWS_CACHE_STALE = float(os.getenv("NEWS_CACHE_STALE", "3600"))
+NEWS_CACHE_MAX = int(os.getenv("NEWS_CACHE_MAX", "1000"))
+NEWS_CACHE_PERSIST = os.getenv("NEWS_CACHE_PERSIST", "1") != "0"
+
+news_cache = TTLCache(
+    "news", ttl=NEWS_CACHE_TTL, stale=NEWS_CACHE_STALE, max_entries=NEWS_CACHE_MAX,
+    persist=NEWS_CACHE_PERSIST, max_disk_entries=NEWS_CACHE_MAX * 10,
+)
 
 def extract_search_query(prompt: str) -> str:
     """Return the raw user query for Google search."""
     return prompt.strip()
 
-def search_news_google(query: str, max_results: int = 3) -> list:
-    """Use Google Custom Search API to get top news results."""
+async def fetch_news_google(query: str, max_results: int = 3) -> list:
+    """Call the Google Custom Search API directly; raises on upstream errors."""
     params = {
         "key": GOOGLE_API_KEY,
         "cx": GOOGLE_CX_ID,
         "q": query,
         "num": max_results
     }
+    res = await http_client.get(GOOGLE_SEARCH_URL, params=params, timeout=10)
+    res.raise_for_status()
+    items = res.json().get("items", [])
+    return [
+        {
+            "title": item.get("title"),
+            "snippet": item.get("snippet"),
+            "url": item.get("link")
+        }
+        for item in items
+    ]
 
+@metrics.stage("search_news_google")
+async def search_news_google(query: str, max_results: int = 3) -> list:
+    """Use Google Custom Search API to get top news results (cached per normalized query)."""
+    key = f"{normalize_key(query)}|{max_results}"
     try:
-        res = requests.get("https://www.googleapis.com/customsearch/v1", params=params, timeout=10)
-        res.raise_for_status()
-        items = res.json().get("items", [])
-        return [
-            {
-                "title": item.get("title"),
-                "snippet": item.get("snippet"),
-                "url": item.get("link")
-            }
-            for item in items
-        ]
+        return await news_cache.get(key, lambda: fetch_news_google(query, max_results))
     except Exception as e:
         logging.error(f"[google_news] Search error: {e}")
+    # Google is failing: older results beat none
+    try:
+        return await news_cache.last_known(key) or []
+    except Exception as e:
+        logging.error(f"[google_news] Cache fallback error: {e}")
         return []
 
 def format_news_reply(articles: list, topic: str) -> str:
@@ -51,8 +78,8 @@ def format_news_reply(articles: list, topic: str) -> str:
     return reply
 
 
-def handle_news(user_input: str) -> str:
+async def handle_news(user_input: str) -> str:
     """Main entrypoint for news intent."""
     topic = extract_search_query(user_input)
-    articles = search_news_google(topic)
+    articles = await search_news_google(topic)
     return format_news_reply(articles, topic)
@@ -1,49 +1,308 @@
 # qa_agent.py
 import os
-import json
-import requests
+import time
 import logging
-from dotenv import load_dotenv
-from memory import get_user_context
+from collections import OrderedDict
+from contextlib import aclosing
 
-load_dotenv()
+import llm
+import metrics
+from cache import normalize_key
+from llm import LLM_ERROR_REPLY, LLM_OFFLINE_REPLY
+from memory import get_user_context_async, get_user_summary_async, add_memory_listener
+from agents.reminder_agent import REMINDER_SLOTS, create_reminder, local_now, reminder_prompt_context
+from semantic_memory import semantic_index
+from intent_classifier import IntentClassifier
+from sharding import SHARDED
 
-# Local LLM config (Ollama)
-OLLAMA_ENDPOINT = "http://localhost:11434/api/generate"
-OLLAMA_MODEL = "mistral"  # or llama3, deepseek-coder, etc.
+# Chat sessions: Ollama's returned `context` tokens are kept per user so the
+# next turn only sends the new message instead of the whole history. Off when
+# sharded: a held context would miss turns handled by another shard process.
+QA_SESSION_TTL = float(os.getenv("QA_SESSION_TTL", "1800"))
+QA_SESSION_MAX_USERS = int(os.getenv("QA_SESSION_MAX_USERS", "0" if SHARDED else "500"))
+QA_SESSION_MAX_TOKENS = int(os.getenv("QA_SESSION_MAX_TOKENS", "2000000"))  # across all sessions
+QA_SESSION_MAX_CONTEXT = int(os.getenv("QA_SESSION_MAX_CONTEXT", "3072"))    # per session
+# Prompt budget (approximate tokens) when history has to be rebuilt from memory
+QA_PROMPT_TOKEN_BUDGET = int(os.getenv("QA_PROMPT_TOKEN_BUDGET", "1024"))
+QA_HISTORY_TURNS = 20
+# Older turns recalled by similarity, on top of the recent history
+QA_RECALL_K = int(os.getenv("QA_RECALL_K", "3"))
+QA_RECALL_TOKEN_BUDGET = int(os.getenv("QA_RECALL_TOKEN_BUDGET", "256"))
+QA_RECALL_MAX_CHARS = 400  # per recalled message
+# Streaming replies: max silence between chunks before giving up
+QA_STREAM_READ_TIMEOUT = float(os.getenv("QA_STREAM_READ_TIMEOUT", "60"))
+# Last answers kept (per user and question) to fall back on while Ollama is down
+QA_ANSWER_CACHE_MAX = int(os.getenv("QA_ANSWER_CACHE_MAX", "2000"))
 
-def local_llm_response(prompt: str) -> str:
-    payload = {
-        "model": OLLAMA_MODEL,
-        "prompt": prompt,
-        "stream": False
-    }
+
+class ChatSessionStore:
+    """Per-user Ollama context arrays with TTL and size-based LRU eviction."""
+
+    def __init__(self, ttl: float = QA_SESSION_TTL, max_users: int = QA_SESSION_MAX_USERS,
+                 max_tokens: int = QA_SESSION_MAX_TOKENS, max_context: int = QA_SESSION_MAX_CONTEXT):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_tokens = max_tokens
+        self.max_context = max_context
+        self._sessions = OrderedDict()  # user_id -> (context, last_used)
+        self._tokens = 0
+
+    def get(self, user_id: str):
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return None
+        context, last_used = entry
+        if time.monotonic() - last_used > self.ttl:
+            self.drop(user_id)
+            return None
+        return context
+
+    def put(self, user_id: str, context: list):
+        self.drop(user_id)
+        # A context past the model window would be truncated by Ollama anyway;
+        # start over from a rebuilt prompt instead.
+        if not context or len(context) > self.max_context:
+            return
+        self._sessions[user_id] = (context, time.monotonic())
+        self._tokens += len(context)
+        self._evict()
+
+    def drop(self, user_id: str):
+        entry = self._sessions.pop(user_id, None)
+        if entry is not None:
+            self._tokens -= len(entry[0])
+
+    def _evict(self):
+        now = time.monotonic()
+        for user_id in [u for u, (_, used) in self._sessions.items() if now - used > self.ttl]:
+            self.drop(user_id)
+        while self._sessions and (len(self._sessions) > self.max_users or self._tokens > self.max_tokens):
+            user_id, (context, _) = self._sessions.popitem(last=False)
+            self._tokens -= len(context)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+chat_sessions = ChatSessionStore()
+
+
+class AnswerCache:
+    """Last good answer per (user, normalized question), LRU-bounded.
+
+    Per user because answers are built from that user's memory. Only kept
+    in this process, and dropped by !forget.
+    """
+
+    def __init__(self, max_entries: int = QA_ANSWER_CACHE_MAX):
+        self.max_entries = max_entries
+        self._answers = OrderedDict()  # (user_id, question) -> answer
+        self.served = 0
+
+    def put(self, user_id: str, question: str, answer: str):
+        if self.max_entries <= 0 or not answer:
+            return
+        key = (user_id, normalize_key(question))
+        self._answers[key] = answer
+        self._answers.move_to_end(key)
+        while len(self._answers) > self.max_entries:
+            self._answers.popitem(last=False)
+
+    def get(self, user_id: str, question: str):
+        return self._answers.get((user_id, normalize_key(question)))
+
+    def forget(self, user_id: str):
+        for key in [key for key in self._answers if key[0] == user_id]:
+            del self._answers[key]
+
+    def on_memory_event(self, event, user_id, role=None, message=None):
+        if event == "clear":
+            self.forget(user_id)
+
+    def __len__(self) -> int:
+        return len(self._answers)
+
+
+answer_cache = AnswerCache()
+add_memory_listener(answer_cache.on_memory_event)
+
+
+def fallback_reply(user_input: str, user_id: str) -> str:
+    """Reply when Ollama is down or failed: the earlier answer to this question, if there is one."""
+    answer = answer_cache.get(user_id, user_input)
+    if answer is not None:
+        answer_cache.served += 1
+        return "📦 (My language model isn't answering, so here's my earlier answer.)\n" + answer
+    return LLM_ERROR_REPLY if llm.available() else LLM_OFFLINE_REPLY
+
+
+# Clear-cut messages are labelled locally; only ambiguous ones reach the LLM
+QA_INTENT_RULES = [
+    (r"\bremind(er|ers)?\b", "reminder", 0.95),
+    (r"\b(don'?t let me forget|set an? alarm|add (it|this|an event) to (my )?calendar)\b", "reminder", 0.9),
+    (r"^(what|why|how|who|which|explain|tell me|write|give me|define|summari[sz]e|can you (tell|explain|help))\b", "chat", 0.85),
+]
+
+# One LLM call answers both "which intent?" and, for reminders, "what and when?"
+QA_INTENT_SCHEMA = {
+    "type": "object",
+    "properties": {"intent": {"type": "string", "enum": ["reminder", "chat"]}, **REMINDER_SLOTS},
+    "required": ["intent", *REMINDER_SLOTS],
+}
+
+qa_intents = IntentClassifier(
+    "qa", QA_INTENT_RULES,
+    build=lambda text, label: {"intent": label},
+    label_of=lambda result: result["intent"],
+    # Reminder slots hold absolute times, only valid for this message
+    cache_as=lambda result: {"intent": result["intent"]},
+    # Only reminder confirmations are harvested: any other reply may follow a
+    # misrouted reminder, so "chat" examples come from LLM decisions alone
+    harvest=[("✅ Reminder", "reminder")],
+)
+
+async def _llm_classify_intent(user_input: str, user_id: str = None):
+    prompt = (
+        "Classify the user message as reminder or chat, and extract the reminder if it is one, as JSON.\n"
+        + reminder_prompt_context(await local_now(user_id))
+        + "For chat, leave summary and start empty.\n"
+        f"Message: \"{user_input}\""
+    )
     try:
-        res = requests.post(OLLAMA_ENDPOINT, json=payload, timeout=15)
-        res.raise_for_status()
-        return res.json().get("response", "").strip()
+        return await llm.generate_json(prompt, QA_INTENT_SCHEMA, priority=llm.PRIORITY_FAST)
+    except Exception as e:
+        logging.error(f"[LLM Chat] Classification error: {e}")
+        return None
+
+@metrics.stage("classify_intent")
+async def classify_intent(user_input: str, user_id: str = None) -> dict:
+    """{"intent": "reminder"|"chat"}, plus "summary"/"start" when the LLM extracted a reminder."""
+    llm_fn = (lambda text: _llm_classify_intent(text, user_id)) if llm.available() else None
+    return await qa_intents.classify(user_input, llm_fn) or {"intent": "chat"}
+
+def _reminder_slots(intent: dict):
+    if intent.get("summary") and intent.get("start"):
+        return {"summary": intent["summary"], "start": intent["start"]}
+    return None
+
+async def handle_qa_agent(user_input: str, user_id: str, channel_id: str = None) -> str:
+    intent = await classify_intent(user_input, user_id)
+    if intent["intent"] == "reminder":
+        return await create_reminder(user_input, user_id, channel_id, slots=_reminder_slots(intent))
+    return await chat_response(user_input, user_id)
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting English prompts
+    return len(text) // 4 + 1
+
+def build_chat_prompt(user_input: str, user_id: str, history: list, budget: int = QA_PROMPT_TOKEN_BUDGET,
+                      recalled: str = "", summary: str = None) -> str:
+    """Rebuild a full prompt from stored history, keeping the newest turns that fit the budget."""
+    # The command handler stores the current message before calling us
+    if history and history[-1]["role"] == "user" and history[-1]["message"] == user_input:
+        history = history[:-1]
+    known = f"What you remember about this user from older conversations: {summary}\n" if summary else ""
+    header = "You are a helpful assistant. " + known + recalled + "Here is the conversation so far:\n"
+    turn = f"User: {user_input}\nAssistant:"
+    remaining = budget - estimate_tokens(header) - estimate_tokens(turn)
+    lines = []
+    for row in reversed(history):
+        speaker = "User" if row["role"] == "user" else "Assistant"
+        line = f"{speaker}: {row['message']}"
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            break
+        lines.append(line)
+        remaining -= cost
+    lines.reverse()
+    return header + "".join(line + "\n" for line in lines) + turn
+
+@metrics.stage("recall_block")
+async def recall_block(user_input: str, user_id: str, history: list) -> str:
+    """Older turns similar to this message, capped at QA_RECALL_TOKEN_BUDGET; "" if none."""
+    if QA_RECALL_K <= 0:
+        return ""
+    hits = await semantic_index.search(user_id, user_input, k=QA_RECALL_K,
+                                       exclude=[row["message"] for row in history])
+    lines = []
+    remaining = QA_RECALL_TOKEN_BUDGET
+    for hit in hits:
+        speaker = "User" if hit["role"] == "user" else "Assistant"
+        line = f"- {speaker}: {hit['message'][:QA_RECALL_MAX_CHARS]}"
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            break
+        lines.append(line)
+        remaining -= cost
+    if not lines:
+        return ""
+    return "Possibly relevant earlier messages:\n" + "".join(line + "\n" for line in lines) + "\n"
+
+async def _chat_turn(user_input: str, user_id: str) -> tuple:
+    """Return (prompt, context) for a chat turn, reusing the held KV context if any."""
+    history = await get_user_context_async(user_id, limit=QA_HISTORY_TURNS)
+    recalled = await recall_block(user_input, user_id, history)
+    context = chat_sessions.get(user_id)
+    if context:
+        return f"\n{recalled}User: {user_input}\nAssistant:", context
+    summary = await get_user_summary_async(user_id)
+    return build_chat_prompt(user_input, user_id, history=history, recalled=recalled, summary=summary), None
+
+@metrics.stage("chat_response")
+async def chat_response(user_input: str, user_id: str) -> str:
+    """Chat turn that reuses the user's Ollama KV context when it is still held."""
+    if not llm.available():
+        return fallback_reply(user_input, user_id)
+    prompt, context = await _chat_turn(user_input, user_id)
+    try:
+        data = await llm.generate(prompt, priority=llm.PRIORITY_CHAT, context=context)
     except Exception as e:
         logging.error(f"[LLM Chat] Error: {e}")
-        return "⚠️ I'm having trouble processing that. Try again later."
+        chat_sessions.drop(user_id)
+        return fallback_reply(user_input, user_id)
+    chat_sessions.put(user_id, data.get("context"))
+    answer = data.get("response", "").strip()
+    answer_cache.put(user_id, user_input, answer)
+    return answer
 
-def classify_intent(user_input: str) -> str:
-    prompt = (
-        "Classify the following user message as one of: reminder, chat.\n"
-        f"Message: \"{user_input}\"\n"
-        "Respond with only the label."
-    )
-    response = local_llm_response(prompt)
-    return response.strip().lower()
-
-def handle_qa_agent(user_input: str, user_id: str) -> str:
-    intent = classify_intent(user_input)
-    if "reminder" in intent:
-        from agents.reminder_agent import create_reminder
-        return create_reminder(user_input)
-    context = get_user_context(user_id)
-    prompt = (
-        f"You are a helpful assistant. Here is the conversation so far:\n"
-        f"{context}\n"
-        f"User: {user_input}\nAssistant:"
-    )
-    return local_llm_response(prompt)
+
+async def stream_chat_response(user_input: str, user_id: str):
+    """Like chat_response, but yields text fragments as Ollama streams them."""
+    if not llm.available():
+        yield fallback_reply(user_input, user_id)
+        return
+    prompt, context = await _chat_turn(user_input, user_id)
+    produced = []
+    try:
+        stream = llm.stream_generate(prompt, priority=llm.PRIORITY_CHAT, context=context,
+                                     read_timeout=QA_STREAM_READ_TIMEOUT)
+        async with aclosing(stream):
+            async for chunk in stream:
+                if chunk.get("error"):
+                    raise RuntimeError(chunk["error"])
+                text = chunk.get("response", "")
+                if text:
+                    produced.append(text)
+                    yield text
+                if chunk.get("done"):
+                    chat_sessions.put(user_id, chunk.get("context"))
+                    answer_cache.put(user_id, user_input, "".join(produced).strip())
+                    return
+        # Stream closed without a final "done" chunk; the context can't be trusted
+        chat_sessions.drop(user_id)
+    except Exception as e:
+        logging.error(f"[LLM Chat] Stream error: {e}")
+        chat_sessions.drop(user_id)
+        if produced:
+            yield "\n⚠️ (reply cut short)"
+        else:
+            yield fallback_reply(user_input, user_id)
+
+async def stream_qa_agent(user_input: str, user_id: str, channel_id: str = None):
+    """Streaming entrypoint for !ask; reminders are answered in one piece."""
+    intent = await classify_intent(user_input, user_id)
+    if intent["intent"] == "reminder":
+        yield await create_reminder(user_input, user_id, channel_id, slots=_reminder_slots(intent))
+        return
+    async for text in stream_chat_response(user_input, user_id):
+        yield text
@@ -0,0 +1,81 @@
+# registry.py
+"""Lazily imported agents.
+
+    news = register("agents.news_agent")
+    ...
+    await news.handle_news(query)   # imports agents.news_agent on first use
+
+Registering costs nothing. An agent's module, with its heavy dependencies
+(Google API clients, the intent classifiers...), is imported the first
+time one of its attributes is used, or earlier by `warm_up()`, which the
+bot runs in a worker thread once it is connected. Import times are kept
+for the startup report.
+"""
+import time
+import asyncio
+import logging
+import importlib
+import threading
+
+_agents = {}        # module name -> LazyAgent
+import_times = {}   # module name -> seconds spent importing it
+
+
+class LazyAgent:
+    def __init__(self, module: str, warm: bool = True):
+        self.module_name = module
+        self.warm = warm  # import during warm_up(), not only on first use
+        self._module = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self.module_name)
+                    import_times[self.module_name] = time.perf_counter() - started
+                    self._module = module
+        return self._module
+
+    async def load_async(self):
+        """Import off the event loop; a no-op once loaded."""
+        if self._module is None:
+            await asyncio.to_thread(self.load)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+def register(module: str, warm: bool = True) -> LazyAgent:
+    agent = _agents.get(module)
+    if agent is None:
+        agent = _agents[module] = LazyAgent(module, warm)
+    return agent
+
+
+async def warm_up():
+    """Import every agent registered with warm=True that hasn't been used yet."""
+    for agent in list(_agents.values()):
+        if not agent.warm or agent.loaded:
+            continue
+        try:
+            await agent.load_async()
+        except Exception as e:
+            logging.error(f"[registry] Failed to load {agent.module_name}: {e}")
+
+
+def report() -> str:
+    """Agent import times, slowest first."""
+    lines = []
+    for name, seconds in sorted(import_times.items(), key=lambda item: -item[1]):
+        lines.append(f"  {name:<28} {seconds * 1000:7.1f} ms")
+    idle = [agent.module_name for agent in _agents.values() if not agent.loaded]
+    if idle:
+        lines.append("  not loaded: " + ", ".join(idle))
+    return "\n".join(lines)
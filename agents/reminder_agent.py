@@ -1,96 +1,95 @@
 # reminder_agent.py
 
 import os
-import json
-import requests
+import asyncio
 import datetime
 import logging
-import re
-from dotenv import load_dotenv
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 
-load_dotenv()
+import metrics
+from llm import generate_json, PRIORITY_FAST, available as llm_available
+from agents.reminder_scheduler import reminders, resolve_timezone, REMINDER_DEFAULT_TZ
+from agents.time_parser import parse_reminder
 
-# Google Calendar config
-SCOPES = ['https://www.googleapis.com/auth/calendar']
-GOOGLE_CRED_FILE = 'credentials.json'
-GOOGLE_TOKEN_FILE = 'token.json'
+# Slots the LLM fills for a reminder; the fused !ask extraction reuses them
+REMINDER_SLOTS = {
+    "summary": {"type": "string"},
+    "start": {"type": "string"},  # "YYYY-MM-DD HH:MM", or just the date
+}
+REMINDER_SCHEMA = {"type": "object", "properties": REMINDER_SLOTS, "required": ["summary", "start"]}
 
-# Local LLM config (Ollama)
-OLLAMA_ENDPOINT = "http://localhost:11434/api/generate"
-OLLAMA_MODEL = "mistral"
+class ReminderTimeError(ValueError):
+    """The LLM returned a start time we can't read."""
 
-def local_llm_response(prompt: str) -> str:
-    payload = {
-        "model": OLLAMA_MODEL,
-        "prompt": prompt,
-        "stream": False
-    }
+def reminder_prompt_context(now: datetime.datetime) -> str:
+    return (f"Today's date is {now.strftime('%Y-%m-%d')} and the current time is {now.strftime('%H:%M:%S')}.\n"
+            "For reminders, \"start\" is \"YYYY-MM-DD HH:MM\" and \"summary\" is a short title.\n")
+
+async def local_now(user_id: str = None) -> datetime.datetime:
+    """The user's wall-clock time (naive) in their reminder time zone."""
+    tz_name = await reminders.get_timezone(user_id) if user_id else REMINDER_DEFAULT_TZ
+    return datetime.datetime.now(resolve_timezone(tz_name)).replace(tzinfo=None)
+
+def reminder_from_slots(slots: dict) -> dict:
+    """Turn validated LLM slots into {"summary", "start": datetime}."""
+    summary = (slots.get("summary") or "").strip()
+    start_str = (slots.get("start") or "").strip()
+    if not summary:
+        raise ReminderTimeError("No reminder summary")
     try:
-        res = requests.post(OLLAMA_ENDPOINT, json=payload, timeout=15)
-        res.raise_for_status()
-        return res.json().get("response", "").strip()
-    except Exception as e:
-        logging.error(f"[LLM Chat] Error: {e}")
-        return "⚠️ I'm having trouble processing that. Try again later."
+        start_dt = datetime.datetime.strptime(start_str, "%Y-%m-%d %H:%M")
+    except ValueError:
+        # If only date is provided, default to 09:00
+        try:
+            start_dt = datetime.datetime.strptime(start_str, "%Y-%m-%d")
+            start_dt = start_dt.replace(hour=9, minute=0)
+        except Exception as e:
+            raise ReminderTimeError(f"Invalid date/time format: {e}")
+    return {"summary": summary, "start": start_dt}
 
-def authenticate_google_calendar():
-    creds = None
-    if os.path.exists(GOOGLE_TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(GOOGLE_TOKEN_FILE, SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(GOOGLE_CRED_FILE, SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open(GOOGLE_TOKEN_FILE, 'w') as token:
-            token.write(creds.to_json())
-    return build('calendar', 'v3', credentials=creds)
+async def llm_extract_reminder(event_text: str, now: datetime.datetime = None) -> dict:
+    """LLM fallback: extract {"summary", "start"} from free text in one schema-constrained call."""
+    now = now or datetime.datetime.now()
+    extraction_prompt = (
+        "Extract the reminder from this text as JSON.\n"
+        + reminder_prompt_context(now)
+        + f"Reminder: \"{event_text}\""
+    )
+    slots = await generate_json(extraction_prompt, REMINDER_SCHEMA, priority=PRIORITY_FAST)
+    return reminder_from_slots(slots)
 
-def extract_json(text: str) -> str:
-    match = re.search(r'\{.*?\}', text, re.DOTALL)
-    if match:
-        return match.group(0)
-    raise ValueError("No JSON object found in LLM response")
+@metrics.stage("extract_reminder")
+async def extract_reminder(event_text: str, now: datetime.datetime = None, slots: dict = None) -> dict:
+    """Rule-based parse first; then `slots` an earlier LLM call already extracted; the LLM last."""
+    now = now or datetime.datetime.now()
+    parsed = parse_reminder(event_text, now)
+    if parsed is not None:
+        return parsed
+    if slots is not None:
+        return reminder_from_slots(slots)
+    if not llm_available():
+        # Fail fast rather than queue for an LLM that is known to be down
+        raise ReminderTimeError("LLM unavailable and the rule parser found no time")
+    return await llm_extract_reminder(event_text, now)
 
-def create_reminder(event_text: str) -> str:
+async def create_reminder(event_text: str, user_id: str = None, channel_id: str = None, slots: dict = None) -> str:
+    """Schedule a reminder in the user's time zone; Discord delivers it, Calendar gets a copy.
+
+    `slots` are summary/start already extracted along with the intent (see
+    qa_agent), which saves a second LLM call.
+    """
     try:
-        now = datetime.datetime.now()
-        today_str = now.strftime("%Y-%m-%d")
-        time_str = now.strftime("%H:%M:%S")
-        extraction_prompt = (
-            "Extract reminder details from this text and return JSON like:\n"
-            "{ \"summary\": \"title\", \"start\": \"YYYY-MM-DD HH:MM\" }\n\n"
-            f"Today's date is {today_str} and the current time is {time_str}.\n"
-            f"Reminder: \"{event_text}\"\nResponse:"
-        )
-        response = local_llm_response(extraction_prompt)
-        parsed = json.loads(extract_json(response))
-        summary = parsed["summary"]
-        start_str = parsed["start"]
+        tz_name = await reminders.get_timezone(user_id) if user_id else REMINDER_DEFAULT_TZ
+        tz = resolve_timezone(tz_name)
+        now = datetime.datetime.now(tz).replace(tzinfo=None)
         try:
-            start_dt = datetime.datetime.strptime(start_str, "%Y-%m-%d %H:%M")
-        except ValueError:
-            # If only date is provided, default to 09:00
-            try:
-                start_dt = datetime.datetime.strptime(start_str, "%Y-%m-%d")
-                start_dt = start_dt.replace(hour=9, minute=0)
-            except Exception as e:
-                logging.error(f"[Reminder] Invalid date/time format: {e}")
-                return "⚠️ Could not understand the reminder time. Please specify a time."
-        end_dt = start_dt + datetime.timedelta(minutes=30)
-        service = authenticate_google_calendar()
-        event = {
-            'summary': summary,
-            'start': {'dateTime': start_dt.isoformat(), 'timeZone': 'Asia/Kolkata'},
-            'end': {'dateTime': end_dt.isoformat(), 'timeZone': 'Asia/Kolkata'}
-        }
-        service.events().insert(calendarId='primary', body=event).execute()
-        return f"✅ Reminder '{summary}' set for {start_dt.strftime('%Y-%m-%d %H:%M')}."
+            parsed = await extract_reminder(event_text, now, slots)
+        except ReminderTimeError as e:
+            logging.error(f"[Reminder] {e}")
+            return "⚠️ Could not understand the reminder time. Please specify a time."
+        summary = parsed["summary"]
+        start_dt = parsed["start"]
+        await reminders.add(user_id, channel_id, summary, start_dt.replace(tzinfo=tz))
+        return f"✅ Reminder '{summary}' set for {start_dt.strftime('%Y-%m-%d %H:%M')} ({tz_name})."
     except Exception as e:
         logging.error(f"[Reminder] Failed to set: {e}")
         return "⚠️ Could not create the reminder. Try a simpler description."
@@ -0,0 +1,364 @@
+# reminder_scheduler.py
+import os
+import time
+import heapq
+import asyncio
+import datetime
+import logging
+import sqlite3
+import threading
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sharding import SHARDED
+from agents import registry
+
+# The Google client libraries are only imported once there is something to sync
+calendar_client = registry.register("agents.calendar_client", warm=False)
+
+# Stored next to memory.db
+REMINDERS_DB = os.getenv("REMINDERS_DB", "reminders.db")
+REMINDER_DEFAULT_TZ = os.getenv("REMINDER_DEFAULT_TZ", "Asia/Kolkata")
+# Mirror reminders to Google Calendar in the background (0 = Discord only). On by
+# default once Calendar is authorized (token.json, written by
+# `python -m agents.calendar_client`) or a stand-in API endpoint is set.
+_CALENDAR_READY = bool(os.getenv("CALENDAR_API_ENDPOINT")) or os.path.exists("token.json")
+REMINDER_CALENDAR_SYNC = os.getenv("REMINDER_CALENDAR_SYNC", "1" if _CALENDAR_READY else "0") != "0"
+REMINDER_SYNC_INTERVAL = float(os.getenv("REMINDER_SYNC_INTERVAL", "30"))
+REMINDER_SYNC_MAX_INTERVAL = float(os.getenv("REMINDER_SYNC_MAX_INTERVAL", "1800"))  # back-off cap while failing
+REMINDER_SYNC_BATCH = int(os.getenv("REMINDER_SYNC_BATCH", "50"))
+REMINDER_SYNC_ATTEMPTS = int(os.getenv("REMINDER_SYNC_ATTEMPTS", "5"))  # per reminder, then it's left out
+REMINDER_DELIVERY_CONCURRENCY = int(os.getenv("REMINDER_DELIVERY_CONCURRENCY", "10"))
+# Failed deliveries are retried after REMINDER_RETRY_DELAY, doubling each time,
+# before the reminder is marked failed
+REMINDER_DELIVERY_ATTEMPTS = int(os.getenv("REMINDER_DELIVERY_ATTEMPTS", "5"))
+REMINDER_RETRY_DELAY = float(os.getenv("REMINDER_RETRY_DELAY", "30"))
+# Sharded: how often the leader picks up reminders added by other shard processes
+REMINDER_POLL_INTERVAL = float(os.getenv("REMINDER_POLL_INTERVAL", "5"))
+REMINDER_DURATION = datetime.timedelta(minutes=30)  # Calendar event length
+
+# Upper bound on a single sleep so wall-clock jumps are noticed
+_MAX_SLEEP = 300.0
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS reminders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        channel_id TEXT,          -- NULL means deliver by DM
+        summary TEXT,
+        due_at REAL,              -- UTC epoch seconds
+        timezone TEXT,
+        status TEXT DEFAULT 'pending',  -- 'pending', 'sent' or 'failed'
+        calendar_synced INTEGER DEFAULT 0,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        attempts INTEGER DEFAULT 0,       -- failed deliveries so far
+        sync_attempts INTEGER DEFAULT 0   -- failed Calendar inserts so far
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders (due_at) WHERE status = 'pending'",
+    '''
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id TEXT PRIMARY KEY,
+        timezone TEXT
+    )
+    ''',
+]
+
+# Columns added since the table was first created: (name, declaration)
+COLUMNS = [
+    ("attempts", "INTEGER DEFAULT 0"),
+    ("sync_attempts", "INTEGER DEFAULT 0"),
+]
+# Created after COLUMNS exist; rows that keep failing sort behind fresh ones
+SYNC_INDEX = [
+    "DROP INDEX IF EXISTS idx_reminders_unsynced",
+    "CREATE INDEX IF NOT EXISTS idx_reminders_sync ON reminders (sync_attempts, id) WHERE calendar_synced = 0",
+]
+
+
+def resolve_timezone(name: str):
+    """ZoneInfo for `name`, or None if it isn't a valid IANA zone."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+class ReminderScheduler:
+    """Persistent reminders fired from the asyncio loop.
+
+    Pending reminders live in SQLite; at startup only their (due_at, id)
+    pairs are loaded into a min-heap. One timer task sleeps until the
+    earliest due time, so scheduling and firing are O(log n). Rows are
+    read back by id when they fire. `deliver(reminder)` is supplied by the
+    bot and returns True once the notification is sent.
+    """
+
+    def __init__(self, path: str = REMINDERS_DB):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._heap = []
+        self._scheduled = set()  # ids in the heap or being fired
+        self._wakeup = None
+        self._deliver = None
+        self._tasks = []
+        self._timezones = {}
+        self.stats = {"scheduled": 0, "sent": 0, "retried": 0, "failed": 0, "synced": 0}
+
+    # ---- storage (runs in worker threads) ----
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(reminders)")}
+            for name, declaration in COLUMNS:
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE reminders ADD COLUMN {name} {declaration}")
+            for statement in SYNC_INDEX:
+                conn.execute(statement)
+            self._conn = conn
+        return self._conn
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._db().execute(sql, params).fetchall()
+
+    def _write(self, sql: str, params) -> int:
+        with self._lock:
+            conn = self._db()
+            with conn:
+                if isinstance(params, list):
+                    conn.executemany(sql, params)
+                    return 0
+                return conn.execute(sql, params).lastrowid
+
+    # ---- timezones ----
+
+    async def get_timezone(self, user_id: str) -> str:
+        # Sharded, another process may have changed it: always read it back
+        if SHARDED or user_id not in self._timezones:
+            rows = await asyncio.to_thread(
+                self._query, "SELECT timezone FROM user_settings WHERE user_id = ?", (user_id,)
+            )
+            self._timezones[user_id] = rows[0][0] if rows else REMINDER_DEFAULT_TZ
+        return self._timezones[user_id]
+
+    async def set_timezone(self, user_id: str, name: str) -> bool:
+        if resolve_timezone(name) is None:
+            return False
+        await asyncio.to_thread(
+            self._write, "INSERT OR REPLACE INTO user_settings (user_id, timezone) VALUES (?, ?)", (user_id, name)
+        )
+        self._timezones[user_id] = name
+        return True
+
+    # ---- scheduling ----
+
+    async def add(self, user_id: str, channel_id: str, summary: str, start: datetime.datetime) -> int:
+        """Store a reminder; `start` must be timezone-aware."""
+        tz_name = getattr(start.tzinfo, "key", None) or REMINDER_DEFAULT_TZ
+        due_at = start.timestamp()
+        reminder_id = await asyncio.to_thread(
+            self._write,
+            "INSERT INTO reminders (user_id, channel_id, summary, due_at, timezone) VALUES (?, ?, ?, ?, ?)",
+            (user_id, channel_id, summary, due_at, tz_name)
+        )
+        self._push(due_at, reminder_id)
+        self.stats["scheduled"] += 1
+        return reminder_id
+
+    def _push(self, due_at: float, reminder_id: int):
+        if self._wakeup is None or reminder_id in self._scheduled:
+            return  # not running the timer here (a non-leader shard process), or already scheduled
+        self._scheduled.add(reminder_id)
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (due_at, reminder_id))
+        if self._wakeup is not None and (earliest is None or due_at < earliest):
+            self._wakeup.set()
+
+    def pending_count(self) -> int:
+        return len(self._heap)
+
+    async def start(self, deliver):
+        """Load pending reminders and start the timer (and Calendar sync) tasks."""
+        self._deliver = deliver
+        self._wakeup = asyncio.Event()
+        rows = await asyncio.to_thread(
+            self._query, "SELECT due_at, id FROM reminders WHERE status = 'pending'"
+        )
+        self._heap = [(due_at, reminder_id) for due_at, reminder_id in rows]
+        heapq.heapify(self._heap)
+        self._scheduled = {reminder_id for _, reminder_id in self._heap}
+        logging.info(f"[reminders] Loaded {len(self._heap)} pending reminders")
+        self._tasks.append(asyncio.ensure_future(self._run()))
+        if SHARDED:
+            last_id = max((reminder_id for _, reminder_id in self._heap), default=0)
+            self._tasks.append(asyncio.ensure_future(self._poll_loop(last_id)))
+        if REMINDER_CALENDAR_SYNC:
+            self._tasks.append(asyncio.ensure_future(self._sync_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[1])
+            if due:
+                retries = []
+                try:
+                    retries = await self._fire(due)
+                except Exception as e:
+                    logging.error(f"[reminders] Failed to fire {len(due)} reminders: {e}")
+                self._scheduled.difference_update(due)
+                for due_at, reminder_id in retries:
+                    self._push(due_at, reminder_id)
+                continue
+            timeout = min(self._heap[0][0] - now, _MAX_SLEEP) if self._heap else _MAX_SLEEP
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll_loop(self, last_id: int):
+        """Schedule reminders stored by other shard processes."""
+        while True:
+            await asyncio.sleep(REMINDER_POLL_INTERVAL)
+            try:
+                rows = await asyncio.to_thread(
+                    self._query, "SELECT due_at, id FROM reminders WHERE status = 'pending' AND id > ?", (last_id,)
+                )
+            except Exception as e:
+                logging.warning(f"[reminders] Poll failed: {e}")
+                continue
+            # Our own adds come back too; _push skips ids it already has
+            for due_at, reminder_id in rows:
+                self._push(due_at, reminder_id)
+                last_id = max(last_id, reminder_id)
+
+    async def _fire(self, ids: list) -> list:
+        """Deliver due reminders; returns (due_at, id) for the ones to try again later."""
+        rows = []
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows += await asyncio.to_thread(
+                self._query,
+                f"SELECT id, user_id, channel_id, summary, due_at, timezone, attempts FROM reminders "
+                f"WHERE status = 'pending' AND id IN ({','.join('?' * len(chunk))})",
+                tuple(chunk)
+            )
+        limit = asyncio.Semaphore(REMINDER_DELIVERY_CONCURRENCY)
+
+        async def deliver(row):
+            reminder = dict(zip(("id", "user_id", "channel_id", "summary", "due_at", "timezone"), row))
+            async with limit:
+                try:
+                    return await self._deliver(reminder)
+                except Exception as e:
+                    logging.error(f"[reminders] Delivery of {reminder['id']} failed: {e}")
+                    return False
+
+        results = await asyncio.gather(*(deliver(row) for row in rows))
+        updates = []
+        retries = []
+        now = time.time()
+        for row, ok in zip(rows, results):
+            reminder_id, attempts = row[0], row[6] + (not ok)
+            if ok:
+                status = "sent"
+            elif attempts < REMINDER_DELIVERY_ATTEMPTS:
+                # Still pending: a Discord hiccup shouldn't lose the reminder
+                status = "pending"
+                retries.append((now + REMINDER_RETRY_DELAY * 2 ** (attempts - 1), reminder_id))
+            else:
+                status = "failed"
+            self.stats["retried" if status == "pending" else status] += 1
+            updates.append((status, attempts, reminder_id))
+        await asyncio.to_thread(self._write, "UPDATE reminders SET status = ?, attempts = ? WHERE id = ?", updates)
+        return retries
+
+    # ---- Google Calendar mirror ----
+
+    async def _sync_loop(self):
+        delay = REMINDER_SYNC_INTERVAL
+        while True:
+            try:
+                synced = await self._sync_batch()
+                delay = REMINDER_SYNC_INTERVAL
+            except Exception as e:
+                logging.warning(f"[reminders] Calendar sync failed, next try in {delay:.0f}s: {e}")
+                synced = 0
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, REMINDER_SYNC_MAX_INTERVAL)
+                continue
+            if synced < REMINDER_SYNC_BATCH:
+                await asyncio.sleep(delay)
+
+    async def _sync_batch(self) -> int:
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT id, summary, due_at, timezone FROM reminders "
+            "WHERE calendar_synced = 0 AND sync_attempts < ? ORDER BY sync_attempts, id LIMIT ?",
+            (REMINDER_SYNC_ATTEMPTS, REMINDER_SYNC_BATCH)
+        )
+        if not rows:
+            return 0
+        calendar = (await calendar_client.load_async()).calendar
+        events = []
+        for _, summary, due_at, tz_name in rows:
+            tz = resolve_timezone(tz_name) or resolve_timezone(REMINDER_DEFAULT_TZ)
+            start = datetime.datetime.fromtimestamp(due_at, tz).replace(tzinfo=None)
+            end = start + REMINDER_DURATION
+            events.append({
+                'summary': summary,
+                'start': {'dateTime': start.isoformat(), 'timeZone': tz_name},
+                'end': {'dateTime': end.isoformat(), 'timeZone': tz_name}
+            })
+        # Inserts issued together are merged into one Calendar batch request
+        results = await asyncio.gather(*(calendar.insert_event(e) for e in events), return_exceptions=True)
+        done = [(row[0],) for row, result in zip(rows, results) if not isinstance(result, Exception)]
+        rejected = [(row[0],) for row, result in zip(rows, results) if _rejected(result)]
+        if done:
+            await asyncio.to_thread(self._write, "UPDATE reminders SET calendar_synced = 1 WHERE id = ?", done)
+            self.stats["synced"] += len(done)
+        if rejected:
+            # Counted, so these rows sort behind fresh ones and are dropped after REMINDER_SYNC_ATTEMPTS
+            await asyncio.to_thread(
+                self._write, "UPDATE reminders SET sync_attempts = sync_attempts + 1 WHERE id = ?", rejected
+            )
+            logging.warning(f"[reminders] Calendar rejected {len(rejected)} of {len(rows)} reminders")
+        errors = [result for result in results if isinstance(result, Exception) and not _rejected(result)]
+        if errors:
+            # Calendar itself is failing: back off without counting it against the reminders
+            raise errors[0]
+        return len(done) + len(rejected)
+
+
+def _rejected(result) -> bool:
+    """True for an insert Calendar refused because of the event itself (a 4xx other than auth/quota)."""
+    if not isinstance(result, Exception):
+        return False
+    status = getattr(result, "status_code", None) or getattr(getattr(result, "resp", None), "status", None)
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return False
+    return 400 <= status < 500 and status not in (401, 403, 429)
+
+
+reminders = ReminderScheduler()
@@ -1,156 +1,293 @@
 import os
-import requests
+import re
 import logging
-import json
 import time
-from dotenv import load_dotenv
-from memory import get_user_context
+import asyncio
 
-load_dotenv()
+import http_client
+import llm
+import metrics
+import resilience
+from cache import TTLCache, normalize_key
+from ratelimit import token_bucket
+from agents.spotify_auth import spotify_tokens
+from memory import get_user_context_async
+from intent_classifier import IntentClassifier
 
-# Environment variables
-SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
-SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
-SPOTIFY_REFRESH_TOKEN = os.getenv("SPOTIFY_REFRESH_TOKEN")
-OLLAMA_ENDPOINT = "http://localhost:11434/api/generate"
+# Spotify API (override the base to point at a stand-in, e.g. bench/stubs.py)
+SPOTIFY_API_BASE = os.getenv("SPOTIFY_API_BASE", "https://api.spotify.com/v1").rstrip("/")
+SPOTIFY_QUEUE_API = f"{SPOTIFY_API_BASE}/me/player/queue"
+SPOTIFY_SEARCH_API = f"{SPOTIFY_API_BASE}/search"
+SPOTIFY_UPSTREAM = "spotify"
+metrics.name_upstream(SPOTIFY_API_BASE, SPOTIFY_UPSTREAM)
+# Any reply (401 without a token) means the API is reachable
+resilience.add_probe(SPOTIFY_UPSTREAM, SPOTIFY_API_BASE, idle=False)
 
-# Spotify API
-SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
-SPOTIFY_QUEUE_API = "https://api.spotify.com/v1/me/player/queue"
-SPOTIFY_SEARCH_API = "https://api.spotify.com/v1/search"
+# Catalog cache (memory LRU + cache.db): per-type TTLs in seconds, then size limits
+SPOTIFY_SEARCH_TTL = float(os.getenv("SPOTIFY_SEARCH_TTL", str(24 * 3600)))
+SPOTIFY_ALBUM_TTL = float(os.getenv("SPOTIFY_ALBUM_TTL", str(30 * 24 * 3600)))
+SPOTIFY_TOP_TRACKS_TTL = float(os.getenv("SPOTIFY_TOP_TRACKS_TTL", str(24 * 3600)))
+SPOTIFY_CACHE_MAX = int(os.getenv("SPOTIFY_CACHE_MAX", "2000"))
+SPOTIFY_CACHE_MAX_DISK = int(os.getenv("SPOTIFY_CACHE_MAX_DISK", "50000"))
 
-# Global token cache
-_spotify_token = None
-_spotify_token_expiry = 0
+def _catalog_cache(namespace: str, ttl: float, should_cache=bool) -> TTLCache:
+    # Catalog data barely changes, so stale entries stay usable for another full TTL
+    return TTLCache(namespace, ttl=ttl, stale=ttl, max_entries=SPOTIFY_CACHE_MAX, persist=True,
+                    max_disk_entries=SPOTIFY_CACHE_MAX_DISK, should_cache=should_cache)
 
-def get_spotify_access_token() -> str:
-    global _spotify_token, _spotify_token_expiry
-    
-    # If token is still valid, return it
-    if _spotify_token and time.time() < _spotify_token_expiry:
-        return _spotify_token
+search_cache = _catalog_cache("spotify_search", SPOTIFY_SEARCH_TTL, should_cache=lambda hit: bool(hit and hit[1]))
+album_tracks_cache = _catalog_cache("spotify_album_tracks", SPOTIFY_ALBUM_TTL)
+top_tracks_cache = _catalog_cache("spotify_top_tracks", SPOTIFY_TOP_TRACKS_TTL)
 
-    try:
-        auth = (SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
-        data = {
-            "grant_type": "refresh_token",
-            "refresh_token": SPOTIFY_REFRESH_TOKEN
-        }
-        response = requests.post(SPOTIFY_TOKEN_URL, data=data, auth=auth, timeout=10)
-        response.raise_for_status()
-        resp_json = response.json()
-        _spotify_token = resp_json.get("access_token")
-        # Set expiry to now + expires_in (default 3600 seconds)
-        _spotify_token_expiry = time.time() + resp_json.get("expires_in", 3600) - 60  # 1 min buffer
-        return _spotify_token
-    except Exception as e:
-        logging.error(f"[spotify] Failed to refresh token: {e}")
-        return None
+# Pacing for Spotify Web API calls made in bulk (requests per second). The
+# rate halves on every 429 and creeps back up on success.
+SPOTIFY_RATE = float(os.getenv("SPOTIFY_RATE", "8"))
+SPOTIFY_MAX_RATE = float(os.getenv("SPOTIFY_MAX_RATE", "20"))
+SPOTIFY_QUEUE_RETRIES = int(os.getenv("SPOTIFY_QUEUE_RETRIES", "3"))
+# Longest one command waits on the bucket before giving up on what is left
+SPOTIFY_MAX_WAIT = float(os.getenv("SPOTIFY_MAX_WAIT", "20"))
+# Minimum seconds between progress updates while bulk queueing
+SPOTIFY_PROGRESS_INTERVAL = float(os.getenv("SPOTIFY_PROGRESS_INTERVAL", "1.5"))
 
-def classify_music_request(prompt: str) -> dict:
-    payload = {
-        "model": "mistral",
-        "prompt": (
-            "You are a music assistant.\n"
-            "Given a user message, extract the music intent in JSON format like:\n"
-            "{ \"type\": \"artist|album|playlist|track\", \"value\": \"search query\" }\n"
-            "If unsure, use 'track' as type. Only use the user's message as value.\n"
-            f"User: {prompt}\n"
-            "Intent:"
-        ),
-        "stream": False
-    }
+# One Spotify app rate limit, so shard processes share this bucket
+spotify_bucket = token_bucket("spotify", SPOTIFY_RATE, capacity=SPOTIFY_RATE, min_rate=1, max_rate=SPOTIFY_MAX_RATE)
+
+
+class SpotifyRateLimited(Exception):
+    """The bucket can't give a token before the command's SPOTIFY_MAX_WAIT runs out."""
+
+
+async def get_spotify_access_token(user_id: str = None) -> str:
+    """Current access token for the user's linked account, else the global one."""
+    return await spotify_tokens.get_token(user_id)
+
+async def _auth_headers(user_id: str = None) -> dict:
+    return {"Authorization": f"Bearer {await get_spotify_access_token(user_id)}"}
+
+MUSIC_TYPES = ("track", "album", "artist", "playlist")
+
+# Clear-cut requests are labelled locally; only ambiguous ones reach the LLM
+MUSIC_INTENT_RULES = [
+    (r"\bplaylists?\b", "playlist", 0.95),
+    (r"\balbums?\b", "album", 0.95),
+    (r"^(play\s+)?(the\s+)?artist\b", "artist", 0.95),
+    (r"\b(songs|music|tracks|hits|anything|something|stuff)\s+(by|from|of)\b", "artist", 0.9),
+    (r"\btop\s+(songs|tracks|hits)\b", "artist", 0.9),
+    (r"\S\s+by\s+\S", "track", 0.85),
+]
+
+_MUSIC_FILLER = re.compile(
+    r"^(please\s+)?(can you\s+)?(play|queue|put on|add|listen to)\s+(me\s+)?(some\s+)?(the\s+)?", re.IGNORECASE
+)
+
+def extract_music_query(prompt: str, search_type: str) -> str:
+    """Strip command words so the rest can be used as a Spotify search query."""
+    query = _MUSIC_FILLER.sub("", prompt.strip())
+    if search_type == "artist":
+        query = re.sub(r"^(the\s+)?artist\s+", "", query, flags=re.IGNORECASE)
+        query = re.sub(r"^.*?\b(songs|music|tracks|hits|anything|something|stuff)\s+(by|from|of)\s+", "", query,
+                       flags=re.IGNORECASE)
+    elif search_type in ("album", "playlist"):
+        query = re.sub(rf"\b(the\s+)?{search_type}s?\b", " ", query, flags=re.IGNORECASE)
+        query = re.sub(r"\s+by\s+", " ", query, flags=re.IGNORECASE)
+    elif search_type == "track":
+        query = re.sub(r"\s+by\s+", " ", query, flags=re.IGNORECASE)
+    query = re.sub(r"\s+", " ", query).strip(" .!?,")
+    return query or prompt.strip()
+
+def _music_label(intent: dict):
+    return intent.get("type") if intent.get("type") in MUSIC_TYPES else None
+
+music_intents = IntentClassifier(
+    "music", MUSIC_INTENT_RULES,
+    build=lambda text, label: {"type": label, "value": extract_music_query(text, label)},
+    label_of=_music_label,
+    harvest=[
+        ("🎧 Added album:", "album"), ("❌ Could not find album:", "album"),
+        ("🎧 Added top tracks by:", "artist"), ("❌ Could not find artist:", "artist"),
+        ("🔗 Playlist found:", "playlist"), ("❌ Could not find playlist:", "playlist"),
+        ("🎧 Now playing:", "track"), ("❌ Could not find track:", "track"),
+    ],
+)
+
+MUSIC_INTENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "type": {"type": "string", "enum": list(MUSIC_TYPES)},
+        "value": {"type": "string"},
+    },
+    "required": ["type", "value"],
+}
+
+async def _llm_classify_music(prompt: str):
+    llm_prompt = (
+        "You are a music assistant. Extract the music intent from the user's message as JSON.\n"
+        "\"type\" is artist, album, playlist or track (track if unsure); "
+        "\"value\" is the search query, taken from the user's message.\n"
+        f"User: {prompt}"
+    )
     try:
-        res = requests.post(OLLAMA_ENDPOINT, json=payload, timeout=10)
-        res.raise_for_status()
-        parsed = res.json().get("response", "").strip()
-        if "{" in parsed:
-            import re
-            match = re.search(r"\{.*\}", parsed, re.DOTALL)
-            if match:
-                return json.loads(match.group(0))
-        # fallback: treat whole prompt as track search
-        return {"type": "track", "value": prompt}
+        intent = await llm.generate_json(llm_prompt, MUSIC_INTENT_SCHEMA, priority=llm.PRIORITY_FAST, timeout=10)
+    except llm.LLMFormatError as e:
+        logging.warning(f"[llm] Unusable music intent: {e}")
+        # None, not a guess: the classifier must not learn it as the LLM's answer
+        return None
     except Exception as e:
         logging.warning(f"[llm] Failed to classify: {e}")
-        return {"type": "track", "value": prompt}
+        return None
+    if not intent["value"].strip():
+        return None
+    return intent
 
-def find_spotify_uri(search_query: str, search_type: str = "track", market: str = "IN") -> tuple:
-    headers = {"Authorization": f"Bearer {get_spotify_access_token()}"}
+@metrics.stage("classify_music_request")
+async def classify_music_request(prompt: str) -> dict:
+    # While Ollama is down or its answer is unusable, unclear requests become track searches
+    intent = await music_intents.classify(prompt, _llm_classify_music if llm.available() else None)
+    return intent or {"type": "track", "value": prompt}
+
+def _slim_tracks(items: list) -> list:
+    # Only what queueing needs; keeps both cache tiers small
+    return [{"uri": item["uri"], "name": item.get("name")} for item in items if item and item.get("uri")]
+
+async def _search_spotify(search_query: str, search_type: str, market: str, user_id: str = None) -> list:
+    headers = await _auth_headers(user_id)
     params = {
         "q": search_query,
         "type": search_type,
         "market": market,
         "limit": 5 if search_type == "artist" else 1  # get more artists to check
     }
+    res = await http_client.get(SPOTIFY_SEARCH_API, headers=headers, params=params, timeout=10)
+    res.raise_for_status()
+    items = [item for item in res.json().get(f"{search_type}s", {}).get("items", []) if item]
+    if search_type == "artist":
+        # Try to find the best match
+        for item in items:
+            if search_query.lower() in item["name"].lower():
+                return [item["external_urls"]["spotify"], item["uri"]]
+    # fallback to first if no match
+    if items:
+        return [items[0]["external_urls"]["spotify"], items[0]["uri"]]
+    return [None, None]
+
+@metrics.stage("find_spotify_uri")
+async def find_spotify_uri(search_query: str, search_type: str = "track", market: str = "IN",
+                           user_id: str = None) -> tuple:
+    # Catalog results don't depend on whose token fetched them, so the cache stays shared
+    key = f"{search_type}|{normalize_key(search_query)}|{market}"
     try:
-        res = requests.get(SPOTIFY_SEARCH_API, headers=headers, params=params, timeout=10)
-        res.raise_for_status()
-        if search_type == "track":
-            items = res.json().get("tracks", {}).get("items", [])
-            if items:
-                return items[0]["external_urls"]["spotify"], items[0]["uri"]
-        elif search_type == "album":
-            items = res.json().get("albums", {}).get("items", [])
-            if items:
-                return items[0]["external_urls"]["spotify"], items[0]["uri"]
-        elif search_type == "artist":
-            items = res.json().get("artists", {}).get("items", [])
-            # Try to find the best match
-            for item in items:
-                if search_query.lower() in item["name"].lower():
-                    return item["external_urls"]["spotify"], item["uri"]
-            # fallback to first if no match
-            if items:
-                return items[0]["external_urls"]["spotify"], items[0]["uri"]
-        return None, None
+        link, uri = await search_cache.get(key, lambda: _search_spotify(search_query, search_type, market, user_id))
+        return link, uri
     except Exception as e:
         logging.warning(f"[spotify] Search error: {e}")
         return None, None
 
-def get_album_tracks(album_id: str) -> list:
-    headers = {"Authorization": f"Bearer {get_spotify_access_token()}"}
-    tracks_url = f"https://api.spotify.com/v1/albums/{album_id}/tracks"
-    
+async def _fetch_album_tracks(album_id: str, user_id: str = None) -> list:
+    headers = await _auth_headers(user_id)
+    tracks_url = f"{SPOTIFY_API_BASE}/albums/{album_id}/tracks"
+    res = await http_client.get(tracks_url, headers=headers, timeout=10)
+    res.raise_for_status()
+    return _slim_tracks(res.json().get("items", []))
+
+@metrics.stage("get_album_tracks")
+async def get_album_tracks(album_id: str, user_id: str = None) -> list:
     try:
-        res = requests.get(tracks_url, headers=headers, timeout=10)
-        res.raise_for_status()
-        return res.json().get("items", [])
+        return await album_tracks_cache.get(album_id, lambda: _fetch_album_tracks(album_id, user_id))
     except Exception as e:
         logging.error(f"[spotify] Failed to get album tracks: {e}")
         return []
 
-def get_artist_top_tracks(artist_id: str, market: str = "IN") -> list:
-    headers = {"Authorization": f"Bearer {get_spotify_access_token()}"}
-    tracks_url = f"https://api.spotify.com/v1/artists/{artist_id}/top-tracks?market={market}"
-    
+async def _fetch_artist_top_tracks(artist_id: str, market: str, user_id: str = None) -> list:
+    headers = await _auth_headers(user_id)
+    tracks_url = f"{SPOTIFY_API_BASE}/artists/{artist_id}/top-tracks?market={market}"
+    res = await http_client.get(tracks_url, headers=headers, timeout=10)
+    res.raise_for_status()
+    return _slim_tracks(res.json().get("tracks", []))
+
+@metrics.stage("get_artist_top_tracks")
+async def get_artist_top_tracks(artist_id: str, market: str = "IN", user_id: str = None) -> list:
     try:
-        res = requests.get(tracks_url, headers=headers, timeout=10)
-        res.raise_for_status()
-        return res.json().get("tracks", [])
+        return await top_tracks_cache.get(f"{artist_id}|{market}",
+                                          lambda: _fetch_artist_top_tracks(artist_id, market, user_id))
     except Exception as e:
         logging.error(f"[spotify] Failed to get artist top tracks: {e}")
         return []
 
-def queue_spotify_track(uri: str) -> bool:
-    headers = {"Authorization": f"Bearer {get_spotify_access_token()}"}
-    params = {"uri": uri}
+def _retry_after(res) -> float:
     try:
-        res = requests.post(SPOTIFY_QUEUE_API, headers=headers, params=params, timeout=5)
-        # Only fail on 401, 403, 404, 429
-        if res.status_code in (401, 403, 404, 429):
+        return max(float(res.headers.get("Retry-After", "1")), 0.0)
+    except ValueError:
+        return 1.0
+
+async def _queue_track(uri: str, user_id: str = None, deadline: float = None) -> str:
+    """Queue one track, waiting out 429s; returns "ok", "rejected" or "failed".
+
+    Raises SpotifyRateLimited if the bucket can't give a token before `deadline`.
+    """
+    for attempt in range(SPOTIFY_QUEUE_RETRIES + 1):
+        if not await spotify_bucket.acquire(deadline=deadline):
+            raise SpotifyRateLimited()
+        headers = await _auth_headers(user_id)
+        try:
+            res = await http_client.post(SPOTIFY_QUEUE_API, headers=headers, params={"uri": uri}, timeout=5)
+        except Exception as e:
+            logging.warning(f"[spotify] Queue error: {e}")
+            return "failed"
+        if res.status_code == 429:
+            delay = _retry_after(res)
+            logging.warning(f"[spotify] Rate limited; retrying {uri} in {delay:.1f}s (attempt {attempt + 1})")
+            spotify_bucket.penalize(delay)
+            continue
+        # 401/403/404 mean no auth or no active device: retrying won't help
+        if res.status_code in (401, 403, 404):
             logging.warning(f"[spotify] Queue error: {res.status_code} - {res.text}")
-            return False
+            return "rejected"
         # For all other codes (including 2xx), treat as success
-        return True
-    except Exception as e:
-        logging.warning(f"[spotify] Queue error: {e}")
-        return False
+        spotify_bucket.reward()
+        return "ok"
+    return "failed"
+
+@metrics.stage("queue_spotify_track")
+async def queue_spotify_track(uri: str, user_id: str = None) -> bool:
+    return await _queue_track(uri, user_id, time.monotonic() + SPOTIFY_MAX_WAIT) == "ok"
+
+@metrics.stage("queue_spotify_tracks")
+async def queue_spotify_tracks(uris: list, progress=None, user_id: str = None) -> int:
+    """Queue tracks in order, paced by the shared token bucket; returns how many were queued.
 
-def pause_music() -> bool:
-    headers = {"Authorization": f"Bearer {get_spotify_access_token()}"}
+    Spotify appends to the queue in arrival order, so tracks are sent one
+    after another rather than in parallel. `progress(done, total)` is
+    awaited at most every SPOTIFY_PROGRESS_INTERVAL seconds. Stops after
+    SPOTIFY_MAX_WAIT seconds of rate limiting; raises SpotifyRateLimited if
+    nothing was queued by then.
+    """
+    queued = 0
+    last_report = time.monotonic()
+    deadline = last_report + SPOTIFY_MAX_WAIT
+    for done, uri in enumerate(uris, start=1):
+        try:
+            status = await _queue_track(uri, user_id, deadline)
+        except SpotifyRateLimited:
+            if queued == 0:
+                raise
+            logging.warning(f"[spotify] Rate limited; stopped after {queued}/{len(uris)} tracks")
+            break
+        if status == "ok":
+            queued += 1
+        elif status == "rejected" and queued == 0:
+            break
+        if progress and done < len(uris) and time.monotonic() - last_report >= SPOTIFY_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            try:
+                await progress(done, len(uris))
+            except Exception as e:
+                logging.warning(f"[spotify] Progress update failed: {e}")
+    return queued
+
+async def pause_music(user_id: str = None) -> bool:
+    headers = await _auth_headers(user_id)
     try:
-        res = requests.put("https://api.spotify.com/v1/me/player/pause", headers=headers, timeout=5)
+        res = await http_client.put(f"{SPOTIFY_API_BASE}/me/player/pause", headers=headers, timeout=5)
         if res.status_code in (401, 403, 404, 429):
             logging.error(f"[spotify] Pause error: {res.status_code} - {res.text}")
             return False
@@ -159,10 +296,10 @@ def pause_music() -> bool:
         logging.error(f"[spotify] Pause error: {e}")
         return False
 
-def resume_music() -> bool:
-    headers = {"Authorization": f"Bearer {get_spotify_access_token()}"}
+async def resume_music(user_id: str = None) -> bool:
+    headers = await _auth_headers(user_id)
     try:
-        res = requests.put("https://api.spotify.com/v1/me/player/play", headers=headers, timeout=5)
+        res = await http_client.put(f"{SPOTIFY_API_BASE}/me/player/play", headers=headers, timeout=5)
         if res.status_code in (401, 403, 404, 429):
             logging.error(f"[spotify] Resume error: {res.status_code} - {res.text}")
             return False
@@ -171,10 +308,10 @@ def resume_music() -> bool:
         logging.error(f"[spotify] Resume error: {e}")
         return False
 
-def next_song() -> bool:
-    headers = {"Authorization": f"Bearer {get_spotify_access_token()}"}
+async def next_song(user_id: str = None) -> bool:
+    headers = await _auth_headers(user_id)
     try:
-        res = requests.post("https://api.spotify.com/v1/me/player/next", headers=headers, timeout=5)
+        res = await http_client.post(f"{SPOTIFY_API_BASE}/me/player/next", headers=headers, timeout=5)
         if res.status_code in (401, 403, 404, 429):
             logging.error(f"[spotify] Next song error: {res.status_code} - {res.text}")
             return False
@@ -183,10 +320,10 @@ def next_song() -> bool:
         logging.error(f"[spotify] Next song error: {e}")
         return False
 
-def get_current_track_uri() -> str:
-    headers = {"Authorization": f"Bearer {get_spotify_access_token()}"}
+async def get_current_track_uri(user_id: str = None) -> str:
+    headers = await _auth_headers(user_id)
     try:
-        res = requests.get("https://api.spotify.com/v1/me/player/currently-playing", headers=headers, timeout=5)
+        res = await http_client.get(f"{SPOTIFY_API_BASE}/me/player/currently-playing", headers=headers, timeout=5)
         if res.status_code == 200:
             data = res.json()
             return data.get("item", {}).get("uri")
@@ -195,12 +332,28 @@ def get_current_track_uri() -> str:
         logging.error(f"[spotify] Get current track error: {e}")
         return None
 
-def handle_music(user_input: str, user_id: str = None) -> str:
+def _bulk_progress(progress, label: str):
+    if progress is None:
+        return None
+    async def report(done: int, total: int):
+        await progress(f"🎶 Queueing {label}… {done}/{total}")
+    return report
+
+async def handle_music(user_input: str, user_id: str = None, progress=None) -> str:
+    """Main entrypoint for !play; `progress(text)` is awaited with status updates for bulk queues."""
+    try:
+        return await _handle_music(user_input, user_id, progress)
+    except SpotifyRateLimited:
+        return "⏳ Spotify is rate limiting, try again shortly."
+
+async def _handle_music(user_input: str, user_id: str = None, progress=None) -> str:
     print(f"[handle_music] User input: {user_input}")
-    intent = classify_music_request(user_input)
+    if not resilience.available(SPOTIFY_UPSTREAM):
+        return "⚠️ Spotify isn't reachable right now. Try again in a minute."
+    intent = await classify_music_request(user_input)
     print(f"[handle_music] Classified intent: {intent}")
 
-    if not get_spotify_access_token():
+    if not await get_spotify_access_token(user_id):
         print("[handle_music] Spotify authentication failed.")
         return "⚠️ Spotify authentication failed."
 
@@ -210,45 +363,43 @@ def handle_music(user_input: str, user_id: str = None) -> str:
     # Album
     if search_type == "album":
         print(f"[handle_music] Handling album request for: {search_query}")
-        _, album_uri = find_spotify_uri(search_query, "album")
+        _, album_uri = await find_spotify_uri(search_query, "album", user_id=user_id)
         if not album_uri:
             return f"❌ Could not find album: {search_query}"
         album_id = album_uri.split(":")[-1]
-        tracks = get_album_tracks(album_id)
+        tracks = await get_album_tracks(album_id, user_id=user_id)
         if not tracks:
             return f"❌ No tracks found in album: {search_query}"
-        queued_count = 0
-        for track in tracks:
-            if queue_spotify_track(track["uri"]):
-                queued_count += 1
+        queued_count = await queue_spotify_tracks(
+            [track["uri"] for track in tracks], _bulk_progress(progress, f"album {search_query}"), user_id
+        )
         if queued_count > 0:
-            return f"🎧 Added album: {search_query}"
+            return f"🎧 Added album: {search_query} ({queued_count}/{len(tracks)} tracks)"
         else:
             return "❌ Could not queue album. Please make sure Spotify is open and active."
 
     # Artist
     elif search_type == "artist":
         print(f"[handle_music] Handling artist request for: {search_query}")
-        _, artist_uri = find_spotify_uri(search_query, "artist")
+        _, artist_uri = await find_spotify_uri(search_query, "artist", user_id=user_id)
         if not artist_uri:
             return f"❌ Could not find artist: {search_query}"
         artist_id = artist_uri.split(":")[-1]
-        tracks = get_artist_top_tracks(artist_id)
+        tracks = await get_artist_top_tracks(artist_id, user_id=user_id)
         if not tracks:
             return f"❌ No tracks found for artist: {search_query}"
-        queued_count = 0
-        for track in tracks:
-            if queue_spotify_track(track["uri"]):
-                queued_count += 1
+        queued_count = await queue_spotify_tracks(
+            [track["uri"] for track in tracks], _bulk_progress(progress, f"top tracks by {search_query}"), user_id
+        )
         if queued_count > 0:
-            return f"🎧 Added top tracks by: {search_query}"
+            return f"🎧 Added top tracks by: {search_query} ({queued_count}/{len(tracks)} tracks)"
         else:
             return "❌ Could not queue artist tracks. Please make sure Spotify is open and active."
 
     # Playlist
     elif search_type == "playlist":
         print(f"[handle_music] Handling playlist request for: {search_query}")
-        link, uri = find_spotify_uri(search_query, "playlist")
+        link, uri = await find_spotify_uri(search_query, "playlist", user_id=user_id)
         if not uri:
             return f"❌ Could not find playlist: {search_query}"
         # Spotify API does not allow queueing an entire playlist directly.
@@ -257,10 +408,10 @@ def handle_music(user_input: str, user_id: str = None) -> str:
     # Track (default)
     else:
         print(f"[handle_music] Handling track request for: {search_query}")
-        link, uri = find_spotify_uri(search_query, "track")
+        link, uri = await find_spotify_uri(search_query, "track", user_id=user_id)
         if not uri:
             return f"❌ Could not find track: {search_query}"
-        if queue_spotify_track(uri):
+        if await queue_spotify_track(uri, user_id):
             return f"🎧 Now playing: {search_query}"
         else:
             return "❌ Could not queue track. Please make sure Spotify is open and active."
@@ -270,7 +421,7 @@ def handle_music(user_input: str, user_id: str = None) -> str:
         set_user_context(user_id, {"music_last_type": search_type, "music_last_value": search_query})
 
     if user_input.strip().lower() == "more" and user_id:
-        context = get_user_context(user_id)
+        context = await get_user_context_async(user_id)
         if context and "music_last_type" in context and "music_last_value" in context:
             # Use the last context to play more from the artist/album/etc.
             search_type = context["music_last_type"]
@@ -0,0 +1,247 @@
+# spotify_auth.py
+import os
+import time
+import hashlib
+import asyncio
+import logging
+import sqlite3
+
+import http_client
+import metrics
+from memory import DB_NAME as LEGACY_DB
+
+SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
+SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
+SPOTIFY_REFRESH_TOKEN = os.getenv("SPOTIFY_REFRESH_TOKEN")
+SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
+# Linked accounts' refresh tokens are credentials: kept apart from memory.db,
+# in a gitignored file only the bot's user can read
+SPOTIFY_ACCOUNTS_DB = os.getenv("SPOTIFY_ACCOUNTS_DB", "spotify_accounts.db")
+metrics.name_upstream(SPOTIFY_TOKEN_URL, "spotify_auth")
+
+# Refresh this many seconds before the access token expires
+SPOTIFY_REFRESH_AHEAD = float(os.getenv("SPOTIFY_REFRESH_AHEAD", "300"))
+# Back-off between failed background refreshes
+SPOTIFY_REFRESH_RETRY = float(os.getenv("SPOTIFY_REFRESH_RETRY", "30"))
+# Linked accounts are refreshed in the background only while used this recently;
+# idle ones refresh on their next command
+SPOTIFY_ACTIVE_WINDOW = float(os.getenv("SPOTIFY_ACTIVE_WINDOW", "1800"))
+
+GLOBAL_ACCOUNT = ""  # account key for the bot-wide SPOTIFY_REFRESH_TOKEN
+# Row under which a rotated global refresh token is saved; keyed by the configured
+# token, so setting a new SPOTIFY_REFRESH_TOKEN takes precedence over the saved one
+GLOBAL_ROW = "global:" + hashlib.sha256(SPOTIFY_REFRESH_TOKEN.encode()).hexdigest()[:16] if SPOTIFY_REFRESH_TOKEN else None
+
+
+class SpotifyTokenManager:
+    """Access tokens for the global account and any linked per-user accounts.
+
+    Tokens of the global account, and of linked accounts used within
+    SPOTIFY_ACTIVE_WINDOW, are refreshed in the background
+    SPOTIFY_REFRESH_AHEAD seconds before they expire, so callers normally get
+    a cached token without awaiting the token endpoint. When a refresh is
+    needed on demand, concurrent callers share a single request.
+    """
+
+    def __init__(self):
+        self._tokens = {}      # account -> (access_token, expires_at)
+        self._refresh = {}     # account -> refresh token
+        self._inflight = {}    # account -> refresh task
+        self._timers = {}      # account -> scheduled background refresh
+        self._last_used = {}   # account -> monotonic time of the last get_token
+        self._loading = None   # task reading linked accounts, once
+        self._loaded = False
+        if SPOTIFY_REFRESH_TOKEN:
+            self._refresh[GLOBAL_ACCOUNT] = SPOTIFY_REFRESH_TOKEN
+
+    # ---- linked accounts ----
+
+    async def _load_accounts(self):
+        if self._loaded:
+            return
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(asyncio.to_thread(_read_accounts))
+        try:
+            accounts = await asyncio.shield(self._loading)
+        except Exception as e:
+            logging.error(f"[spotify] Failed to load linked accounts: {e}")
+            self._loading = None  # try again on the next call
+            return
+        if self._loaded:
+            return
+        self._loaded = True
+        for user_id, refresh_token in accounts.items():
+            if user_id == GLOBAL_ROW:
+                self._refresh[GLOBAL_ACCOUNT] = refresh_token
+            elif not user_id.startswith("global:"):
+                self._refresh.setdefault(user_id, refresh_token)
+
+    async def link_account(self, user_id: str, refresh_token: str):
+        """Store a user's own refresh token; their playback commands then use their account."""
+        await self._load_accounts()
+        await asyncio.to_thread(_write_account, user_id, refresh_token)
+        self._refresh[user_id] = refresh_token
+        self._tokens.pop(user_id, None)
+
+    async def account_for(self, user_id: str = None) -> str:
+        await self._load_accounts()
+        if user_id and user_id in self._refresh:
+            return user_id
+        return GLOBAL_ACCOUNT
+
+    def _active(self, account: str) -> bool:
+        if account == GLOBAL_ACCOUNT:
+            return True
+        return time.monotonic() - self._last_used.get(account, float("-inf")) < SPOTIFY_ACTIVE_WINDOW
+
+    # ---- tokens ----
+
+    async def get_token(self, user_id: str = None):
+        account = await self.account_for(user_id)
+        self._last_used[account] = time.monotonic()
+        cached = self._tokens.get(account)
+        if cached and time.time() < cached[1]:
+            return cached[0]
+        try:
+            return await self._refresh_once(account)
+        except Exception as e:
+            logging.error(f"[spotify] Failed to refresh token: {e}")
+            return None
+
+    def _refresh_once(self, account: str) -> asyncio.Task:
+        task = self._inflight.get(account)
+        if task is None:
+            task = asyncio.ensure_future(self._do_refresh(account))
+            self._inflight[account] = task
+            task.add_done_callback(lambda t: self._inflight.pop(account, None))
+        return asyncio.shield(task)
+
+    async def _do_refresh(self, account: str) -> str:
+        refresh_token = self._refresh.get(account)
+        if not refresh_token:
+            raise RuntimeError("no Spotify refresh token configured")
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token
+        }
+        auth = (SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
+        response = await http_client.post(SPOTIFY_TOKEN_URL, data=data, auth=auth, timeout=10)
+        response.raise_for_status()
+        resp_json = response.json()
+        token = resp_json.get("access_token")
+        expires_in = resp_json.get("expires_in", 3600)
+        # 1 min buffer so a token is never used right at its expiry
+        self._tokens[account] = (token, time.time() + expires_in - 60)
+        # Spotify may rotate the refresh token
+        rotated = resp_json.get("refresh_token")
+        if rotated and rotated != refresh_token:
+            self._refresh[account] = rotated
+            await self._save_rotated(account, rotated)
+        if self._active(account):
+            self._schedule(account, max(expires_in - SPOTIFY_REFRESH_AHEAD, 1))
+        return token
+
+    async def _save_rotated(self, account: str, refresh_token: str):
+        # Saved so a restart doesn't reuse the revoked token; the access token just fetched stays cached
+        try:
+            await asyncio.to_thread(_write_account, GLOBAL_ROW if account == GLOBAL_ACCOUNT else account,
+                                    refresh_token)
+        except Exception as e:
+            logging.error(f"[spotify] Failed to save rotated refresh token: {e}")
+            return
+        if account == GLOBAL_ACCOUNT:
+            logging.warning(f"[spotify] Spotify rotated the global refresh token; saved it to {SPOTIFY_ACCOUNTS_DB}, "
+                            f"update SPOTIFY_REFRESH_TOKEN when convenient")
+
+    # ---- background refresh ----
+
+    def _schedule(self, account: str, delay: float):
+        timer = self._timers.get(account)
+        if timer is not None and not timer.done() and timer is not asyncio.current_task():
+            timer.cancel()
+        self._timers[account] = asyncio.ensure_future(self._refresh_later(account, delay))
+
+    async def _refresh_later(self, account: str, delay: float):
+        await asyncio.sleep(delay)
+        if not self._active(account):
+            # Idle linked account: its next command refreshes on demand
+            self._timers.pop(account, None)
+            return
+        try:
+            await self._refresh_once(account)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"[spotify] Background token refresh failed, retrying in {SPOTIFY_REFRESH_RETRY}s: {e}")
+            self._schedule(account, SPOTIFY_REFRESH_RETRY)
+
+    async def start(self):
+        """Fetch the global token in the background so the first command doesn't wait."""
+        if GLOBAL_ACCOUNT in self._refresh:
+            self._schedule(GLOBAL_ACCOUNT, 0)
+
+    async def stop(self):
+        for task in list(self._timers.values()) + list(self._inflight.values()):
+            task.cancel()
+        self._timers.clear()
+
+
+def _create_accounts_table(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS spotify_accounts (
+            user_id TEXT PRIMARY KEY,
+            refresh_token TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _connect_accounts() -> sqlite3.Connection:
+    # Create the file owner-only before SQLite opens it
+    os.close(os.open(SPOTIFY_ACCOUNTS_DB, os.O_CREAT | os.O_RDWR, 0o600))
+    conn = sqlite3.connect(SPOTIFY_ACCOUNTS_DB)
+    _create_accounts_table(conn)
+    return conn
+
+
+def _migrate_legacy(conn: sqlite3.Connection):
+    """Move tokens stored in memory.db by earlier versions into the accounts file."""
+    if not os.path.exists(LEGACY_DB):
+        return
+    with sqlite3.connect(LEGACY_DB) as legacy:
+        found = legacy.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'spotify_accounts'"
+        ).fetchone()
+        if not found:
+            return
+        rows = legacy.execute("SELECT user_id, refresh_token FROM spotify_accounts").fetchall()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO spotify_accounts (user_id, refresh_token) VALUES (?, ?)", rows
+            )
+        legacy.execute("DROP TABLE IF EXISTS spotify_accounts")
+    logging.warning(f"[spotify] Moved {len(rows)} linked accounts from {LEGACY_DB} to {SPOTIFY_ACCOUNTS_DB}")
+
+
+def _read_accounts() -> dict:
+    conn = _connect_accounts()
+    try:
+        _migrate_legacy(conn)
+        return dict(conn.execute("SELECT user_id, refresh_token FROM spotify_accounts"))
+    finally:
+        conn.close()
+
+
+def _write_account(user_id: str, refresh_token: str):
+    conn = _connect_accounts()
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO spotify_accounts (user_id, refresh_token) VALUES (?, ?)",
+                (user_id, refresh_token)
+            )
+    finally:
+        conn.close()
+
+
+spotify_tokens = SpotifyTokenManager()
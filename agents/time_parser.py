@@ -0,0 +1,243 @@
+# time_parser.py
+import re
+import datetime
+from collections import Counter
+
+# Defaults for vague times of day (README: "morning", "evening", ...)
+PART_OF_DAY = {
+    "morning": (9, 0),
+    "noon": (12, 0),
+    "afternoon": (14, 0),
+    "evening": (18, 0),
+    "tonight": (20, 0),
+    "night": (20, 0),
+    "midnight": (0, 0),
+}
+DEFAULT_TIME = (9, 0)  # date given without a time
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+MONTHS = ["january", "february", "march", "april", "may", "june", "july",
+          "august", "september", "october", "november", "december"]
+_MONTH_RE = "|".join(m[:3] + r"[a-z]*\.?" for m in MONTHS)
+
+# Words that mean the text carries time information we don't understand;
+# if any survive after parsing, the LLM gets the input instead.
+_UNHANDLED = re.compile(
+    r"\b(quarter|half past|o'?clock|every|daily|weekly|monthly|weekend|next (week|month|year)|"
+    r"later|soon|before|(?<!day )after|until|till|ago)\b"
+    r"|(?<![\d-])\d{1,2}(:\d{2})?\s*(am|pm)?\s*(-|to)\s*\d{1,2}(?![\d-])",  # ranges like "10-11am"
+    re.IGNORECASE,
+)
+
+_LEAD_IN = re.compile(
+    r"^(please\s+)?(can you\s+)?(set\s+(a\s+|an\s+)?)?(remind(er)?\s+(me\s+)?(to|about|that)?\s*|"
+    r"don'?t let me forget\s+(to\s+)?|create\s+(a\s+)?reminder\s+(to|for)?\s*)",
+    re.IGNORECASE,
+)
+
+_RELATIVE = re.compile(
+    r"\bin\s+(?P<n>\d+|an?|one|two|three|four|five|ten|fifteen|twenty|thirty|half an?)\s*"
+    r"(?P<unit>min(ute)?s?|hours?|hrs?|days?|weeks?)\b",
+    re.IGNORECASE,
+)
+_WORD_NUMBERS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "ten": 10,
+                 "fifteen": 15, "twenty": 20, "thirty": 30}
+
+_ISO_DATE = re.compile(r"\b(on\s+)?(?P<y>\d{4})-(?P<m>\d{1,2})-(?P<d>\d{1,2})\b")
+_MONTH_DAY = re.compile(
+    rf"\b(on\s+)?(the\s+)?(?:(?P<d1>\d{{1,2}})(?:st|nd|rd|th)?\s+(?:of\s+)?(?P<m1>{_MONTH_RE})|"
+    rf"(?P<m2>{_MONTH_RE})\s+(?P<d2>\d{{1,2}})(?:st|nd|rd|th)?)\b",
+    re.IGNORECASE,
+)
+_RELATIVE_DAY = re.compile(r"\b(the\s+)?(day after tomorrow|tomorrow|today|tonight)\b", re.IGNORECASE)
+_WEEKDAY = re.compile(rf"\b(on\s+)?(?P<which>next|this|coming)?\s*(?P<day>{'|'.join(WEEKDAYS)})\b", re.IGNORECASE)
+_CLOCK = re.compile(
+    r"\b(at\s+|by\s+|@\s*)?(?P<h>\d{1,2})(?::(?P<min>\d{2}))?\s*(?P<ampm>a\.?m\.?|p\.?m\.?)(?=\W|$)"
+    r"|\b(at|by|@)\s*(?P<h24>\d{1,2}):(?P<min24>\d{2})\b"
+    r"|\b(?P<h24b>\d{1,2}):(?P<min24b>\d{2})\b"
+    r"|\b(at|by|@)\s*(?P<hbare>\d{1,2})\b(?!\s*(min|hour|day|week|%|st|nd|rd|th))",
+    re.IGNORECASE,
+)
+_PART = re.compile(r"\b(in\s+the\s+|this\s+|at\s+)?(?P<part>morning|noon|afternoon|evening|night|midnight)\b",
+                   re.IGNORECASE)
+
+parse_stats = Counter()  # "parsed" / "declined"
+
+
+def parse_rate() -> float:
+    total = parse_stats["parsed"] + parse_stats["declined"]
+    return parse_stats["parsed"] / total if total else 0.0
+
+
+def _cut(text: str, match) -> str:
+    return text[:match.start()] + " " + text[match.end():]
+
+
+# A part of day that makes "at 7" mean 7pm; "morning" keeps it am
+_PM_PARTS = ("afternoon", "evening", "night", "tonight")
+_AM_PARTS = ("morning",)
+
+# "check in 5 minutes" may be "check in, in 5 minutes": leave those to the LLM
+_PHRASAL_IN = re.compile(r"\b(check|log|sign|clock|drop|hand|turn|fill|plug|move|pop|tune|cash|settle|call)\s*$",
+                         re.IGNORECASE)
+
+
+def _bare_hour(hour: int, part: str):
+    """"at 7" as a 24-hour clock hour, or None when only a part of day could tell am from pm."""
+    if hour >= 13:
+        return hour
+    if part in _PM_PARTS and 1 <= hour <= 11:
+        return hour + 12
+    if part in _AM_PARTS and 1 <= hour <= 11:
+        return hour
+    return None
+
+
+def parse_reminder(text: str, now: datetime.datetime = None):
+    """Parse "call mom at 10am tomorrow" into {"summary", "start"} without the LLM.
+
+    Returns None when the text has no time information we can read with
+    confidence; callers then fall back to LLM extraction.
+    """
+    result = _parse(text, now or datetime.datetime.now())
+    parse_stats["parsed" if result else "declined"] += 1
+    return result
+
+
+def _parse(text: str, now: datetime.datetime):
+    if _UNHANDLED.search(text):
+        return None
+    rest = " " + text.strip() + " "
+    date = None
+    clock = None
+    part = None   # part-of-day word seen so far ("tonight", "morning"...)
+    found = False
+
+    m = _RELATIVE.search(rest)
+    if m:
+        raw = m.group("n").lower()
+        unit = m.group("unit").lower()
+        if raw.startswith("half"):
+            amount, unit = 30, "min"
+        else:
+            amount = int(raw) if raw.isdigit() else _WORD_NUMBERS[raw]
+        if unit.startswith("min"):
+            delta = datetime.timedelta(minutes=amount)
+        elif unit.startswith("h"):
+            delta = datetime.timedelta(hours=amount)
+        elif unit.startswith("d"):
+            delta = datetime.timedelta(days=amount)
+        else:
+            delta = datetime.timedelta(weeks=amount)
+        if _PHRASAL_IN.search(rest[:m.start()]):
+            return None
+        rest = _cut(rest, m)
+        start = now + delta
+        if delta < datetime.timedelta(days=1):
+            return _finish(rest, start.replace(second=0, microsecond=0))
+        date = start.date()
+        found = True
+
+    m = _ISO_DATE.search(rest)
+    if m and date is None:
+        try:
+            date = datetime.date(int(m.group("y")), int(m.group("m")), int(m.group("d")))
+        except ValueError:
+            return None
+        rest = _cut(rest, m)
+        found = True
+
+    m = _MONTH_DAY.search(rest)
+    if m and date is None:
+        month_name = (m.group("m1") or m.group("m2")).lower()[:3]
+        month = [name[:3] for name in MONTHS].index(month_name) + 1
+        day = int(m.group("d1") or m.group("d2"))
+        try:
+            date = datetime.date(now.year, month, day)
+            if date < now.date():
+                date = date.replace(year=now.year + 1)
+        except ValueError:
+            return None
+        rest = _cut(rest, m)
+        found = True
+
+    m = _RELATIVE_DAY.search(rest)
+    if m and date is None:
+        word = m.group(2).lower()
+        offset = {"today": 0, "tonight": 0, "tomorrow": 1, "day after tomorrow": 2}[word]
+        date = now.date() + datetime.timedelta(days=offset)
+        if word == "tonight":
+            part = word
+        rest = _cut(rest, m)
+        found = True
+
+    m = _WEEKDAY.search(rest)
+    if m and date is None:
+        target = WEEKDAYS.index(m.group("day").lower())
+        ahead = (target - now.weekday()) % 7
+        # "friday" said on a Friday means next week; "this friday" means today
+        if ahead == 0 and (m.group("which") or "").lower() != "this":
+            ahead = 7
+        date = now.date() + datetime.timedelta(days=ahead)
+        rest = _cut(rest, m)
+        found = True
+
+    m = _PART.search(rest)
+    if m:
+        part = m.group("part").lower()
+        rest = _cut(rest, m)
+        found = True
+
+    m = _CLOCK.search(rest)
+    if m:
+        if m.group("h") is not None:
+            hour, minute = int(m.group("h")), int(m.group("min") or 0)
+            if hour > 12:
+                return None
+            pm = m.group("ampm").lower().startswith("p")
+            hour = hour % 12 + (12 if pm else 0)
+        elif m.group("h24") is not None or m.group("h24b") is not None:
+            hour = int(m.group("h24") or m.group("h24b"))
+            minute = int(m.group("min24") or m.group("min24b"))
+            if part in _PM_PARTS and hour < 12:
+                hour += 12  # "at 7:30 in the evening"
+        else:
+            hour, minute = _bare_hour(int(m.group("hbare")), part), 0
+            if hour is None:
+                return None
+        if hour > 23 or minute > 59:
+            return None
+        clock = (hour, minute)
+        rest = _cut(rest, m)
+        found = True
+
+    if clock is None and part is not None:
+        clock = PART_OF_DAY[part]
+
+    if not found:
+        return None
+
+    if date is None:
+        # Time only: the next time the clock reads that
+        date = now.date()
+        if clock is not None and (clock[0], clock[1]) <= (now.hour, now.minute):
+            date += datetime.timedelta(days=1)
+    if clock is None:
+        clock = DEFAULT_TIME
+    start = datetime.datetime.combine(date, datetime.time(clock[0], clock[1]))
+    if start < now - datetime.timedelta(minutes=1):
+        return None
+    return _finish(rest, start)
+
+
+def _finish(rest: str, start: datetime.datetime):
+    summary = re.sub(r"\s+", " ", rest).strip()
+    summary = _LEAD_IN.sub("", summary)
+    # Connectors left dangling once the time phrases are gone
+    summary = re.sub(r"^(to|at|on|by|for|about)\s+|\s+(at|on|by|for|in|the)$", "", summary, flags=re.IGNORECASE)
+    summary = re.sub(r"\s+(at|on|by)\s+(?=(at|on|by)\b)", " ", summary, flags=re.IGNORECASE)
+    summary = summary.strip(" ,.;:-!")
+    if not summary or re.search(r"\b\d{1,2}\b", summary):
+        # Leftover numbers usually mean a time we failed to read
+        return None
+    return {"summary": summary[0].upper() + summary[1:], "start": start}
@@ -1,28 +1,155 @@
 import os
+import re
+import time
+import asyncio
+from dotenv import load_dotenv
+
+# Before any other import: modules read their settings from the environment when imported
+load_dotenv()
+_import_started = time.perf_counter()
+
 import discord
 from discord.ext import commands
-from dotenv import load_dotenv
 
-from memory import append_user_message, get_user_context
-from agents.news_agent import handle_news
-from agents.spotify_agent import handle_music, pause_music, resume_music, next_song
-from agents.reminder_agent import create_reminder  
-from agents.qa_agent import handle_qa_agent
+import http_client
+import llm
+import metrics
+import resilience
+import sharding
+from admission import admission, Busy
+from cache import close_disk_store
+from ratelimit import close_bucket_store
+from memory import (append_user_message, get_user_context, close_memory, search_user_memory, clear_user_memory_async,
+                    init_db)
+from memory_maintenance import maintenance
+# Eager: its memory listener has to see every append from the first one
+from semantic_memory import semantic_index, close_semantic_index, SEMANTIC_MEMORY
+from agents import registry
+from agents.spotify_auth import spotify_tokens
+from agents.reminder_scheduler import reminders
+from discord_stream import StreamingReply
 
-load_dotenv()
+# Agents are imported on first use, or by the warm-up after on_ready
+news_agent = registry.register("agents.news_agent")
+spotify_agent = registry.register("agents.spotify_agent")
+reminder_agent = registry.register("agents.reminder_agent")
+qa_agent = registry.register("agents.qa_agent")
+# Only needed once a reminder is mirrored to Google Calendar
+calendar_client = registry.register("agents.calendar_client", warm=False)
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+# Matches shown per !history page
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "5"))
+
+# Stream !ask replies into a progressively edited message (set to 0 to disable)
+ASK_STREAMING = os.getenv("ASK_STREAMING", "1") != "0"
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Under sharding.py each process runs its slice of gateway shards
+_BotBase = commands.AutoShardedBot if sharding.SHARDED else commands.Bot
+
+class AssistantBot(_BotBase):
+    async def setup_hook(self):
+        await asyncio.to_thread(init_db)
+        # Warm the Spotify token so the first !play doesn't wait on the token endpoint
+        await spotify_tokens.start()
+        # Singleton work runs in one process; the others only store reminders
+        if sharding.is_leader():
+            await reminders.start(deliver_reminder)
+            # Retention, summaries and vacuuming run in the background
+            maintenance.start()
+        # Prometheus text endpoint (METRICS_PORT=0 disables it)
+        await metrics.metrics_server.start()
+        # Background probes, so a recovered upstream is used again without waiting on a user
+        resilience.health.start()
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        name = ctx.command.qualified_name
+        guild_id = str(ctx.guild.id) if ctx.guild is not None else None
+        agent = ctx.command.extras.get("agent")
+        try:
+            # Rate limits and per-class lanes; playback controls get their own fast lane
+            async with admission.slot(name, str(ctx.author.id), guild_id):
+                with metrics.track_command(name):
+                    if agent is not None:
+                        # First use before the warm-up got to it: import off the loop
+                        await agent.load_async()
+                    await super().invoke(ctx)
+        except Busy as busy:
+            print(f"⏳ Shed !{name} from {ctx.author}: {busy.reason}")
+            await ctx.send(busy.reply)
+            return
+        # Command errors are handled inside invoke, so they never reach track_command
+        if ctx.command_failed:
+            metrics.command_errors.inc(command=name)
+
+    async def close(self):
+        await super().close()
+        await spotify_tokens.stop()
+        await reminders.stop()
+        await maintenance.stop()
+        await metrics.metrics_server.stop()
+        await resilience.health.stop()
+        if calendar_client.loaded:
+            await calendar_client.calendar.close()
+        # Embeds still in flight would otherwise lose their connection below
+        await semantic_index.stop()
+        # Release the pooled upstream connections once the gateway is down
+        await http_client.close_sessions()
+        # Commit any write-behind memory rows and unsaved vectors still queued
+        close_semantic_index()
+        close_memory()
+        close_disk_store()
+        close_bucket_store()
+
+bot = AssistantBot(command_prefix="!", intents=intents, **sharding.bot_options())
+
+async def deliver_reminder(reminder: dict) -> bool:
+    """Post a due reminder in the channel it was set in, or by DM."""
+    text = f"⏰ <@{reminder['user_id']}> Reminder: **{reminder['summary']}**"
+    try:
+        if reminder["channel_id"]:
+            channel_id = int(reminder["channel_id"])
+            target = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+        else:
+            user_id = int(reminder["user_id"])
+            target = bot.get_user(user_id) or await bot.fetch_user(user_id)
+        await target.send(text)
+        return True
+    except (discord.HTTPException, TypeError, ValueError) as e:
+        print(f"[deliver_reminder] Error: {e}")
+        return False
+
+_warm_up_task = None
+
+async def warm_up():
+    started = time.perf_counter()
+    await registry.warm_up()
+    print(f"🔥 Agents loaded in {(time.perf_counter() - started) * 1000:.0f} ms "
+          f"(app imports took {IMPORT_SECONDS * 1000:.0f} ms):\n{registry.report()}")
+    if llm.OLLAMA_WARM_UP:
+        # Load the routed models now rather than on the first command
+        timings = await llm.warm_up(embed_model=llm.OLLAMA_EMBED_MODEL if SEMANTIC_MEMORY else None)
+        if timings:
+            print("🔥 Models loaded: " + ", ".join(f"{model} {seconds:.1f}s" for model, seconds in timings.items()))
 
 @bot.event
 async def on_ready():
-    print(f"✅ Bot is online as {bot.user}")
+    global _warm_up_task
+    # on_ready fires again after reconnects; warm up only once
+    if _warm_up_task is None:
+        _warm_up_task = asyncio.ensure_future(warm_up())
+    shards = f" (shards {bot.shard_ids} of {bot.shard_count})" if sharding.SHARDED else ""
+    print(f"✅ Bot is online as {bot.user}{shards}")
 
 
 
-@bot.command(name="news")
+@bot.command(name="news", extras={"agent": news_agent})
 async def news_command(ctx, *, query: str):
     user_id = str(ctx.author.id)
     print(f"📨 News command from {ctx.author}: {query}")
@@ -30,7 +157,7 @@ async def news_command(ctx, *, query: str):
     append_user_message(user_id, "user", query)
 
     try:
-        response = handle_news(query)
+        response = await news_agent.handle_news(query)
     except Exception as e:
         print(f"[news_command] Error: {e}")
         response = "⚠️ Could not fetch news right now."
@@ -38,23 +165,35 @@ async def news_command(ctx, *, query: str):
     append_user_message(user_id, "assistant", response)
     await ctx.send(response)
 
-@bot.command(name="play")
+@bot.command(name="play", extras={"agent": spotify_agent})
 async def play_command(ctx, *, query: str):
     user_id = str(ctx.author.id)
     print(f"🎵 Music command from {ctx.author}: {query}")
 
     append_user_message(user_id, "user", query)
 
+    status = None
+
+    async def progress(text):
+        nonlocal status
+        if status is None:
+            status = await ctx.send(text)
+        else:
+            await status.edit(content=text)
+
     try:
-        response = handle_music(query, user_id)
+        response = await spotify_agent.handle_music(query, user_id, progress=progress)
     except Exception as e:
         print(f"[play_command] Error: {e}")
         response = "⚠️ Could not process music request."
 
     append_user_message(user_id, "assistant", response)
-    await ctx.send(response)
+    if status is not None:
+        await status.edit(content=response)
+    else:
+        await ctx.send(response)
 
-@bot.command(name="remind")
+@bot.command(name="remind", extras={"agent": reminder_agent})
 async def remind_command(ctx, *, query: str):
     user_id = str(ctx.author.id)
     print(f"⏰ Remind command from {ctx.author}: {query}")
@@ -62,7 +201,9 @@ async def remind_command(ctx, *, query: str):
     append_user_message(user_id, "user", query)
 
     try:
-        response = create_reminder(query)
+        # Reminders set in a server fire there; reminders set in DMs come back by DM
+        channel_id = str(ctx.channel.id) if ctx.guild is not None else None
+        response = await reminder_agent.create_reminder(query, user_id, channel_id)
     except Exception as e:
         print(f"[remind_command] Error: {e}")
         response = "⚠️ Could not set reminder right now."
@@ -70,15 +211,43 @@ async def remind_command(ctx, *, query: str):
     append_user_message(user_id, "assistant", response)
     await ctx.send(response)
 
-@bot.command(name="ask")
+@bot.command(name="timezone")
+async def timezone_command(ctx, name: str = None):
+    user_id = str(ctx.author.id)
+    if name is None:
+        current = await reminders.get_timezone(user_id)
+        await ctx.send(f"🕒 Your reminders use {current}. Change it with `!timezone <Area/City>`.")
+        return
+    if await reminders.set_timezone(user_id, name):
+        response = f"✅ Reminders will now use {name}."
+    else:
+        response = "⚠️ Unknown time zone. Use a name like `Europe/London` or `America/New_York`."
+    await ctx.send(response)
+
+@bot.command(name="ask", extras={"agent": qa_agent})
 async def ask_command(ctx, *, query: str):
     user_id = str(ctx.author.id)
     print(f"💬 Ask command from {ctx.author}: {query}")
 
     append_user_message(user_id, "user", query)
+    # Used if this turns out to be a reminder, as with !remind
+    channel_id = str(ctx.channel.id) if ctx.guild is not None else None
+
+    if ASK_STREAMING:
+        reply = StreamingReply(ctx)
+        await reply.start()
+        try:
+            async for text in qa_agent.stream_qa_agent(query, user_id, channel_id):
+                await reply.feed(text)
+        except Exception as e:
+            print(f"[ask_command] Error: {e}")
+            await reply.feed("⚠️ Sorry, I couldn’t answer that right now.")
+        response = await reply.finish()
+        append_user_message(user_id, "assistant", response)
+        return
 
     try:
-        response = handle_qa_agent(query, user_id)
+        response = await qa_agent.handle_qa_agent(query, user_id, channel_id)
     except Exception as e:
         print(f"[ask_command] Error: {e}")
         response = "⚠️ Sorry, I couldn’t answer that right now."
@@ -86,30 +255,107 @@ async def ask_command(ctx, *, query: str):
     append_user_message(user_id, "assistant", response)
     await ctx.send(response)
 
-@bot.command(name="next")
+@bot.command(name="history")
+async def history_command(ctx, *, query: str):
+    user_id = str(ctx.author.id)
+    print(f"🔎 History command from {ctx.author}: {query}")
+
+    # "!history rex --page 2" asks for the second page
+    page = 1
+    match = re.search(r"\s--page\s+(\d+)\s*$", query)
+    if match:
+        page = max(int(match.group(1)), 1)
+        query = query[:match.start()]
+
+    try:
+        total, rows = await asyncio.to_thread(search_user_memory, user_id, query, page, HISTORY_PAGE_SIZE)
+    except Exception as e:
+        print(f"[history_command] Error: {e}")
+        await ctx.send("⚠️ Could not search your history right now.")
+        return
+
+    if not rows:
+        await ctx.send("🔎 No matching messages." if page == 1 else "🔎 No more matches.")
+        return
+    pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+    lines = [f"🔎 **{total}** matches for “{query.strip()}” (page {page}/{pages}):"]
+    for row in rows:
+        speaker = "You" if row["role"] == "user" else "Bot"
+        lines.append(f"`{row['timestamp'][:16]}` **{speaker}:** {row['message']}")
+    if page < pages:
+        lines.append(f"More: `!history {query.strip()} --page {page + 1}`")
+    await ctx.send("\n".join(lines)[:2000])
+
+@bot.command(name="forget")
+async def forget_command(ctx):
+    user_id = str(ctx.author.id)
+    print(f"🧹 Forget command from {ctx.author}")
+    try:
+        await clear_user_memory_async(user_id)
+        if qa_agent.loaded:
+            qa_agent.chat_sessions.drop(user_id)
+        response = "🧹 I've forgotten our conversation history."
+    except Exception as e:
+        print(f"[forget_command] Error: {e}")
+        response = "⚠️ Could not clear your history right now."
+    await ctx.send(response)
+
+@bot.command(name="next", extras={"agent": spotify_agent})
 async def next_command(ctx):
     user_id = str(ctx.author.id)
     print(f"⏭️ Next command from {ctx.author}")
-    success = next_song()
+    success = await spotify_agent.next_song(user_id)
     response = "⏭️ Skipped to next song." if success else "⚠️ Could not skip to next song."
     await ctx.send(response)
 
-@bot.command(name="pause")
+@bot.command(name="pause", extras={"agent": spotify_agent})
 async def pause_command(ctx):
     user_id = str(ctx.author.id)
     print(f"⏸️ Pause command from {ctx.author}")
-    success = pause_music()
+    success = await spotify_agent.pause_music(user_id)
     response = "⏸️ Paused playback." if success else "⚠️ Could not pause playback."
     await ctx.send(response)
 
-@bot.command(name="resume")
+@bot.command(name="resume", extras={"agent": spotify_agent})
 async def resume_command(ctx):
     user_id = str(ctx.author.id)
     print(f"▶️ Resume command from {ctx.author}")
-    success = resume_music()
+    success = await spotify_agent.resume_music(user_id)
     response = "▶️ Resumed playback." if success else "⚠️ Could not resume playback."
     await ctx.send(response)
 
+@bot.command(name="linkspotify")
+async def linkspotify_command(ctx, refresh_token: str):
+    # Refresh tokens are credentials: only accept them in DMs
+    if ctx.guild is not None:
+        try:
+            await ctx.message.delete()
+        except discord.HTTPException:
+            pass
+        await ctx.send("🔒 Please send `!linkspotify <refresh_token>` to me in a DM.")
+        return
+    await spotify_tokens.link_account(str(ctx.author.id), refresh_token)
+    token = await spotify_tokens.get_token(str(ctx.author.id))
+    response = "✅ Spotify account linked." if token else "⚠️ Saved, but that refresh token didn't work."
+    await ctx.send(response)
+
+@bot.command(name="stats")
+@commands.is_owner()
+async def stats_command(ctx, view: str = None):
+    # "!stats traces" shows the latest sampled command traces instead
+    if view == "traces":
+        traces = list(metrics.recent_traces)
+        if not traces:
+            await ctx.send(f"🧭 No traces yet (sampling {metrics.METRICS_TRACE_SAMPLE:.0%} of commands).")
+            return
+        text = "\n\n".join(traces[-5:])
+        await ctx.send(f"```\n{text[-1900:]}\n```")
+        return
+    text = "\n".join([metrics.summary(), llm.summary(), admission.summary(), resilience.summary()])
+    for start in range(0, len(text), 2000):
+        await ctx.send(text[start:start + 2000])
+
 
-# Start bot
-bot.run(os.getenv("DISCORD_BOT_TOKEN"))
+# Start bot (importing app, e.g. from bench/, only defines the commands)
+if __name__ == "__main__":
+    bot.run(os.getenv("DISCORD_BOT_TOKEN"))
@@ -0,0 +1,96 @@
+# import_profile.py
+"""Startup profile: how long importing the bot takes, per module.
+
+    python -m bench.import_profile              # top 25 modules
+    python -m bench.import_profile --top 50 --all
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter (with
+throwaway databases), then imports the lazily registered agents the way
+the post-on_ready warm-up does. Reports cumulative import time per module,
+so a package's line includes everything it pulled in. Project modules are
+always listed; third-party ones only when they make the top N (or with --all).
+Agents are timed by agents/registry.py, since importlib.import_module()
+imports don't appear in -X importtime.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import time, json, asyncio
+started = time.perf_counter()
+import app
+app_seconds = time.perf_counter() - started
+from agents import registry
+started = time.perf_counter()
+asyncio.run(registry.warm_up())
+print("@@" + json.dumps({"app": app_seconds, "warm_up": time.perf_counter() - started,
+                         "agents": registry.import_times}))
+"""
+
+
+def _project_modules() -> set:
+    names = {name[:-3] for name in os.listdir(ROOT) if name.endswith(".py")}
+    names |= {"agents." + name[:-3] for name in os.listdir(os.path.join(ROOT, "agents")) if name.endswith(".py")}
+    return names
+
+
+def _parse_importtime(stderr: str) -> list:
+    """[(module, self_us, cumulative_us, depth)] from -X importtime output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=25, help="third-party modules to list")
+    parser.add_argument("--all", action="store_true", help="list every top-level import")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bot-import-")
+    env = {
+        **os.environ,
+        "MEMORY_DB": os.path.join(workdir, "memory.db"),
+        "CACHE_DB": os.path.join(workdir, "cache.db"),
+        "REMINDERS_DB": os.path.join(workdir, "reminders.db"),
+    }
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], cwd=ROOT, env=env,
+                            capture_output=True, text=True)
+    summary = next((json.loads(line[2:]) for line in result.stdout.splitlines() if line.startswith("@@")), None)
+    if summary is None:
+        sys.exit(f"probe failed:\n{result.stderr[-2000:]}")
+
+    rows = _parse_importtime(result.stderr)
+    project = _project_modules()
+    # Top-level imports (depth 1) plus every project module, whatever its depth
+    top = [row for row in rows if row[3] == 1 and row[0] not in project]
+    top.sort(key=lambda row: -row[2])
+    if not args.all:
+        top = top[:args.top]
+    ours = [row for row in rows if row[0] in project]
+
+    print(f"import app: {summary['app'] * 1000:.0f} ms; agent warm-up: {summary['warm_up'] * 1000:.0f} ms")
+    print(f"\n  {'project module':<32} {'self ms':>8} {'cumul ms':>9}")
+    for name, self_us, cumulative_us, _ in sorted(ours, key=lambda row: -row[2]):
+        print(f"  {name:<32} {self_us / 1000:>8.1f} {cumulative_us / 1000:>9.1f}")
+    print(f"\n  {'third-party (top level)':<32} {'self ms':>8} {'cumul ms':>9}")
+    for name, self_us, cumulative_us, _ in top:
+        print(f"  {name:<32} {self_us / 1000:>8.1f} {cumulative_us / 1000:>9.1f}")
+    print("\n  lazily loaded agents (warm-up)")
+    for name, seconds in sorted(summary["agents"].items(), key=lambda item: -item[1]):
+        print(f"  {name:<32} {seconds * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
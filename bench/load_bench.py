@@ -0,0 +1,294 @@
+# load_bench.py
+"""Load-test the bot's command handlers offline, against bench/stubs.py.
+
+    python -m bench.load_bench                                   # default mix, concurrency 1,4,16,64
+    python -m bench.load_bench --concurrency 1,8,32 --requests 300 --mix ask=3,play=2,news=1
+    python -m bench.load_bench --latency ollama=400 --rate-429 spotify=0.05 --json results.json
+    python -m bench.load_bench --max-p95 ask=3000,play=1500       # exit 1 if exceeded (CI)
+    python -m bench.load_bench --admission --users 5              # include admission control
+
+Commands are invoked through their discord.py callbacks with a fake
+context whose send/edit calls cost --discord-latency ms. Latency is
+measured from invocation until the handler returns, which is when the
+user has their final reply. Replies starting with ⚠️ count as errors.
+With --admission, commands go through admission control first, as
+AssistantBot.invoke does; rejected commands are counted as shed.
+All databases live in a temporary directory.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextlib
+from collections import defaultdict
+
+from bench.stubs import Stubs, add_arguments, config_from_args
+
+COMMANDS = ("news", "play", "remind", "ask", "next", "pause", "resume")
+QUERIES = {
+    "news": ["AI regulation", "cricket world cup", "stock market today", "climate summit", "space launch"],
+    "play": ["Blinding Lights", "album Random Access Memories", "songs by Arijit Singh",
+             "Bohemian Rhapsody", "playlist lofi beats", "top tracks by Coldplay"],
+    "remind": ["call mom tomorrow at 10am", "pay rent in 2 hours", "standup on friday at 9:30",
+               "dentist on 12th March at 4pm", "water the plants this evening"],
+    "ask": ["what is a black hole?", "explain recursion simply", "give me a pasta recipe",
+            "how do vaccines work?", "write a haiku about rain"],
+}
+
+
+def _percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))] if values else 0.0
+
+
+def _parse_weights(spec: str) -> dict:
+    weights = {}
+    for part in spec.split(","):
+        name, _, value = part.partition("=")
+        if name not in COMMANDS:
+            raise SystemExit(f"unknown command in --mix: {name}")
+        weights[name] = float(value or 1)
+    return weights
+
+
+# ---- fake Discord objects ----
+
+class FakeMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.round_trip()
+        self.content = content
+        self.channel.edits += 1
+        return self
+
+    async def delete(self):
+        await self.channel.round_trip()
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, latency: float):
+        self.id = channel_id
+        self.latency = latency
+        self.sends = 0
+        self.edits = 0
+
+    async def round_trip(self):
+        if self.latency:
+            await asyncio.sleep(self.latency / 1000)
+
+    async def send(self, content=None, **kwargs):
+        await self.round_trip()
+        self.sends += 1
+        return FakeMessage(self, content)
+
+
+class FakeUser:
+    def __init__(self, user_id: int, channel: FakeChannel):
+        self.id = user_id
+        self.name = f"bench{user_id}"
+        self._dm = channel
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content=None, **kwargs):
+        return await self._dm.send(content, **kwargs)
+
+
+class FakeContext:
+    """What the command handlers touch on discord.ext.commands.Context."""
+
+    def __init__(self, user: FakeUser, channel: FakeChannel):
+        self.author = user
+        self.channel = channel
+        self.guild = object()
+        self.message = FakeMessage(channel, "")
+        self.replies = []
+
+    async def send(self, content=None, **kwargs):
+        message = await self.channel.send(content, **kwargs)
+        self.replies.append(message)
+        return message
+
+
+# ---- driver ----
+
+async def _invoke(app, name: str, ctx: FakeContext, query: str, admit: bool = False):
+    if admit:
+        async with app.admission.slot(name, str(ctx.author.id), str(ctx.channel.id)):
+            await _invoke(app, name, ctx, query)
+        return
+    command = getattr(app, f"{name}_command")
+    if name in ("next", "pause", "resume"):
+        await command.callback(ctx)
+    else:
+        await command.callback(ctx, query=query)
+
+
+async def run_level(app, concurrency: int, total: int, weights: dict, channel: FakeChannel,
+                    users: int, rng: random.Random, admit: bool = False) -> dict:
+    names = list(weights)
+    plan = [(rng.choices(names, [weights[n] for n in names])[0], rng.randrange(users)) for _ in range(total)]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    shed = defaultdict(int)
+    queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+
+    async def worker():
+        while not queue.empty():
+            name, user = queue.get_nowait()
+            ctx = FakeContext(FakeUser(100000 + user, channel), channel)
+            query = rng.choice(QUERIES.get(name, [""]))
+            started = time.perf_counter()
+            try:
+                await _invoke(app, name, ctx, query, admit)
+                failed = any((m.content or "").startswith("⚠️") for m in ctx.replies)
+            except app.Busy:
+                shed[name] += 1
+                continue
+            except Exception as e:
+                logging.error(f"[bench] {name} raised: {e}")
+                failed = True
+            latencies[name].append(time.perf_counter() - started)
+            errors[name] += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    result = {"concurrency": concurrency, "requests": total, "seconds": elapsed,
+              "throughput": total / elapsed, "commands": {}}
+    everything = []
+    for name, values in latencies.items():
+        everything += values
+        result["commands"][name] = _summary(values, errors[name], shed[name])
+    for name in shed.keys() - latencies.keys():
+        result["commands"][name] = _summary([], 0, shed[name])
+    result["all"] = _summary(everything, sum(errors.values()), sum(shed.values()))
+    return result
+
+
+def _summary(values: list, errors: int, shed: int = 0) -> dict:
+    return {
+        "count": len(values),
+        "errors": errors,
+        "shed": shed,
+        "p50_ms": _percentile(values, 0.50) * 1000,
+        "p95_ms": _percentile(values, 0.95) * 1000,
+        "p99_ms": _percentile(values, 0.99) * 1000,
+        "max_ms": max(values) * 1000 if values else 0.0,
+    }
+
+
+def _print_level(result: dict):
+    print(f"\nconcurrency {result['concurrency']}: {result['requests']} requests in "
+          f"{result['seconds']:.2f}s = {result['throughput']:.1f} req/s")
+    print(f"  {'command':<8} {'count':>6} {'errors':>6} {'shed':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = sorted(result["commands"].items()) + [("ALL", result["all"])]
+    for name, s in rows:
+        print(f"  {name:<8} {s['count']:>6} {s['errors']:>6} {s['shed']:>6} {s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} "
+              f"{s['p99_ms']:>9.1f} {s['max_ms']:>9.1f}")
+
+
+async def _main(args) -> int:
+    stubs = Stubs(config_from_args(args))
+    await stubs.start()
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update(stubs.env())
+    os.environ.update({
+        "MEMORY_DB": os.path.join(workdir, "memory.db"),
+        "CACHE_DB": os.path.join(workdir, "cache.db"),
+        "REMINDERS_DB": os.path.join(workdir, "reminders.db"),
+        "REMINDER_SYNC_INTERVAL": "1",
+    })
+    for pair in args.env:
+        key, _, value = pair.partition("=")
+        os.environ[key] = value
+
+    # Agents print per-request traces; keep the report readable
+    logging.basicConfig(level=logging.ERROR if not args.verbose else logging.INFO)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+
+    import app  # after the environment points at the stubs
+
+    channel = FakeChannel(1, args.discord_latency)
+    await app.reminders.start(lambda reminder: channel.send(reminder["summary"]))
+    rng = random.Random(args.seed)
+    weights = _parse_weights(args.mix)
+    results = []
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            with quiet:
+                result = await run_level(app, concurrency, args.requests, weights, channel, args.users, rng,
+                                         args.admission)
+            results.append(result)
+            _print_level(result)
+    finally:
+        with quiet:
+            await app.reminders.stop()
+            if app.calendar_client.loaded:
+                await app.calendar_client.calendar.close()
+            await app.semantic_index.stop()
+            await app.http_client.close_sessions()
+            app.close_semantic_index()
+            app.close_memory()
+            app.close_disk_store()
+        await stubs.stop()
+
+    upstream = defaultdict(dict)
+    for (name, status), count in sorted(stubs.requests.items()):
+        upstream[name][status] = count
+    print("\nupstream requests: " + ", ".join(f"{name} {dict(codes)}" for name, codes in upstream.items()))
+    print(f"discord: {channel.sends} sends, {channel.edits} edits")
+    models = app.llm.get_stats()["models"]
+    if models:
+        print("ollama calls per model: " + ", ".join(f"{model} {stats['calls']}" for model, stats in models.items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"levels": results, "upstream": upstream}, f, indent=2)
+
+    failed = False
+    if args.max_p95:
+        worst = results[-1]
+        for part in args.max_p95.split(","):
+            name, _, limit = part.partition("=")
+            stats = worst["all"] if name == "all" else worst["commands"].get(name)
+            if stats and stats["p95_ms"] > float(limit):
+                print(f"FAIL {name} p95 {stats['p95_ms']:.0f}ms > {limit}ms at concurrency {worst['concurrency']}")
+                failed = True
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,4,16,64", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="commands per concurrency level")
+    parser.add_argument("--mix", default="ask=3,play=2,news=2,remind=1,next=1,pause=1,resume=1",
+                        help="relative weights of commands")
+    parser.add_argument("--users", type=int, default=50, help="distinct fake users")
+    parser.add_argument("--discord-latency", type=float, default=40.0, help="ms per Discord send/edit")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the bot, e.g. --env ASK_STREAMING=0")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--max-p95", help='fail if p95 at the highest concurrency exceeds e.g. "ask=3000,all=2000"')
+    parser.add_argument("--admission", action="store_true",
+                        help="route commands through admission control and count shed commands")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own output")
+    add_arguments(parser)
+    sys.exit(asyncio.run(_main(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# reminder_parse_bench.py
+"""Compare the rule-based reminder parser with LLM extraction on a fixed corpus.
+
+    python -m bench.reminder_parse_bench            # parser only (no network)
+    python -m bench.reminder_parse_bench --llm      # also time the Ollama path
+
+Cases with "start": null are inputs the parser is expected to decline.
+Exits non-zero when parser accuracy falls below --min-accuracy, so it
+can run in CI.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import datetime
+import statistics
+
+from agents.time_parser import parse_reminder
+
+CORPUS = os.path.join(os.path.dirname(__file__), "reminder_corpus.json")
+FMT = "%Y-%m-%d %H:%M"
+
+
+def _load(path: str):
+    with open(path) as f:
+        data = json.load(f)
+    return datetime.datetime.strptime(data["now"], FMT), data["cases"]
+
+
+def _correct(case: dict, result) -> bool:
+    if case["start"] is None:
+        return result is None
+    if result is None:
+        return False
+    return (result["start"].strftime(FMT) == case["start"]
+            and result["summary"].lower() == case["summary"].lower())
+
+
+def _percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def _report(name: str, latencies: list, results: list, cases: list):
+    answered = [(c, r) for c, r in zip(cases, results) if r is not None]
+    correct = sum(_correct(c, r) for c, r in zip(cases, results))
+    print(f"{name}:")
+    print(f"  parse rate  {len(answered)}/{len(cases)} ({len(answered) / len(cases):.0%})")
+    print(f"  accuracy    {correct}/{len(cases)} ({correct / len(cases):.0%})")
+    print(f"  latency     mean {statistics.mean(latencies) * 1e6:.1f}us  "
+          f"p95 {_percentile(latencies, 0.95) * 1e6:.1f}us")
+    for case, result in zip(cases, results):
+        if not _correct(case, result):
+            got = None if result is None else (result["summary"], result["start"].strftime(FMT))
+            print(f"  MISS {case['text']!r}: expected {(case['summary'], case['start'])}, got {got}")
+    return correct / len(cases)
+
+
+def bench_parser(now, cases, repeat: int):
+    latencies, results = [], []
+    for case in cases:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            result = parse_reminder(case["text"], now)
+        latencies.append((time.perf_counter() - started) / repeat)
+        results.append(result)
+    return _report("rule parser", latencies, results, cases)
+
+
+async def bench_llm(now, cases):
+    from agents.reminder_agent import llm_extract_reminder
+    latencies, results = [], []
+    for case in cases:
+        started = time.perf_counter()
+        try:
+            result = await llm_extract_reminder(case["text"], now)
+        except Exception:
+            result = None
+        latencies.append(time.perf_counter() - started)
+        results.append(result)
+    _report("LLM extraction", latencies, results, cases)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--repeat", type=int, default=200, help="parser calls per case when timing")
+    parser.add_argument("--llm", action="store_true", help="also run the LLM path (needs Ollama)")
+    parser.add_argument("--min-accuracy", type=float, default=0.9)
+    args = parser.parse_args()
+
+    now, cases = _load(args.corpus)
+    accuracy = bench_parser(now, cases, args.repeat)
+    if args.llm:
+        asyncio.run(bench_llm(now, cases))
+    sys.exit(0 if accuracy >= args.min_accuracy else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+# stubs.py
+"""Local stand-ins for Ollama, Spotify, Google Custom Search and Google Calendar.
+
+    python -m bench.stubs --port 8765 --latency ollama=300 --error-rate 0.01 --rate-429 spotify=0.05
+
+Each upstream gets its own latency (mean ms, +/- `jitter`), 5xx error rate
+and 429 rate. `Stubs.env()` returns the environment variables that point
+the bot at the stubs (see bench/load_bench.py).
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+UPSTREAMS = ("ollama", "spotify", "google", "calendar")
+
+
+@dataclass
+class UpstreamProfile:
+    latency: float = 0.0      # mean, in ms
+    jitter: float = 0.25      # +/- fraction of latency
+    error_rate: float = 0.0   # share of 500s
+    rate_429: float = 0.0     # share of 429s
+    retry_after: float = 1.0  # seconds, sent with each 429
+
+
+@dataclass
+class StubConfig:
+    profiles: dict = field(default_factory=lambda: {name: UpstreamProfile() for name in UPSTREAMS})
+    # Ollama streaming: tokens per reply and delay between chunks (ms)
+    stream_tokens: int = 40
+    token_interval: float = 5.0
+    album_tracks: int = 12
+    seed: int = 1
+
+    def set(self, attr: str, spec: str):
+        """Apply "300" (all upstreams) or "ollama=300,spotify=20" to `attr`."""
+        for part in spec.split(","):
+            name, _, value = part.rpartition("=")
+            for upstream in ([name] if name else UPSTREAMS):
+                setattr(self.profiles[upstream], attr, float(value))
+
+
+class Stubs:
+    def __init__(self, config: StubConfig = None):
+        self.config = config or StubConfig()
+        self.requests = Counter()   # (upstream, status) -> count
+        self._random = random.Random(self.config.seed)
+        self._runner = None
+        self.base_url = None
+
+    # ---- fault injection ----
+
+    async def _gate(self, upstream: str):
+        """Sleep for the configured latency, then maybe return an injected failure."""
+        profile = self.config.profiles[upstream]
+        if profile.latency:
+            spread = profile.latency * profile.jitter
+            await asyncio.sleep(max(profile.latency + self._random.uniform(-spread, spread), 0) / 1000)
+        roll = self._random.random()
+        if roll < profile.rate_429:
+            self.requests[(upstream, 429)] += 1
+            return web.json_response({"error": "rate limited"}, status=429,
+                                     headers={"Retry-After": str(profile.retry_after)})
+        if roll < profile.rate_429 + profile.error_rate:
+            self.requests[(upstream, 500)] += 1
+            return web.json_response({"error": "injected failure"}, status=500)
+        self.requests[(upstream, 200)] += 1
+        return None
+
+    # ---- Ollama ----
+
+    def _reply_for(self, payload: dict) -> str:
+        prompt = payload.get("prompt", "")
+        if payload.get("format"):
+            # Structured extraction: fill whichever schema was asked for
+            if "music intent" in prompt:
+                value = re.search(r"User: (.*)$", prompt)
+                return json.dumps({"type": "track", "value": value.group(1) if value else "song"})
+            if "reminder or chat" in prompt:
+                return json.dumps({"intent": "chat", "summary": "", "start": ""})
+            return json.dumps({"summary": "Bench reminder", "start": "2099-01-01 09:00"})
+        if "maintain a short memory" in prompt:
+            return "The user likes benchmarks."
+        return " ".join(["token"] * self.config.stream_tokens)
+
+    def _timings(self, prompt: str, text: str, started: float) -> dict:
+        """Ollama's timing fields (nanoseconds), so per-model stats have something to show."""
+        total = int((time.perf_counter() - started) * 1e9)
+        tokens = len(text.split())
+        eval_ns = int(tokens * self.config.token_interval * 1e6)
+        return {"total_duration": total, "load_duration": 0,
+                "prompt_eval_count": len(prompt.split()), "prompt_eval_duration": max(total - eval_ns, 0),
+                "eval_count": tokens, "eval_duration": eval_ns}
+
+    async def ollama_generate(self, request):
+        started = time.perf_counter()
+        failure = await self._gate("ollama")
+        if failure:
+            return failure
+        payload = await request.json()
+        text = self._reply_for(payload)
+        context = list(range(len(payload.get("context") or []) + 32))
+        if not payload.get("stream", True):
+            return web.json_response({"model": payload.get("model"), "response": text, "done": True,
+                                      "context": context,
+                                      **self._timings(payload.get("prompt", ""), text, started)})
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for word in text.split(" "):
+            await response.write((json.dumps({"response": word + " ", "done": False}) + "\n").encode())
+            await asyncio.sleep(self.config.token_interval / 1000)
+        final = {"model": payload.get("model"), "response": "", "done": True, "context": context,
+                 **self._timings(payload.get("prompt", ""), text, started)}
+        await response.write((json.dumps(final) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    async def ollama_embed(self, request):
+        failure = await self._gate("ollama")
+        if failure:
+            return failure
+        payload = await request.json()
+        texts = payload.get("input") or []
+        texts = [texts] if isinstance(texts, str) else texts
+        # Bag-of-words hashing: similar texts get similar vectors
+        vectors = []
+        for text in texts:
+            vector = [0.0] * 64
+            for word in text.lower().split():
+                vector[hash(word) % 64] += 1.0
+            vectors.append(vector)
+        return web.json_response({"embeddings": vectors})
+
+    # ---- Spotify ----
+
+    async def spotify_token(self, request):
+        failure = await self._gate("spotify")
+        return failure or web.json_response({"access_token": "bench-token", "expires_in": 3600})
+
+    async def spotify_search(self, request):
+        failure = await self._gate("spotify")
+        if failure:
+            return failure
+        kind = request.query.get("type", "track")
+        query = request.query.get("q", "")
+        ident = f"{abs(hash(query)) % 10**8:08d}"
+        item = {"name": query, "uri": f"spotify:{kind}:{ident}",
+                "external_urls": {"spotify": f"https://open.spotify.com/{kind}/{ident}"}}
+        return web.json_response({f"{kind}s": {"items": [item]}})
+
+    def _tracks(self, prefix: str) -> list:
+        return [{"uri": f"spotify:track:{prefix}{i:02d}", "name": f"Track {i}"}
+                for i in range(self.config.album_tracks)]
+
+    async def spotify_album_tracks(self, request):
+        failure = await self._gate("spotify")
+        return failure or web.json_response({"items": self._tracks(request.match_info["id"])})
+
+    async def spotify_top_tracks(self, request):
+        failure = await self._gate("spotify")
+        return failure or web.json_response({"tracks": self._tracks(request.match_info["id"])})
+
+    async def spotify_player(self, request):
+        failure = await self._gate("spotify")
+        return failure or web.Response(status=204)
+
+    async def spotify_current(self, request):
+        failure = await self._gate("spotify")
+        return failure or web.json_response({"item": {"uri": "spotify:track:bench"}})
+
+    # ---- Google ----
+
+    async def google_search(self, request):
+        failure = await self._gate("google")
+        if failure:
+            return failure
+        query = request.query.get("q", "")
+        num = int(request.query.get("num", "3"))
+        items = [{"title": f"{query} headline {i}", "snippet": f"What happened with {query}.",
+                  "link": f"https://news.example/{i}"} for i in range(num)]
+        return web.json_response({"items": items})
+
+    async def calendar_insert(self, request):
+        failure = await self._gate("calendar")
+        if failure:
+            return failure
+        event = await request.json()
+        return web.json_response({"id": f"evt{self._random.randrange(10**9)}", "status": "confirmed", **event})
+
+    async def calendar_batch(self, request):
+        failure = await self._gate("calendar")
+        if failure:
+            return failure
+        boundary = request.headers["Content-Type"].split("boundary=")[-1].strip('"')
+        body = await request.text()
+        parts = []
+        for chunk in body.split("--" + boundary)[1:]:
+            match = re.search(r"Content-ID: <(.+?)>", chunk)
+            if match:
+                parts.append(match.group(1))
+        out_boundary = "batch_bench"
+        lines = []
+        for content_id in parts:
+            event = json.dumps({"id": f"evt{self._random.randrange(10**9)}", "status": "confirmed"})
+            lines += [
+                f"--{out_boundary}", "Content-Type: application/http", f"Content-ID: <response-{content_id}>", "",
+                "HTTP/1.1 200 OK", "Content-Type: application/json; charset=UTF-8", "", event, "",
+            ]
+        lines.append(f"--{out_boundary}--")
+        return web.Response(body="\r\n".join(lines).encode(),
+                            headers={"Content-Type": f"multipart/mixed; boundary={out_boundary}"})
+
+    # ---- lifecycle ----
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/generate", self.ollama_generate)
+        app.router.add_post("/api/embed", self.ollama_embed)
+        app.router.add_post("/spotify/api/token", self.spotify_token)
+        app.router.add_get("/spotify/v1/search", self.spotify_search)
+        app.router.add_get("/spotify/v1/albums/{id}/tracks", self.spotify_album_tracks)
+        app.router.add_get("/spotify/v1/artists/{id}/top-tracks", self.spotify_top_tracks)
+        app.router.add_post("/spotify/v1/me/player/queue", self.spotify_player)
+        app.router.add_put("/spotify/v1/me/player/pause", self.spotify_player)
+        app.router.add_put("/spotify/v1/me/player/play", self.spotify_player)
+        app.router.add_post("/spotify/v1/me/player/next", self.spotify_player)
+        app.router.add_get("/spotify/v1/me/player/currently-playing", self.spotify_current)
+        app.router.add_get("/customsearch/v1", self.google_search)
+        app.router.add_post("/calendar/v3/calendars/{calendar}/events", self.calendar_insert)
+        app.router.add_post("/batch/calendar/v3", self.calendar_batch)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def env(self) -> dict:
+        base = self.base_url
+        return {
+            "OLLAMA_ENDPOINT": f"{base}/api/generate",
+            "SPOTIFY_API_BASE": f"{base}/spotify/v1",
+            "SPOTIFY_TOKEN_URL": f"{base}/spotify/api/token",
+            "SPOTIFY_CLIENT_ID": "bench",
+            "SPOTIFY_CLIENT_SECRET": "bench",
+            "SPOTIFY_REFRESH_TOKEN": "bench",
+            "GOOGLE_SEARCH_URL": f"{base}/customsearch/v1",
+            "GOOGLE_API_KEY": "bench",
+            "GOOGLE_CSE_ID": "bench",
+            "CALENDAR_API_ENDPOINT": f"{base}/calendar/v3/",
+        }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", default="ollama=150,spotify=40,google=120,calendar=80",
+                        help='mean upstream latency in ms: "100" or "ollama=300,spotify=20"')
+    parser.add_argument("--jitter", default="0.25", help="latency spread as a fraction of the mean")
+    parser.add_argument("--error-rate", default="0", help='share of 500 responses, e.g. "0.01" or "google=0.1"')
+    parser.add_argument("--rate-429", default="0", help='share of 429 responses, e.g. "spotify=0.05"')
+    parser.add_argument("--retry-after", default="1", help="Retry-After seconds sent with 429s")
+    parser.add_argument("--token-interval", type=float, default=5.0, help="ms between streamed Ollama chunks")
+
+
+def config_from_args(args) -> StubConfig:
+    config = StubConfig(token_interval=args.token_interval, seed=getattr(args, "seed", 1))
+    config.set("latency", args.latency)
+    config.set("jitter", args.jitter)
+    config.set("error_rate", args.error_rate)
+    config.set("rate_429", args.rate_429)
+    config.set("retry_after", args.retry_after)
+    return config
+
+
+async def _serve(args):
+    stubs = Stubs(config_from_args(args))
+    await stubs.start(args.host, args.port)
+    print(f"Stubs listening on {stubs.base_url}; point the bot at them with:")
+    for key, value in stubs.env().items():
+        print(f"  {key}={value}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+# cache.py
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# Optional on-disk tier shared by every persistent cache (kept apart from memory.db)
+CACHE_DB = os.getenv("CACHE_DB", "cache.db")
+
+
+def normalize_key(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class DiskStore:
+    """SQLite-backed key/value rows grouped by namespace; values are JSON."""
+
+    def __init__(self, path: str = CACHE_DB):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    namespace TEXT,
+                    key TEXT,
+                    value TEXT,
+                    stored_at REAL,
+                    PRIMARY KEY (namespace, key)
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_age ON cache_entries (namespace, stored_at)")
+            self._conn = conn
+        return self._conn
+
+    def get(self, namespace: str, key: str):
+        """Return (value, stored_at) or None."""
+        with self._lock, metrics.track_sqlite("cache_get"):
+            row = self._db().execute(
+                "SELECT value, stored_at FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, namespace: str, key: str, value, stored_at: float, max_entries: int = 0):
+        with self._lock, metrics.track_sqlite("cache_put"):
+            conn = self._db()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (namespace, key, value, stored_at) VALUES (?, ?, ?, ?)",
+                    (namespace, key, json.dumps(value), stored_at)
+                )
+                if max_entries:
+                    # Drop the oldest rows beyond the namespace's size limit
+                    conn.execute(
+                        '''
+                        DELETE FROM cache_entries WHERE namespace = ? AND stored_at < (
+                            SELECT stored_at FROM cache_entries WHERE namespace = ?
+                            ORDER BY stored_at DESC LIMIT 1 OFFSET ?
+                        )
+                        ''',
+                        (namespace, namespace, max_entries - 1)
+                    )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_disk = None
+
+
+def get_disk_store() -> DiskStore:
+    global _disk
+    if _disk is None:
+        _disk = DiskStore()
+    return _disk
+
+
+def close_disk_store():
+    if _disk is not None:
+        _disk.close()
+
+
+_caches = []  # every TTLCache, for metrics
+
+
+class TTLCache:
+    """LRU cache with a fresh TTL, a stale-while-revalidate window and single-flight misses.
+
+    Entries younger than `ttl` are served as-is. Entries up to `ttl + stale`
+    old are served immediately while one background refresh runs. Older
+    entries, and misses, wait on a single shared fetch per key. With
+    `persist=True` entries are also written to the shared SQLite DiskStore,
+    so a restart starts warm.
+    """
+
+    def __init__(self, namespace: str, ttl: float, stale: float = 0.0, max_entries: int = 1024,
+                 persist: bool = False, max_disk_entries: int = 0, should_cache=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.stale = stale
+        self.max_entries = max_entries
+        self.persist = persist
+        self.max_disk_entries = max_disk_entries
+        self.should_cache = should_cache or (lambda value: value is not None)
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._inflight = {}            # key -> task
+        self.stats = {"fresh": 0, "stale": 0, "disk": 0, "miss": 0, "coalesced": 0, "refresh_errors": 0}
+        _caches.append(self)
+
+    def _age(self, stored_at: float) -> float:
+        return time.time() - stored_at
+
+    def _remember(self, key: str, value, stored_at: float):
+        self._entries[key] = (value, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def peek(self, key: str):
+        """Return the cached value regardless of age (memory tier only), or None."""
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    async def get(self, key: str, fetch):
+        """Return the value for `key`, calling the async `fetch()` only when needed."""
+        entry = self._entries.get(key)
+        if entry is None and self.persist:
+            entry = await asyncio.to_thread(get_disk_store().get, self.namespace, key)
+            if entry is not None:
+                self.stats["disk"] += 1
+                self._remember(key, *entry)
+        if entry is not None:
+            value, stored_at = entry
+            age = self._age(stored_at)
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats["fresh"] += 1
+                return value
+            if age < self.ttl + self.stale:
+                self._entries.move_to_end(key)
+                self.stats["stale"] += 1
+                self._refresh(key, fetch)
+                return value
+        self.stats["miss"] += 1
+        return await asyncio.shield(self._refresh(key, fetch))
+
+    def _refresh(self, key: str, fetch) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            return task
+        task = asyncio.ensure_future(self._load(key, fetch))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["refresh_errors"] += 1
+            logging.warning(f"[cache] {self.namespace} refresh failed for {key!r}: {task.exception()}")
+
+    async def _load(self, key: str, fetch):
+        value = await fetch()
+        if self.should_cache(value):
+            await self.put(key, value)
+        return value
+
+    async def put(self, key: str, value):
+        """Store `value` as fresh (and on disk with persist=True)."""
+        stored_at = time.time()
+        self._remember(key, value, stored_at)
+        if self.persist:
+            try:
+                await asyncio.to_thread(get_disk_store().put, self.namespace, key, value, stored_at,
+                                        self.max_disk_entries)
+            except Exception as e:
+                logging.error(f"[cache] {self.namespace} failed to persist {key!r}: {e}")
+
+    async def last_known(self, key: str):
+        """The cached value however old (disk too with persist=True), or None; fetches nothing.
+
+        For fallbacks when the upstream behind the cache is down.
+        """
+        entry = self._entries.get(key)
+        if entry is None and self.persist:
+            entry = await asyncio.to_thread(get_disk_store().get, self.namespace, key)
+        return entry[0] if entry else None
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["fresh"] + self.stats["stale"] + self.stats["miss"]
+        hits = self.stats["fresh"] + self.stats["stale"]
+        return {**self.stats, "entries": len(self._entries), "hit_ratio": hits / lookups if lookups else 0.0}
+
+
+def _collect_metrics() -> dict:
+    out = {}
+    for cache in _caches:
+        stats = cache.get_stats()
+        labels = (("cache", cache.namespace),)
+        out[("bot_cache_hit_ratio", labels)] = stats["hit_ratio"]
+        out[("bot_cache_entries", labels)] = stats["entries"]
+        for outcome in ("fresh", "stale", "disk", "miss", "coalesced", "refresh_errors"):
+            out[("bot_cache_lookups", labels + (("outcome", outcome),))] = stats[outcome]
+    return out
+
+
+metrics.add_collector(_collect_metrics)
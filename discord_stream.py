@@ -0,0 +1,72 @@
+# discord_stream.py
+import os
+import time
+
+DISCORD_MESSAGE_LIMIT = 2000
+# Discord allows roughly 5 edits per 5 s per channel; stay comfortably under it
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_PLACEHOLDER = "💭 …"
+
+
+def _split_point(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> int:
+    """Index to cut `text` at: the last newline or space before `limit`, else `limit`."""
+    for sep in ("\n", " "):
+        idx = text.rfind(sep, 0, limit)
+        if idx > limit // 2:
+            return idx + 1
+    return limit
+
+
+class StreamingReply:
+    """A Discord reply that grows as text is fed in.
+
+    Edits are throttled to STREAM_EDIT_INTERVAL, and text past the
+    2000-character limit continues in follow-up messages.
+    """
+
+    def __init__(self, ctx, interval: float = STREAM_EDIT_INTERVAL):
+        self.ctx = ctx
+        self.interval = interval
+        self.parts = []        # every fragment fed so far
+        self.buffer = ""       # text belonging to the current message
+        self.message = None
+        self.shown = None      # content last sent for the current message
+        self.last_edit = 0.0
+
+    async def start(self):
+        self.message = await self.ctx.send(STREAM_PLACEHOLDER)
+        self.shown = STREAM_PLACEHOLDER
+        self.last_edit = time.monotonic()
+
+    async def feed(self, text: str):
+        if not text:
+            return
+        self.parts.append(text)
+        self.buffer += text
+        while len(self.buffer) > DISCORD_MESSAGE_LIMIT:
+            cut = _split_point(self.buffer)
+            head, self.buffer = self.buffer[:cut], self.buffer[cut:]
+            await self._show(head)
+            # Overflow continues in a fresh message
+            self.message = None
+            self.shown = None
+        if time.monotonic() - self.last_edit >= self.interval:
+            await self._show(self.buffer)
+
+    async def finish(self) -> str:
+        """Flush what is left and return the full reply text."""
+        full = "".join(self.parts).strip()
+        if not full:
+            self.buffer = "⚠️ I didn't get a reply this time."
+        await self._show(self.buffer)
+        return full
+
+    async def _show(self, content: str):
+        if not content.strip():
+            return
+        if self.message is None:
+            self.message = await self.ctx.send(content)
+        elif content != self.shown:
+            await self.message.edit(content=content)
+        self.shown = content
+        self.last_edit = time.monotonic()
@@ -0,0 +1,171 @@
+# http_client.py
+import os
+import json
+import logging
+from dataclasses import dataclass, field
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import metrics
+import resilience
+
+# Keep-alive pool tuning (one pool per upstream host)
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+# Cap on connection setup, so an unreachable host fails well before the total timeout
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+
+# One long-lived session per "scheme://host:port"
+_sessions: dict = {}
+
+
+class UpstreamError(Exception):
+    """Raised by Response.raise_for_status for 4xx/5xx upstream replies."""
+
+    def __init__(self, status: int, url: str, body: str = ""):
+        super().__init__(f"{status} from {url}: {body[:200]}")
+        self.status = status
+        self.url = url
+
+
+@dataclass
+class Response:
+    """Fully-read upstream response (the connection is already back in the pool)."""
+    status: int
+    url: str
+    headers: dict = field(default_factory=dict)
+    body: bytes = b""
+
+    @property
+    def status_code(self) -> int:
+        # requests-style alias used by the agents
+        return self.status
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    @property
+    def text(self) -> str:
+        return self.body.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.body) if self.body else {}
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise UpstreamError(self.status, self.url, self.text)
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(url: str) -> aiohttp.ClientSession:
+    """Return the pooled session for the upstream host of `url`, creating it on first use."""
+    origin = _origin(url)
+    session = _sessions.get(origin)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _sessions[origin] = session
+    return session
+
+
+def _clean_params(params: dict) -> dict:
+    # aiohttp rejects None values in query strings
+    if not params:
+        return params
+    return {k: v for k, v in params.items() if v is not None}
+
+
+async def request(method: str, url: str, *, params: dict = None, json: dict = None, data: dict = None,
+                  headers: dict = None, auth: tuple = None, timeout: float = 10, guarded: bool = True,
+                  adaptive=True) -> Response:
+    """Send a request through the host's keep-alive pool and read the whole body.
+
+    Raises resilience.UpstreamUnavailable without sending anything while the
+    upstream's circuit breaker is open; `guarded=False` bypasses the breaker
+    (health probes). With `adaptive` (True, or a string naming the kind of
+    call, e.g. an Ollama model and lane) `timeout` may be shortened to fit
+    the recent latency of the same endpoint and kind of call; pass False
+    for calls whose duration varies too much to predict.
+    """
+    session = get_session(url)
+    basic_auth = aiohttp.BasicAuth(*auth) if auth else None
+    upstream, endpoint = metrics.classify_url(url)
+    latency_key = None
+    if guarded and adaptive:
+        latency_key = endpoint if adaptive is True else f"{endpoint} {adaptive}"
+        timeout = resilience.timeout_for(upstream, latency_key, timeout)
+    with resilience.guard(upstream, latency_key) if guarded else nullcontext({}) as call, \
+            metrics.track_call(upstream, endpoint):
+        async with session.request(
+            method, url,
+            params=_clean_params(params),
+            json=json,
+            data=data,
+            headers=headers,
+            auth=basic_auth,
+            timeout=aiohttp.ClientTimeout(total=timeout, sock_connect=min(timeout, HTTP_CONNECT_TIMEOUT)),
+        ) as res:
+            body = await res.read()
+        metrics.upstream_responses.inc(upstream=upstream, status=res.status)
+        call["status"] = res.status
+        return Response(res.status, str(res.url), dict(res.headers), body)
+
+
+async def stream_lines(method: str, url: str, *, json: dict = None, headers: dict = None,
+                       connect_timeout: float = 10, read_timeout: float = 60):
+    """Yield non-empty lines of a streamed (e.g. NDJSON) body as they arrive.
+
+    There is no total timeout: a long stream is fine as long as each chunk
+    arrives within `read_timeout` seconds of the previous one.
+    """
+    session = get_session(url)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=min(connect_timeout, HTTP_CONNECT_TIMEOUT),
+                                    sock_read=read_timeout)
+    upstream, endpoint = metrics.classify_url(url)
+    # Timed until the stream ends, so this is total generation time (too
+    # variable to adapt timeouts to, but failures still count)
+    with resilience.guard(upstream), metrics.track_call(upstream, endpoint):
+        async with session.request(method, url, json=json, headers=headers, timeout=timeout) as res:
+            metrics.upstream_responses.inc(upstream=upstream, status=res.status)
+            if res.status >= 400:
+                body = await res.read()
+                raise UpstreamError(res.status, str(res.url), body.decode("utf-8", errors="replace"))
+            async for line in res.content:
+                line = line.strip()
+                if line:
+                    yield line.decode("utf-8", errors="replace")
+
+
+async def get(url: str, **kwargs) -> Response:
+    return await request("GET", url, **kwargs)
+
+
+async def post(url: str, **kwargs) -> Response:
+    return await request("POST", url, **kwargs)
+
+
+async def put(url: str, **kwargs) -> Response:
+    return await request("PUT", url, **kwargs)
+
+
+async def close_sessions():
+    """Close every pooled session; call once on shutdown."""
+    for origin, session in list(_sessions.items()):
+        try:
+            await session.close()
+        except Exception as e:
+            logging.warning(f"[http] Failed to close session for {origin}: {e}")
+    _sessions.clear()
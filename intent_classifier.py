@@ -0,0 +1,270 @@
+# intent_classifier.py
+import os
+import re
+import math
+import atexit
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+from memory import DB_NAME
+
+# Fast-path answers below this confidence are escalated to the LLM
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", "0.8"))
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "4096"))
+# The n-gram model is only trusted once it has seen this many labelled examples,
+# and only predicts labels it has seen at least INTENT_MIN_LABEL_EXAMPLES times
+INTENT_MIN_EXAMPLES = int(os.getenv("INTENT_MIN_EXAMPLES", "30"))
+INTENT_MIN_LABEL_EXAMPLES = int(os.getenv("INTENT_MIN_LABEL_EXAMPLES", "10"))
+# ...and by at least this much probability over the runner-up
+INTENT_MIN_MARGIN = float(os.getenv("INTENT_MIN_MARGIN", "0.5"))
+# How far back to look in memory.db when harvesting labelled history
+INTENT_HISTORY_ROWS = int(os.getenv("INTENT_HISTORY_ROWS", "50000"))
+
+_LABEL_FLUSH_EVERY = 20
+
+
+def normalize(text: str) -> str:
+    text = text.lower().strip()
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" .!?,;:'\"")
+
+
+def _features(text: str) -> list:
+    words = re.findall(r"[a-z0-9']+", normalize(text))
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class NgramModel:
+    """Multinomial naive Bayes over word unigrams and bigrams.
+
+    Plain naive Bayes multiplies one likelihood per feature and ends up near
+    certain about almost anything; the likelihood is averaged per feature
+    instead, so the posterior stays usable as a confidence.
+    """
+
+    def __init__(self):
+        self.label_counts = Counter()
+        self.feature_counts = defaultdict(Counter)
+        self.totals = Counter()
+        self.vocab = set()
+
+    @property
+    def size(self) -> int:
+        return sum(self.label_counts.values())
+
+    def learn(self, text: str, label: str):
+        feats = _features(text)
+        self.label_counts[label] += 1
+        self.feature_counts[label].update(feats)
+        self.totals[label] += len(feats)
+        self.vocab.update(feats)
+
+    def predict(self, text: str) -> tuple:
+        """Return (label, posterior probability), or (None, 0.0) without enough data or a clear winner."""
+        if self.size < INTENT_MIN_EXAMPLES or any(n < INTENT_MIN_LABEL_EXAMPLES for n in self.label_counts.values()):
+            return None, 0.0
+        if len(self.label_counts) < 2:
+            return None, 0.0
+        feats = _features(text)
+        if not feats:
+            return None, 0.0
+        vocab = len(self.vocab) + 1
+        scores = {}
+        for label, count in self.label_counts.items():
+            counts = self.feature_counts[label]
+            denom = self.totals[label] + vocab
+            likelihood = sum(math.log((counts[feat] + 1) / denom) for feat in feats) / len(feats)
+            scores[label] = math.log(count / self.size) + likelihood
+        peak = max(scores.values())
+        weights = {label: math.exp(score - peak) for label, score in scores.items()}
+        total = sum(weights.values())
+        ranked = sorted((weight / total for weight in weights.values()), reverse=True)
+        if ranked[0] - ranked[1] < INTENT_MIN_MARGIN:
+            return None, 0.0
+        return max(weights, key=weights.get), ranked[0]
+
+
+class IntentClassifier:
+    """Rules first, then an n-gram model, then the LLM for whatever is left.
+
+    `rules` is a list of (regex, label, confidence). `build(text, label)`
+    turns a fast-path label into the same shape of result the LLM fallback
+    returns, and `label_of(result)` maps an LLM result back to a label (or
+    None when the LLM failed, in which case nothing is cached or learned).
+    `cache_as(result)` is what gets cached for an LLM result, e.g. without
+    slots that are only valid right now. `harvest` maps assistant-reply
+    prefixes in memory.db to the label of the user message they answered;
+    replies matching none of them are not used.
+    """
+
+    def __init__(self, domain: str, rules: list, build=None, label_of=None, cache_as=None,
+                 harvest: list = ()):
+        self.domain = domain
+        self.rules = [(re.compile(pattern, re.IGNORECASE), label, conf) for pattern, label, conf in rules]
+        self.build = build or (lambda text, label: label)
+        self.label_of = label_of or (lambda result: result)
+        self.cache_as = cache_as or (lambda result: result)
+        self.harvest = harvest
+        self.model = NgramModel()
+        self.stats = Counter()
+        self._cache = OrderedDict()
+        self._trained = False
+        self._train_lock = None
+        self._new_labels = []
+        self._label_lock = threading.Lock()
+        atexit.register(self.flush_labels)
+
+    # ---- fast path ----
+
+    def match_rules(self, text: str) -> tuple:
+        best = (None, 0.0)
+        for pattern, label, conf in self.rules:
+            if conf > best[1] and pattern.search(text):
+                best = (label, conf)
+        return best
+
+    def predict(self, text: str) -> tuple:
+        """Return (label, confidence, source) from rules or the n-gram model."""
+        label, conf = self.match_rules(text)
+        if label and conf >= INTENT_CONFIDENCE_THRESHOLD:
+            return label, conf, "rule"
+        model_label, model_conf = self.model.predict(text)
+        if model_label and model_conf > conf:
+            return model_label, model_conf, "model"
+        return label, conf, "rule"
+
+    async def classify(self, text: str, llm):
+        """Classify `text`, calling the async `llm(text)` only for low-confidence inputs.
+
+        With `llm=None` (the LLM is down) low-confidence inputs get the best
+        local guess, which is neither learned nor cached.
+        """
+        key = normalize(text)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.stats["cache"] += 1
+            return self._cache[key]
+        await self._ensure_trained()
+
+        label, conf, source = self.predict(text)
+        if label and conf >= INTENT_CONFIDENCE_THRESHOLD:
+            self.stats[source] += 1
+            return self._remember(key, self.build(text, label))
+        if llm is None:
+            self.stats["offline"] += 1
+            return self.build(text, label) if label else None
+
+        self.stats["llm"] += 1
+        result = await llm(text)
+        label = self.label_of(result) if result is not None else None
+        if label is None:
+            self.stats["llm_failed"] += 1
+            return result
+        self.learn(text, label)
+        self._remember(key, self.cache_as(result))
+        return result
+
+    def _remember(self, key: str, result):
+        self._cache[key] = result
+        if len(self._cache) > INTENT_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return result
+
+    def get_stats(self) -> dict:
+        fast = self.stats["cache"] + self.stats["rule"] + self.stats["model"]
+        total = fast + self.stats["llm"]
+        return {
+            **self.stats,
+            "fast_path_ratio": fast / total if total else 0.0,
+            "training_examples": self.model.size,
+        }
+
+    # ---- training ----
+
+    def learn(self, text: str, label: str):
+        self.model.learn(text, label)
+        with self._label_lock:
+            self._new_labels.append((self.domain, text, label))
+            if len(self._new_labels) < _LABEL_FLUSH_EVERY:
+                return
+        threading.Thread(target=self.flush_labels, daemon=True).start()
+
+    def flush_labels(self):
+        with self._label_lock:
+            rows, self._new_labels = self._new_labels, []
+            if not rows:
+                return
+            try:
+                with sqlite3.connect(DB_NAME) as conn:
+                    _create_label_table(conn)
+                    conn.executemany("INSERT INTO intent_labels (domain, text, label) VALUES (?, ?, ?)", rows)
+            except Exception as e:
+                logging.error(f"[intent] Failed to save {len(rows)} labels: {e}")
+
+    async def _ensure_trained(self):
+        if self._trained:
+            return
+        if self._train_lock is None:
+            self._train_lock = asyncio.Lock()
+        async with self._train_lock:
+            if self._trained:
+                return
+            try:
+                examples = await asyncio.to_thread(self.load_examples)
+                for text, label in examples:
+                    self.model.learn(text, label)
+                logging.info(f"[intent] {self.domain}: trained on {len(examples)} examples")
+            except Exception as e:
+                logging.error(f"[intent] {self.domain}: training failed: {e}")
+            self._trained = True
+
+    def load_examples(self) -> list:
+        """Labelled examples from past LLM decisions plus harvested reply history."""
+        with sqlite3.connect(DB_NAME) as conn:
+            _create_label_table(conn)
+            examples = conn.execute(
+                "SELECT text, label FROM intent_labels WHERE domain = ?", (self.domain,)
+            ).fetchall()
+            if not self.harvest:
+                return examples
+            rows = conn.execute(
+                '''
+                SELECT u.message, a.role, a.message
+                FROM memory u
+                JOIN memory a ON a.id = (
+                    SELECT MIN(n.id) FROM memory n WHERE n.user_id = u.user_id AND n.id > u.id
+                )
+                WHERE u.role = 'user'
+                ORDER BY u.id DESC
+                LIMIT ?
+                ''',
+                (INTENT_HISTORY_ROWS,)
+            ).fetchall()
+        for text, role, reply in rows:
+            if role != "assistant" or not text or not reply:
+                continue
+            label = self._label_reply(reply)
+            if label:
+                examples.append((text, label))
+        return examples
+
+    def _label_reply(self, reply: str):
+        for prefix, label in self.harvest:
+            if reply.startswith(prefix):
+                return label
+        return None
+
+
+def _create_label_table(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS intent_labels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            domain TEXT,
+            text TEXT,
+            label TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
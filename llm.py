@@ -0,0 +1,408 @@
+# llm.py
+import os
+import json
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+
+import http_client
+import metrics
+import resilience
+
+# Local LLM config (Ollama)
+OLLAMA_ENDPOINT = os.getenv("OLLAMA_ENDPOINT", "http://localhost:11434/api/generate")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "mistral")  # or llama3, deepseek-coder, etc.
+OLLAMA_BASE = OLLAMA_ENDPOINT.rsplit("/api/", 1)[0]
+OLLAMA_EMBED_ENDPOINT = os.getenv("OLLAMA_EMBED_ENDPOINT", OLLAMA_BASE + "/api/embed")
+OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
+OLLAMA_UPSTREAM = "ollama"
+metrics.name_upstream(OLLAMA_BASE, OLLAMA_UPSTREAM)
+# Lists the local models: cheap, and only answers once Ollama is serving
+resilience.add_probe(OLLAMA_UPSTREAM, f"{OLLAMA_BASE}/api/tags")
+
+# Structured output: "schema" sends the JSON schema as Ollama's `format`
+# (Ollama 0.5+); "json" only asks for any JSON object (older servers)
+OLLAMA_STRUCTURED_OUTPUT = os.getenv("OLLAMA_STRUCTURED_OUTPUT", "schema")
+
+# Model routing: classification/extraction prompts go to OLLAMA_FAST_MODEL
+# (a small model such as llama3.2:3b or qwen2.5:1.5b), chat to OLLAMA_MODEL.
+# Both default to OLLAMA_MODEL, so one model serves everything unless configured.
+OLLAMA_FAST_MODEL = os.getenv("OLLAMA_FAST_MODEL", OLLAMA_MODEL)
+OLLAMA_BACKGROUND_MODEL = os.getenv("OLLAMA_BACKGROUND_MODEL", OLLAMA_MODEL)
+# How long Ollama keeps a model loaded after our last request to it
+# (e.g. "30m", "2h"; -1 keeps it until Ollama stops)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Load the routed models once the bot is connected, so the first command doesn't pay for it
+OLLAMA_WARM_UP = os.getenv("OLLAMA_WARM_UP", "1") != "0"
+# A load_duration above this means the model wasn't resident
+COLD_LOAD_SECONDS = 1.0
+
+# Generations allowed at once; everything else waits in a priority queue
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "2"))
+
+# Lanes: lower value is served first
+PRIORITY_FAST = 0   # short classification / extraction prompts
+PRIORITY_CHAT = 1   # open-ended chat generations
+PRIORITY_BACKGROUND = 2  # maintenance work nobody is waiting on
+LANE_NAMES = {PRIORITY_FAST: "fast", PRIORITY_CHAT: "chat", PRIORITY_BACKGROUND: "background"}
+MODEL_ROUTES = {PRIORITY_FAST: OLLAMA_FAST_MODEL, PRIORITY_CHAT: OLLAMA_MODEL,
+                PRIORITY_BACKGROUND: OLLAMA_BACKGROUND_MODEL}
+
+LLM_ERROR_REPLY = "⚠️ I'm having trouble processing that. Try again later."
+LLM_OFFLINE_REPLY = "⚠️ My language model is offline right now. Try again in a minute."
+
+
+class LLMFormatError(ValueError):
+    """The model's reply isn't a JSON object matching the requested schema."""
+
+
+def route(priority: int) -> str:
+    """The model for a request in `priority`'s lane."""
+    return MODEL_ROUTES.get(priority, OLLAMA_MODEL)
+
+
+def routed_models() -> list:
+    """Distinct generation models in use, chat model first."""
+    return list(dict.fromkeys([OLLAMA_MODEL, OLLAMA_FAST_MODEL, OLLAMA_BACKGROUND_MODEL]))
+
+
+def _keep_alive():
+    # Ollama reads plain numbers as seconds and strings as durations
+    value = OLLAMA_KEEP_ALIVE.strip()
+    return int(value) if value.lstrip("-").isdigit() else value
+
+
+load_seconds = metrics.histogram("bot_llm_load_seconds", "Model load time reported by Ollama", ("model",))
+_model_stats = {}  # model -> totals from Ollama's timing fields
+
+
+def record_timings(data: dict):
+    """Per-model load, prompt-eval and generation times from a finished Ollama reply (ns fields)."""
+    if "total_duration" not in data:
+        return
+    model = data.get("model") or "unknown"
+    stats = _model_stats.get(model)
+    if stats is None:
+        stats = _model_stats[model] = {"calls": 0, "cold_loads": 0, "load_seconds": 0.0, "total_seconds": 0.0,
+                                       "prompt_tokens": 0, "prompt_seconds": 0.0,
+                                       "eval_tokens": 0, "eval_seconds": 0.0}
+    load = data.get("load_duration", 0) / 1e9
+    load_seconds.observe(load, model=model)
+    stats["calls"] += 1
+    stats["load_seconds"] += load
+    stats["cold_loads"] += load > COLD_LOAD_SECONDS
+    stats["total_seconds"] += data["total_duration"] / 1e9
+    stats["prompt_tokens"] += data.get("prompt_eval_count", 0)
+    stats["prompt_seconds"] += data.get("prompt_eval_duration", 0) / 1e9
+    stats["eval_tokens"] += data.get("eval_count", 0)
+    stats["eval_seconds"] += data.get("eval_duration", 0) / 1e9
+
+
+class PriorityLimiter:
+    """Concurrency limit whose waiters are woken by priority, then FIFO."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self.wait_stats = {lane: {"count": 0, "total": 0.0, "max": 0.0} for lane in LANE_NAMES}
+
+    async def acquire(self, priority: int):
+        started = time.monotonic()
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                # The slot may have been handed over just before we were cancelled
+                if fut.done() and not fut.cancelled():
+                    self.release()
+                else:
+                    fut.cancel()
+                raise
+        self._record_wait(priority, time.monotonic() - started)
+
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                # Hand the slot straight to the next waiter
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    def _record_wait(self, priority: int, waited: float):
+        stats = self.wait_stats.setdefault(priority, {"count": 0, "total": 0.0, "max": 0.0})
+        stats["count"] += 1
+        stats["total"] += waited
+        stats["max"] = max(stats["max"], waited)
+
+    def queue_depth(self) -> dict:
+        depth = {name: 0 for name in LANE_NAMES.values()}
+        for priority, _, fut in self._waiters:
+            if not fut.done():
+                name = LANE_NAMES.get(priority, str(priority))
+                depth[name] = depth.get(name, 0) + 1
+        return depth
+
+
+_limiter = PriorityLimiter(LLM_MAX_CONCURRENCY)
+_inflight = {}  # payload key -> task shared by identical requests
+_coalesced = 0
+
+
+def _adaptive(priority: int, model: str):
+    """Adaptive-timeout key for a call: per lane and model, never for background work or warm-up.
+
+    A one-word label and a full chat answer take very different times, so
+    they mustn't share a latency pool; background generations (summaries,
+    model loads) are too long and too rare to predict.
+    """
+    if priority >= PRIORITY_BACKGROUND:
+        return False
+    return f"{LANE_NAMES.get(priority, priority)}:{model}"
+
+
+async def _run(payload: dict, priority: int, timeout: float) -> dict:
+    await _limiter.acquire(priority)
+    try:
+        res = await http_client.post(OLLAMA_ENDPOINT, json=payload, timeout=timeout,
+                                     adaptive=_adaptive(priority, payload["model"]))
+        res.raise_for_status()
+        data = res.json()
+        record_timings(data)
+        return data
+    finally:
+        _limiter.release()
+
+
+def _forget(key: str, task: asyncio.Task):
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    if not task.cancelled():
+        task.exception()  # mark as retrieved; callers already saw it
+
+
+async def generate(prompt: str, *, priority: int = PRIORITY_CHAT, context: list = None,
+                   model: str = None, timeout: float = 15, **options) -> dict:
+    """Non-streaming /api/generate through the gateway; returns Ollama's JSON.
+
+    `model` defaults to the one routed for `priority`. Identical in-flight
+    requests share one upstream call. `timeout` covers
+    the upstream call only, not the time spent queued. Raises
+    resilience.UpstreamUnavailable at once while Ollama is known to be down.
+    """
+    global _coalesced
+    resilience.check(OLLAMA_UPSTREAM)
+    payload = {"model": model or route(priority), "prompt": prompt, "stream": False,
+               "keep_alive": _keep_alive(), **options}
+    if context:
+        payload["context"] = context
+    key = json.dumps(payload, sort_keys=True)
+    task = _inflight.get(key)
+    if task is not None:
+        _coalesced += 1
+    else:
+        task = asyncio.ensure_future(_run(payload, priority, timeout))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _forget(key, t))
+    # Shielded so one caller giving up doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+
+async def stream_generate(prompt: str, *, priority: int = PRIORITY_CHAT, context: list = None,
+                          model: str = None, read_timeout: float = 60, **options):
+    """Streaming /api/generate; yields each NDJSON chunk as a dict.
+
+    Holds a gateway slot for the whole stream, so close the generator
+    (e.g. with contextlib.aclosing) when stopping early.
+    """
+    payload = {"model": model or route(priority), "prompt": prompt, "stream": True,
+               "keep_alive": _keep_alive(), **options}
+    if context:
+        payload["context"] = context
+    resilience.check(OLLAMA_UPSTREAM)
+    await _limiter.acquire(priority)
+    try:
+        async for line in http_client.stream_lines("POST", OLLAMA_ENDPOINT, json=payload, read_timeout=read_timeout):
+            chunk = json.loads(line)
+            if chunk.get("done"):
+                record_timings(chunk)
+            yield chunk
+    finally:
+        _limiter.release()
+
+
+async def embed(texts: list, *, model: str = OLLAMA_EMBED_MODEL, priority: int = PRIORITY_FAST,
+                timeout: float = 15) -> list:
+    """One /api/embed call for a batch of texts; returns a vector per text."""
+    payload = {"model": model, "input": texts, "keep_alive": _keep_alive()}
+    resilience.check(OLLAMA_UPSTREAM)
+    await _limiter.acquire(priority)
+    try:
+        res = await http_client.post(OLLAMA_EMBED_ENDPOINT, json=payload, timeout=timeout,
+                                     adaptive=_adaptive(priority, model))
+        res.raise_for_status()
+        data = res.json()
+        record_timings(data)
+        return data["embeddings"]
+    finally:
+        _limiter.release()
+
+
+async def local_llm_response(prompt: str, priority: int = PRIORITY_CHAT, timeout: float = 15) -> str:
+    """Generated text, or a friendly error message if the LLM is unavailable."""
+    try:
+        data = await generate(prompt, priority=priority, timeout=timeout)
+        return data.get("response", "").strip()
+    except Exception as e:
+        logging.error(f"[LLM Chat] Error: {e}")
+        return LLM_ERROR_REPLY
+
+
+_JSON_TYPES = {"object": dict, "string": str, "integer": int, "number": (int, float), "boolean": bool,
+               "array": list, "null": type(None)}
+
+
+def validate(value, schema: dict, path: str = "$"):
+    """Check `value` against the small JSON-schema subset used for extraction.
+
+    Supports type (or a list of types), enum, properties, required and
+    items. Raises LLMFormatError naming the first offending path.
+    """
+    types = schema.get("type")
+    if types is not None:
+        types = types if isinstance(types, list) else [types]
+        if not any(isinstance(value, _JSON_TYPES[t]) and not (t in ("integer", "number") and isinstance(value, bool))
+                   for t in types):
+            raise LLMFormatError(f"{path}: expected {'/'.join(types)}, got {type(value).__name__}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise LLMFormatError(f"{path}: {value!r} is not one of {schema['enum']}")
+    if isinstance(value, dict):
+        for key in schema.get("required", ()):
+            if key not in value:
+                raise LLMFormatError(f"{path}: missing {key!r}")
+        for key, sub in schema.get("properties", {}).items():
+            if key in value:
+                validate(value[key], sub, f"{path}.{key}")
+    elif isinstance(value, list) and "items" in schema:
+        for i, item in enumerate(value):
+            validate(item, schema["items"], f"{path}[{i}]")
+    return value
+
+
+def parse_json(text: str, schema: dict) -> dict:
+    """The one parser for structured replies: strict JSON, validated against `schema`."""
+    try:
+        value = json.loads(text)
+    except ValueError as e:
+        raise LLMFormatError(f"not JSON: {e}: {text[:200]!r}") from None
+    return validate(value, schema)
+
+
+async def generate_json(prompt: str, schema: dict, *, priority: int = PRIORITY_FAST, timeout: float = 15,
+                        **options) -> dict:
+    """Schema-constrained /api/generate; returns the validated object.
+
+    Ollama's `format` makes the model emit JSON that fits `schema`, and
+    temperature 0 keeps extractions repeatable. Raises LLMFormatError if the
+    reply still doesn't match (e.g. OLLAMA_STRUCTURED_OUTPUT=json).
+    """
+    output_format = schema if OLLAMA_STRUCTURED_OUTPUT == "schema" else "json"
+    data = await generate(prompt, priority=priority, timeout=timeout, format=output_format,
+                          options={"temperature": 0}, **options)
+    return parse_json(data.get("response", ""), schema)
+
+
+async def warm_up(models: list = None, embed_model: str = None) -> dict:
+    """Load each model into Ollama (an empty prompt generates nothing); returns seconds per model.
+
+    Defaults to every routed generation model. Runs in the background lane,
+    so commands arriving meanwhile go first.
+    """
+    timings = {}
+    for model in models or routed_models():
+        started = time.perf_counter()
+        try:
+            await generate("", priority=PRIORITY_BACKGROUND, model=model, timeout=300)
+            timings[model] = time.perf_counter() - started
+        except Exception as e:
+            logging.error(f"[llm] Failed to load {model}: {e}")
+    if embed_model:
+        started = time.perf_counter()
+        try:
+            await embed(["warm-up"], model=embed_model, priority=PRIORITY_BACKGROUND, timeout=300)
+            timings[embed_model] = time.perf_counter() - started
+        except Exception as e:
+            logging.error(f"[llm] Failed to load {embed_model}: {e}")
+    return timings
+
+
+def available() -> bool:
+    """False while Ollama's circuit breaker is open; callers can skip the LLM."""
+    return resilience.available(OLLAMA_UPSTREAM)
+
+
+def is_idle() -> bool:
+    """True when no generation is running or queued."""
+    return _limiter.active == 0 and not any(not fut.done() for _, _, fut in _limiter._waiters)
+
+
+def get_stats() -> dict:
+    wait = {}
+    for priority, stats in _limiter.wait_stats.items():
+        count = stats["count"]
+        wait[LANE_NAMES.get(priority, str(priority))] = {
+            "count": count,
+            "avg": stats["total"] / count if count else 0.0,
+            "max": stats["max"],
+        }
+    return {
+        "in_flight": _limiter.active,
+        "limit": _limiter.limit,
+        "queued": _limiter.queue_depth(),
+        "wait_seconds": wait,
+        "coalesced": _coalesced,
+        "routes": {LANE_NAMES[priority]: model for priority, model in MODEL_ROUTES.items()},
+        "models": {model: dict(stats) for model, stats in _model_stats.items()},
+    }
+
+
+def summary() -> str:
+    """Lines for !stats: model routes and per-model timings."""
+    routes = ", ".join(f"{lane} → {model}" for lane, model in get_stats()["routes"].items())
+    lines = [f"**Models** {routes} (calls, cold loads, avg load ms, prompt / generation tokens/s)"]
+    for model, stats in sorted(_model_stats.items()):
+        prompt_rate = stats["prompt_tokens"] / stats["prompt_seconds"] if stats["prompt_seconds"] else 0.0
+        eval_rate = stats["eval_tokens"] / stats["eval_seconds"] if stats["eval_seconds"] else 0.0
+        lines.append(f"`{model}` {stats['calls']}, {stats['cold_loads']}, "
+                     f"{stats['load_seconds'] / stats['calls'] * 1000:.0f}, {prompt_rate:.0f} / {eval_rate:.0f}")
+    return "\n".join(lines)
+
+
+def _collect_metrics() -> dict:
+    stats = get_stats()
+    out = {("bot_llm_in_flight", ()): stats["in_flight"], ("bot_llm_coalesced", ()): stats["coalesced"]}
+    for lane, depth in stats["queued"].items():
+        out[("bot_llm_queued", (("lane", lane),))] = depth
+    for lane, wait in stats["wait_seconds"].items():
+        out[("bot_llm_wait_seconds_avg", (("lane", lane),))] = wait["avg"]
+        out[("bot_llm_wait_seconds_max", (("lane", lane),))] = wait["max"]
+    for model, totals in stats["models"].items():
+        labels = (("model", model),)
+        out[("bot_llm_model_calls", labels)] = totals["calls"]
+        out[("bot_llm_cold_loads", labels)] = totals["cold_loads"]
+        out[("bot_llm_prompt_tokens", labels)] = totals["prompt_tokens"]
+        out[("bot_llm_generated_tokens", labels)] = totals["eval_tokens"]
+        out[("bot_llm_prompt_eval_seconds", labels)] = totals["prompt_seconds"]
+        out[("bot_llm_eval_seconds", labels)] = totals["eval_seconds"]
+    return out
+
+
+metrics.add_collector(_collect_metrics)
@@ -1,51 +1,692 @@
+import os
+import queue
+import asyncio
+import atexit
+import logging
 import sqlite3
-from datetime import datetime
+import threading
+from collections import OrderedDict, deque
 
-DB_NAME = "memory.db"
+import metrics
+from sharding import SHARDED
 
-# ✅ Initialize database and tables
-def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        # Table for message history
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS memory (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
-                role TEXT,  -- 'user' or 'assistant'
-                message TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+DB_NAME = os.getenv("MEMORY_DB", "memory.db")
+
+# Write-behind tuning: how many rows go into one transaction, and how long the
+# writer waits for more rows to arrive before committing a partial batch.
+MEMORY_BATCH_SIZE = int(os.getenv("MEMORY_BATCH_SIZE", "256"))
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "0.05"))
+
+# Recent-turns cache: turns kept per user, and the caps that trigger LRU eviction.
+# Off when sharded: another shard process may append to the same user.
+MEMORY_CACHE_TURNS = int(os.getenv("MEMORY_CACHE_TURNS", "20"))
+MEMORY_CACHE_MAX_USERS = int(os.getenv("MEMORY_CACHE_MAX_USERS", "0" if SHARDED else "10000"))
+MEMORY_CACHE_MAX_BYTES = int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS memory (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        role TEXT,  -- 'user' or 'assistant'
+        message TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # Serves "last N rows for a user" as an index range scan
+    "CREATE INDEX IF NOT EXISTS idx_memory_user_id ON memory (user_id, id)",
+    # Rolling summary of turns folded out of memory by retention
+    '''
+    CREATE TABLE IF NOT EXISTS memory_summaries (
+        user_id TEXT PRIMARY KEY,
+        summary TEXT,
+        covered_id INTEGER,  -- last memory.id folded into the summary
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+]
+
+# Full-text index over memory, kept in sync by triggers. External content:
+# the text itself is stored once, in memory. user_id is indexed so a
+# search intersects the user's postings instead of filtering afterwards.
+FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE memory_fts USING fts5(user_id, message, content='memory', content_rowid='id')",
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_fts_insert AFTER INSERT ON memory BEGIN
+        INSERT INTO memory_fts (rowid, user_id, message) VALUES (new.id, new.user_id, new.message);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_fts_delete AFTER DELETE ON memory BEGIN
+        INSERT INTO memory_fts (memory_fts, rowid, user_id, message) VALUES ('delete', old.id, old.user_id, old.message);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_fts_update AFTER UPDATE ON memory BEGIN
+        INSERT INTO memory_fts (memory_fts, rowid, user_id, message) VALUES ('delete', old.id, old.user_id, old.message);
+        INSERT INTO memory_fts (rowid, user_id, message) VALUES (new.id, new.user_id, new.message);
+    END
+    ''',
+    # Backfill rows written before the index existed
+    "INSERT INTO memory_fts (memory_fts) VALUES ('rebuild')",
+]
+
+
+def _create_fts(conn: sqlite3.Connection) -> bool:
+    """Create and backfill memory_fts if missing; False if SQLite lacks FTS5."""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'memory_fts'").fetchone()
+    if exists:
+        return True
+    try:
+        with conn:
+            for statement in FTS_SCHEMA:
+                conn.execute(statement)
+    except sqlite3.OperationalError as e:
+        logging.error(f"[memory] Full-text search unavailable: {e}")
+        return False
+    return True
+
+
+def fts_query(user_id: str, terms: str) -> str:
+    """FTS5 query for the user's rows containing every term; "word*" is a prefix search."""
+    words = []
+    for word in terms.split():
+        prefix = word.endswith("*")
+        word = word.strip('*"')
+        if word:
+            words.append(_fts_string(word) + ("*" if prefix else ""))
+    if not words:
+        return ""
+    return f"user_id:{_fts_string(user_id)} AND message:(" + " AND ".join(words) + ")"
+
+
+def _fts_string(text: str) -> str:
+    # Inside an FTS5 string a double quote is written twice
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class RecentTurnsCache:
+    """Per-user ring buffer of the latest turns, LRU-evicted across users.
+
+    An entry always holds the exact tail of that user's history (up to
+    `turns` rows), so any read with limit <= turns can be answered from it.
+    """
+
+    # Rough per-row overhead on top of the message text (dict, deque slot, role)
+    ROW_OVERHEAD = 120
+
+    def __init__(self, turns: int = MEMORY_CACHE_TURNS, max_users: int = MEMORY_CACHE_MAX_USERS,
+                 max_bytes: int = MEMORY_CACHE_MAX_BYTES):
+        self.turns = turns
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # user_id -> deque of {"role", "message"}
+        self._summaries = {}           # user_id -> long-term summary (or None), for cached users only
+        self._fills = {}               # user_id -> [fills in flight, changes seen since they started]
+        self._sizes = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.turns > 0 and self.max_users > 0 and self.max_bytes > 0
+
+    def _row_size(self, row: dict) -> int:
+        return len(row["message"] or "") + self.ROW_OVERHEAD
+
+    def _resize(self, user_id: str):
+        size = sum(self._row_size(row) for row in self._entries[user_id])
+        size += len(self._summaries.get(user_id) or "")
+        self._bytes += size - self._sizes.get(user_id, 0)
+        self._sizes[user_id] = size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_users or self._bytes > self.max_bytes):
+            user_id, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(user_id, 0)
+            self._summaries.pop(user_id, None)
+            self.evictions += 1
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._entries
+
+    def get(self, user_id: str, limit: int):
+        """Return the last `limit` turns, or None on a miss."""
+        with self.lock:
+            entry = self._entries.get(user_id)
+            if entry is None or limit > self.turns:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            rows = list(entry)
+            return rows[-limit:] if limit > 0 else []
+
+    def load(self, user_id: str, rows: list):
+        with self.lock:
+            self._entries[user_id] = deque(rows[-self.turns:], maxlen=self.turns)
+            self._entries.move_to_end(user_id)
+            self._resize(user_id)
+            self._evict()
+
+    def begin_fill(self, user_id: str) -> int:
+        """Start a miss fill; the SQLite read runs without the lock, so pass the result to end_fill."""
+        with self.lock:
+            fill = self._fills.setdefault(user_id, [0, 0])
+            fill[0] += 1
+            return fill[1]
+
+    def end_fill(self, user_id: str, version: int, apply=None):
+        """Run `apply()` under the lock unless the user changed since begin_fill returned `version`."""
+        with self.lock:
+            fill = self._fills[user_id]
+            fill[0] -= 1
+            if fill[0] == 0:
+                del self._fills[user_id]
+            if apply and fill[1] == version:
+                apply()
+
+    def _changed(self, user_id: str):
+        # An append or drop during a fill means what it read may be stale
+        fill = self._fills.get(user_id)
+        if fill is not None:
+            fill[1] += 1
+
+    def append(self, user_id: str, role: str, message: str):
+        # Only users already cached can be extended; anyone else loads on their next miss
+        with self.lock:
+            self._changed(user_id)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            entry.append({"role": role, "message": message})
+            self._entries.move_to_end(user_id)
+            self._resize(user_id)
+            self._evict()
+
+    def summary(self, user_id: str) -> tuple:
+        """(True, summary) if the user's summary is cached, else (False, None)."""
+        with self.lock:
+            if user_id in self._summaries:
+                return True, self._summaries[user_id]
+            return False, None
+
+    def set_summary(self, user_id: str, summary):
+        # Kept only alongside the user's turns, so eviction and drops cover both
+        with self.lock:
+            if user_id in self._entries:
+                self._summaries[user_id] = summary
+                self._resize(user_id)
+                self._evict()
+
+    def drop(self, user_id: str):
+        with self.lock:
+            self._changed(user_id)
+            self._summaries.pop(user_id, None)
+            if self._entries.pop(user_id, None) is not None:
+                self._bytes -= self._sizes.pop(user_id, 0)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "users": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+class MemoryStore:
+    """Long-lived SQLite store with a write-behind queue.
+
+    Inserts are queued and committed in batches by a single writer thread;
+    reads go through a separate connection, which WAL mode lets run
+    alongside the writer.
+    """
+
+    def __init__(self, path: str = DB_NAME):
+        self.path = path
+        self._queue = queue.Queue()
+        self._pending = {}  # user_id -> rows queued but not yet committed
+        self._pending_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._reader = None
+        self._writer = None
+        self._closed = False
+        self._fts = False
+        self._open_lock = threading.Lock()
+        self.cache = RecentTurnsCache()
+
+    def open(self):
+        if self._reader is not None:
+            return
+        # Opened on first use, possibly from several threads at once
+        with self._open_lock:
+            if self._reader is None:
+                self._open()
+
+    def _open(self):
+        with _connect(self.path) as conn:
+            # Only takes effect on a new file; existing ones are converted by vacuum(full=True)
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._fts = _create_fts(conn)
+        self._reader = _connect(self.path)
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name="memory-writer", daemon=True)
+        self._writer.start()
+
+    # ---- writer thread ----
+
+    def _write_loop(self):
+        conn = _connect(self.path)
+        running = True
+        while running:
+            ops = [self._queue.get()]
+            # Collect whatever else arrives within the flush window
+            try:
+                while len(ops) < MEMORY_BATCH_SIZE and ops[-1][0] == "insert":
+                    ops.append(self._queue.get(timeout=MEMORY_FLUSH_INTERVAL))
+            except queue.Empty:
+                pass
+            with metrics.track_sqlite("memory_write"):
+                running = self._apply(conn, ops)
+        conn.close()
+
+    def _apply(self, conn: sqlite3.Connection, ops: list) -> bool:
+        running = True
+        waiters = []
+        inserted = {}
+        try:
+            with conn:
+                rows = []
+                for kind, payload in ops:
+                    if kind == "insert":
+                        rows.append(payload)
+                        inserted[payload[0]] = inserted.get(payload[0], 0) + 1
+                        continue
+                    # Keep ordering: commit queued inserts before a delete runs
+                    if rows:
+                        conn.executemany("INSERT INTO memory (user_id, role, message) VALUES (?, ?, ?)", rows)
+                        rows = []
+                    if kind == "delete":
+                        conn.execute("DELETE FROM memory WHERE user_id = ?", (payload,))
+                        conn.execute("DELETE FROM memory_summaries WHERE user_id = ?", (payload,))
+                    elif kind == "fold":
+                        user_id, upto_id, summary = payload
+                        if summary is not None:
+                            conn.execute(
+                                "INSERT OR REPLACE INTO memory_summaries (user_id, summary, covered_id) VALUES (?, ?, ?)",
+                                (user_id, summary, upto_id)
+                            )
+                        conn.execute("DELETE FROM memory WHERE user_id = ? AND id <= ?", (user_id, upto_id))
+                    elif kind == "vacuum":
+                        conn.commit()
+                        if payload is None:
+                            # One-off conversion so later passes can vacuum incrementally
+                            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                            conn.execute("VACUUM")
+                        else:
+                            conn.execute(f"PRAGMA incremental_vacuum({int(payload)})").fetchall()
+                        # Vacuumed pages pass through the WAL; shrink it back too
+                        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+                    elif kind == "flush":
+                        waiters.append(payload)
+                    elif kind == "stop":
+                        waiters.append(payload)
+                        running = False
+                if rows:
+                    conn.executemany("INSERT INTO memory (user_id, role, message) VALUES (?, ?, ?)", rows)
+        except Exception as e:
+            logging.error(f"[memory] Failed to write batch of {len(ops)} ops: {e}")
+        finally:
+            with self._pending_lock:
+                for user_id, count in inserted.items():
+                    left = self._pending.get(user_id, 0) - count
+                    if left > 0:
+                        self._pending[user_id] = left
+                    else:
+                        self._pending.pop(user_id, None)
+            for event in waiters:
+                event.set()
+        return running
+
+    # ---- public API ----
+
+    def append(self, user_id: str, role: str, message: str):
+        self.open()
+        with self._pending_lock:
+            self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        self._queue.put(("insert", (user_id, role, message)))
+        self.cache.append(user_id, role, message)
+
+    def recent(self, user_id: str, limit: int = 5) -> list:
+        self.open()
+        if not self.cache.enabled:
+            return self._read(user_id, limit)
+        rows = self.cache.get(user_id, limit)
+        if rows is not None:
+            return rows
+        if limit > self.cache.turns:
+            return self._read(user_id, limit)
+        # The lock isn't held across the flush and read (appends on the event
+        # loop would wait on the writer); a fill that raced a change is dropped
+        version = self.cache.begin_fill(user_id)
+        rows = None
+        try:
+            rows = self._read(user_id, self.cache.turns)
+        finally:
+            self.cache.end_fill(user_id, version, rows is not None and (lambda: self.cache.load(user_id, rows)))
+        return rows[-limit:] if limit > 0 else []
+
+    def cached(self, user_id: str, limit: int = 5):
+        """Like recent(), but only from the cache: None if SQLite would be needed.
+
+        Never blocks, so it is safe on the event loop; a thread busy filling
+        the cache also counts as "needs SQLite".
+        """
+        cache = self.cache
+        if not cache.enabled or limit > cache.turns or not cache.lock.acquire(blocking=False):
+            return None
+        try:
+            return cache.get(user_id, limit) if user_id in cache else None
+        finally:
+            cache.lock.release()
+
+    def _read(self, user_id: str, limit: int) -> list:
+        # Read-your-writes: make sure this user's queued rows are committed
+        self._flush_user(user_id)
+        with self._read_lock, metrics.track_sqlite("memory_read"):
+            rows = self._reader.execute(
+                "SELECT role, message FROM memory WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+        return list(reversed([{"role": row[0], "message": row[1]} for row in rows]))
+
+    def _flush_user(self, user_id: str):
+        with self._pending_lock:
+            dirty = user_id in self._pending
+        if dirty:
+            self.flush()
+
+    def search(self, user_id: str, terms: str, limit: int = 5, offset: int = 0) -> tuple:
+        """(total, rows) of the user's messages matching `terms`, best match first."""
+        self.open()
+        query = fts_query(user_id, terms)
+        if not self._fts or not query:
+            return 0, []
+        self._flush_user(user_id)
+        with self._read_lock, metrics.track_sqlite("memory_search"):
+            total = self._reader.execute(
+                "SELECT count(*) FROM memory_fts WHERE memory_fts MATCH ?", (query,)
+            ).fetchone()[0]
+            rows = self._reader.execute(
+                '''
+                SELECT m.role, snippet(memory_fts, 1, '**', '**', '…', 16), m.timestamp
+                FROM memory_fts JOIN memory m ON m.id = memory_fts.rowid
+                WHERE memory_fts MATCH ?
+                ORDER BY bm25(memory_fts, 0.0, 1.0)
+                LIMIT ? OFFSET ?
+                ''',
+                (query, limit, offset)
+            ).fetchall()
+        return total, [{"role": row[0], "message": row[1], "timestamp": row[2]} for row in rows]
+
+    # ---- retention ----
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        self.open()
+        with self._read_lock:
+            return self._reader.execute(sql, params).fetchall()
+
+    def retention_candidates(self, max_rows: int, max_age_days: float, limit: int) -> dict:
+        """user_id -> newest memory.id that is over the row cap or older than the TTL."""
+        self.flush()
+        candidates = {}
+        if max_rows > 0:
+            over = self._query(
+                "SELECT user_id FROM memory GROUP BY user_id HAVING count(*) > ? LIMIT ?", (max_rows, limit)
+            )
+            for (user_id,) in over:
+                row = self._query(
+                    "SELECT id FROM memory WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?", (user_id, max_rows)
+                )
+                if row:
+                    candidates[user_id] = row[0][0]
+        if max_age_days > 0:
+            cutoff = f"-{max_age_days} days"
+            # ids grow with time: everything below the first fresh row has expired
+            first_fresh = self._query(
+                "SELECT id FROM memory WHERE timestamp >= datetime('now', ?) ORDER BY id LIMIT 1", (cutoff,)
+            )
+            if first_fresh:
+                bound = first_fresh[0][0]
+            else:
+                bound = (self._query("SELECT max(id) FROM memory")[0][0] or 0) + 1
+            expired = self._query(
+                "SELECT user_id, max(id) FROM memory WHERE id < ? GROUP BY user_id LIMIT ?", (bound, limit)
             )
-        ''')
-        conn.commit()
+            for user_id, upto_id in expired:
+                candidates[user_id] = max(candidates.get(user_id, 0), upto_id)
+        return candidates
 
-# ✅ Append a message to memory
-def append_user_message(user_id, role, message):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO memory (user_id, role, message) VALUES (?, ?, ?)",
-            (user_id, role, message)
+    def rows_upto(self, user_id: str, upto_id: int, limit: int) -> list:
+        """The newest `limit` rows with id <= upto_id, oldest first."""
+        rows = self._query(
+            "SELECT role, message FROM memory WHERE user_id = ? AND id <= ? ORDER BY id DESC LIMIT ?",
+            (user_id, upto_id, limit)
         )
-        conn.commit()
+        return list(reversed([{"role": row[0], "message": row[1]} for row in rows]))
+
+    def summary(self, user_id: str):
+        if not self.cache.enabled:
+            return self._read_summary(user_id)
+        found, summary = self.cache.summary(user_id)
+        if found:
+            return summary
+        # As in recent(): a fold or clear during the read discards the fill
+        version = self.cache.begin_fill(user_id)
+        found = False
+        try:
+            summary = self._read_summary(user_id)
+            found = True
+        finally:
+            self.cache.end_fill(user_id, version, found and (lambda: self.cache.set_summary(user_id, summary)))
+        return summary
+
+    def cached_summary(self, user_id: str) -> tuple:
+        """Non-blocking cache lookup for the event loop: (found, summary)."""
+        if not self.cache.enabled or not self.cache.lock.acquire(blocking=False):
+            return False, None
+        try:
+            return self.cache.summary(user_id)
+        finally:
+            self.cache.lock.release()
+
+    def _read_summary(self, user_id: str):
+        row = self._query("SELECT summary FROM memory_summaries WHERE user_id = ?", (user_id,))
+        return row[0][0] if row else None
+
+    def fold(self, user_id: str, upto_id: int, summary: str = None):
+        """Delete the user's rows up to upto_id, storing `summary` in the same transaction."""
+        self.open()
+        self._queue.put(("fold", (user_id, upto_id, summary)))
+        self.flush()
+        # Retention may have removed turns the cache still holds
+        self.cache.drop(user_id)
+
+    def vacuum(self, pages: int):
+        self.open()
+        if self._query("PRAGMA auto_vacuum")[0][0] != 2:
+            self._queue.put(("vacuum", None))
+        else:
+            self._queue.put(("vacuum", pages))
+        self.flush()
+
+    def db_stats(self) -> dict:
+        size = sum(os.path.getsize(path) for path in (self.path, self.path + "-wal") if os.path.exists(path))
+        return {
+            "file_bytes": size,
+            "page_count": self._query("PRAGMA page_count")[0][0],
+            "free_pages": self._query("PRAGMA freelist_count")[0][0],
+            "rows": self._query("SELECT count(*) FROM memory")[0][0],
+            "users": self._query("SELECT count(DISTINCT user_id) FROM memory")[0][0],
+            "summaries": self._query("SELECT count(*) FROM memory_summaries")[0][0],
+        }
+
+    def clear(self, user_id: str):
+        self.open()
+        self.cache.drop(user_id)
+        self._queue.put(("delete", user_id))
+        self.flush()
+        # A read that ran before the delete committed may have refilled it
+        self.cache.drop(user_id)
+
+    def flush(self, timeout: float = None):
+        """Block until everything queued so far is committed."""
+        if self._writer is None or not self._writer.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        done.wait(timeout)
+
+    def close(self):
+        """Flush pending writes and stop the writer thread."""
+        if self._closed or self._writer is None:
+            return
+        self._closed = True
+        if self._writer.is_alive():
+            done = threading.Event()
+            self._queue.put(("stop", done))
+            done.wait()
+            self._writer.join()
+        with self._read_lock:
+            self._reader.close()
+        self._reader = None
+        self._writer = None
+
+
+_store = MemoryStore(DB_NAME)
+_listeners = []  # fn(event, user_id, role, message), event is "append", "clear" or "fold"
+
+
+def _notify(event, user_id, role=None, message=None):
+    for listener in _listeners:
+        try:
+            listener(event, user_id, role, message)
+        except Exception as e:
+            logging.error(f"[memory] Listener failed on {event}: {e}")
+
+# ✅ Initialize database and tables (otherwise done on first use)
+def init_db():
+    _store.open()
+
+# ✅ Append a message to memory (queued; committed in the next batch)
+def append_user_message(user_id, role, message):
+    _store.append(user_id, role, message)
+    _notify("append", user_id, role, message)
 
 # ✅ Get the last N messages for a user
 def get_user_context(user_id, limit=5):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute(
-            "SELECT role, message FROM memory WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (user_id, limit)
-        )
-        rows = c.fetchall()
-        return list(reversed([{"role": row[0], "message": row[1]} for row in rows]))
+    return _store.recent(user_id, limit)
+
+# ✅ Same, for the event loop: cache hits return at once, misses wait for SQLite in a thread
+async def get_user_context_async(user_id, limit=5):
+    rows = _store.cached(user_id, limit)
+    if rows is not None:
+        return rows
+    return await asyncio.to_thread(_store.recent, user_id, limit)
 
 # ✅ Clear memory (optional)
 def clear_user_memory(user_id):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM memory WHERE user_id = ?", (user_id,))
-        conn.commit()
+    _store.clear(user_id)
+    _notify("clear", user_id)
+
+# ✅ Same, for the event loop; listeners are still notified on the loop thread
+async def clear_user_memory_async(user_id):
+    await asyncio.to_thread(_store.clear, user_id)
+    _notify("clear", user_id)
+
+# ✅ Long-term summary of turns folded out by retention (None if there is none yet)
+def get_user_summary(user_id):
+    return _store.summary(user_id)
+
+# ✅ Same, for the event loop: cached next to the recent turns, read in a thread otherwise
+async def get_user_summary_async(user_id):
+    found, summary = _store.cached_summary(user_id)
+    if found:
+        return summary
+    return await asyncio.to_thread(_store.summary, user_id)
+
+# ✅ Row counts and file size
+def get_db_stats():
+    return _store.db_stats()
+
+# ✅ Users with rows past the row cap or TTL -> newest id to fold away
+def find_retention_candidates(max_rows, max_age_days, limit=100):
+    return _store.retention_candidates(max_rows, max_age_days, limit)
+
+# ✅ Rows about to be folded, for summarizing
+def get_rows_upto(user_id, upto_id, limit=200):
+    return _store.rows_upto(user_id, upto_id, limit)
+
+# ✅ Replace a user's rows up to upto_id with a summary
+def fold_user_memory(user_id, upto_id, summary=None):
+    _store.fold(user_id, upto_id, summary)
+    _notify("fold", user_id)
+
+# ✅ Same, for the event loop; listeners are still notified on the loop thread
+async def fold_user_memory_async(user_id, upto_id, summary=None):
+    await asyncio.to_thread(_store.fold, user_id, upto_id, summary)
+    _notify("fold", user_id)
+
+# ✅ Return free pages to the filesystem
+def vacuum_memory(pages=2000):
+    _store.vacuum(pages)
+
+# ✅ Full-text search over a user's history, one page at a time
+def search_user_memory(user_id, terms, page=1, per_page=5):
+    return _store.search(user_id, terms, limit=per_page, offset=(page - 1) * per_page)
+
+# ✅ Get notified of appends, clears and folds (e.g. to keep an index in sync)
+def add_memory_listener(listener):
+    _listeners.append(listener)
+
+# ✅ Recent-turns cache hit/miss counters
+def get_cache_stats():
+    return _store.cache.stats()
+
+# ✅ Commit queued writes now
+def flush_memory():
+    _store.flush()
+
+# ✅ Flush and close on shutdown
+def close_memory():
+    _store.close()
+
+atexit.register(close_memory)
+
+def _collect_metrics():
+    stats = _store.cache.stats()
+    return {
+        ("bot_memory_cache_hit_ratio", ()): stats["hit_ratio"],
+        ("bot_memory_cache_users", ()): stats["users"],
+        ("bot_memory_cache_bytes", ()): stats["bytes"],
+        ("bot_memory_write_queue", ()): _store._queue.qsize(),
+    }
 
-# ✅ Initialize the DB when this file is imported
-init_db()
+metrics.add_collector(_collect_metrics)
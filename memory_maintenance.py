@@ -0,0 +1,125 @@
+# memory_maintenance.py
+import os
+import asyncio
+import datetime
+import logging
+
+import llm
+from memory import (
+    find_retention_candidates, get_rows_upto, get_user_summary, fold_user_memory_async,
+    vacuum_memory, get_db_stats, MEMORY_CACHE_TURNS,
+)
+
+# Retention: rows beyond the newest MEMORY_MAX_ROWS_PER_USER, or older than
+# MEMORY_TTL_DAYS, are folded into the user's rolling summary (0 disables either)
+MEMORY_MAX_ROWS_PER_USER = max(int(os.getenv("MEMORY_MAX_ROWS_PER_USER", "500")), MEMORY_CACHE_TURNS)
+MEMORY_TTL_DAYS = float(os.getenv("MEMORY_TTL_DAYS", "90"))
+# Summarize folded turns with the LLM; with 0 they are simply deleted
+MEMORY_SUMMARIZE = os.getenv("MEMORY_SUMMARIZE", "1") != "0"
+MEMORY_SUMMARY_WORDS = int(os.getenv("MEMORY_SUMMARY_WORDS", "120"))
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+MAINTENANCE_USERS_PER_PASS = int(os.getenv("MAINTENANCE_USERS_PER_PASS", "50"))
+MAINTENANCE_VACUUM_PAGES = int(os.getenv("MAINTENANCE_VACUUM_PAGES", "2000"))
+# Local hours in which summaries may be generated, e.g. "1-6"; empty means any
+# time the LLM is idle
+MAINTENANCE_HOURS = os.getenv("MAINTENANCE_HOURS", "")
+SUMMARY_INPUT_ROWS = 200
+
+
+def _in_window(hour: int) -> bool:
+    if not MAINTENANCE_HOURS:
+        return True
+    start, end = (int(part) for part in MAINTENANCE_HOURS.split("-"))
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end  # wraps midnight, e.g. "22-4"
+
+
+def off_peak() -> bool:
+    return _in_window(datetime.datetime.now().hour) and llm.is_idle()
+
+
+async def summarize(previous: str, rows: list) -> str:
+    """Fold `rows` into the previous summary with the LLM."""
+    transcript = "\n".join(
+        f"{'User' if row['role'] == 'user' else 'Assistant'}: {row['message']}" for row in rows
+    )
+    prompt = (
+        "You maintain a short memory of a user for a chat assistant.\n"
+        f"Current memory: {previous or '(empty)'}\n\n"
+        f"Older conversation to fold in:\n{transcript}\n\n"
+        f"Rewrite the memory to include any lasting facts, preferences and open tasks from the "
+        f"conversation. At most {MEMORY_SUMMARY_WORDS} words, plain sentences, no preamble.\n"
+        "Memory:"
+    )
+    data = await llm.generate(prompt, priority=llm.PRIORITY_BACKGROUND, timeout=120)
+    summary = data.get("response", "").strip()
+    if not summary:
+        raise ValueError("empty summary")
+    return summary
+
+
+async def run_pass() -> dict:
+    """One retention pass: fold expired/over-cap rows, vacuum, return DB stats."""
+    candidates = await asyncio.to_thread(
+        find_retention_candidates, MEMORY_MAX_ROWS_PER_USER, MEMORY_TTL_DAYS, MAINTENANCE_USERS_PER_PASS
+    )
+    folded = deferred = 0
+    for user_id, upto_id in candidates.items():
+        summary = None
+        if MEMORY_SUMMARIZE:
+            # Summaries wait for an idle LLM; the rows stay until one can be written
+            if not off_peak():
+                deferred += 1
+                continue
+            rows = await asyncio.to_thread(get_rows_upto, user_id, upto_id, SUMMARY_INPUT_ROWS)
+            previous = await asyncio.to_thread(get_user_summary, user_id)
+            try:
+                summary = await summarize(previous, rows)
+            except Exception as e:
+                logging.warning(f"[maintenance] Summary for {user_id} failed: {e}")
+                deferred += 1
+                continue
+        await fold_user_memory_async(user_id, upto_id, summary)
+        folded += 1
+    await asyncio.to_thread(vacuum_memory, MAINTENANCE_VACUUM_PAGES)
+    stats = await asyncio.to_thread(get_db_stats)
+    stats.update(folded_users=folded, deferred_users=deferred)
+    logging.info(
+        f"[maintenance] {stats['rows']} rows / {stats['users']} users, "
+        f"{stats['file_bytes'] / 1e6:.1f} MB ({stats['free_pages']} free pages); "
+        f"folded {folded}, deferred {deferred}"
+    )
+    return stats
+
+
+class MemoryMaintenance:
+    """Runs run_pass() every MAINTENANCE_INTERVAL seconds in the background."""
+
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self.last_stats = {}
+        self._task = None
+
+    async def _loop(self):
+        # First pass shortly after startup, once the bot has settled
+        await asyncio.sleep(min(self.interval, 60))
+        while True:
+            try:
+                self.last_stats = await run_pass()
+            except Exception as e:
+                logging.error(f"[maintenance] Pass failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+maintenance = MemoryMaintenance()
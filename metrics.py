@@ -0,0 +1,424 @@
+# metrics.py
+"""In-process metrics: counters, gauges and histograms with Prometheus text output.
+
+Recording is a dict lookup plus a few additions under a lock, cheap
+enough for every command and upstream call. Collectors registered with
+`add_collector` are only called when metrics are rendered, which is how
+existing stats (caches, LLM queue, memory) are exported without touching
+their hot paths.
+
+Tracing is sampled: a command starts a trace with probability
+METRICS_TRACE_SAMPLE, and every instrumented block inside it (HTTP,
+Calendar, SQLite, agent stages) becomes a span. Finished traces are logged and the
+latest few are kept for `!stats traces`.
+"""
+import os
+import re
+import time
+import bisect
+import random
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlsplit
+
+from sharding import SHARD_PROCESS
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 disables the HTTP endpoint
+if METRICS_PORT:
+    # Shard processes listen on consecutive ports: 9108, 9109, ...
+    METRICS_PORT += SHARD_PROCESS
+METRICS_TRACE_SAMPLE = float(os.getenv("METRICS_TRACE_SAMPLE", "0.01"))
+METRICS_TRACES_KEPT = 20
+
+# Seconds; spans SQLite commits through to slow LLM generations
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labelnames: tuple, labels: dict) -> tuple:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: tuple, key: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def render(self) -> list:
+        lines = self.header()
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def series(self) -> dict:
+        """label values -> {"count", "sum", "p50", "p95", "p99"} (quantiles from buckets)."""
+        with self._lock:
+            snapshot = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()}
+        out = {}
+        for key, (counts, total, count) in snapshot.items():
+            out[key] = {"count": count, "sum": total,
+                        **{f"p{int(q * 100)}": self._quantile(counts, count, q) for q in (0.5, 0.95, 0.99)}}
+        return out
+
+    def _quantile(self, counts: list, count: int, q: float) -> float:
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            if seen + n >= rank and n:
+                low = self.buckets[i - 1] if i > 0 else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else self.buckets[-1] * 2
+                return low + (high - low) * (rank - seen) / n  # linear within the bucket
+            seen += n
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        lines = self.header()
+        with self._lock:
+            items = sorted((key, list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items())
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def add_collector(self, collect):
+        """`collect()` returns {(metric_name, labels_tuple_of_pairs): value}; exported as gauges."""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        gauges = {}
+        for collect in self._collectors:
+            try:
+                for (name, labels), value in collect().items():
+                    gauges.setdefault(name, []).append((labels, value))
+            except Exception as e:
+                logging.warning(f"[metrics] Collector failed: {e}")
+        for name, samples in sorted(gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                rendered = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{rendered}}} {float(value)}" if rendered else f"{name} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+add_collector = registry.add_collector
+
+
+def counter(name: str, help: str, labelnames: tuple = ()) -> Counter:
+    return registry.register(Counter(name, help, labelnames))
+
+
+def gauge(name: str, help: str, labelnames: tuple = ()) -> Gauge:
+    return registry.register(Gauge(name, help, labelnames))
+
+
+def histogram(name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+
+# ---- the bot's metrics ----
+
+command_seconds = histogram("bot_command_seconds", "Command handler latency", ("command",))
+command_errors = counter("bot_command_errors_total", "Commands that raised", ("command",))
+commands_in_flight = gauge("bot_commands_in_flight", "Commands being handled", ("command",))
+
+upstream_seconds = histogram("bot_upstream_seconds", "Upstream call latency", ("upstream", "endpoint"))
+upstream_responses = counter("bot_upstream_responses_total", "Upstream responses by status", ("upstream", "status"))
+upstream_errors = counter("bot_upstream_errors_total", "Upstream calls that failed without a response",
+                          ("upstream", "kind"))
+upstream_in_flight = gauge("bot_upstream_in_flight", "Upstream calls in progress", ("upstream",))
+
+stage_seconds = histogram("bot_stage_seconds", "Agent pipeline stage latency", ("stage",))
+stage_errors = counter("bot_stage_errors_total", "Agent pipeline stages that raised", ("stage",))
+
+sqlite_seconds = histogram("bot_sqlite_seconds", "SQLite operation latency", ("op",))
+
+
+# ---- upstream naming ----
+
+_upstreams = []  # (url prefix, name), longest prefix first
+_ID_SEGMENT = re.compile(r"^(\d+|[A-Za-z0-9]{22}|[0-9a-f-]{32,36})$")
+
+
+def name_upstream(base_url: str, name: str):
+    """Label calls under `base_url` as `name` (e.g. OLLAMA_ENDPOINT -> "ollama")."""
+    _upstreams.append((base_url.rstrip("/"), name))
+    _upstreams.sort(key=lambda item: -len(item[0]))
+
+
+def classify_url(url: str) -> tuple:
+    """(upstream, endpoint) for a request URL; IDs in the path become {id}."""
+    base = url.split("?", 1)[0]
+    for prefix, name in _upstreams:
+        if base.startswith(prefix):
+            path = base[len(prefix):] or "/"
+            break
+    else:
+        parts = urlsplit(base)
+        name, path = parts.netloc, parts.path or "/"
+    endpoint = "/".join("{id}" if _ID_SEGMENT.match(seg) else seg for seg in path.split("/"))
+    return name, endpoint
+
+
+# ---- tracing ----
+
+_trace = contextvars.ContextVar("trace", default=None)
+recent_traces = deque(maxlen=METRICS_TRACES_KEPT)
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []  # (name, offset, duration, depth)
+        self.depth = 0
+
+    def format(self, total: float) -> str:
+        lines = [f"{self.name} {total * 1000:.0f}ms"]
+        for name, offset, duration, depth in sorted(self.spans, key=lambda s: s[1]):
+            lines.append(f"{'  ' * (depth + 1)}+{offset * 1000:.0f}ms {name} {duration * 1000:.0f}ms")
+        return "\n".join(lines)
+
+
+@contextmanager
+def span(name: str):
+    """Record a span if the current command is being traced; otherwise free."""
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    depth = trace.depth
+    trace.depth += 1
+    try:
+        yield
+    finally:
+        trace.depth = depth
+        trace.spans.append((name, started - trace.started, time.perf_counter() - started, depth))
+
+
+# ---- recording helpers ----
+
+@contextmanager
+def track_command(name: str):
+    """Time one command invocation; samples it for tracing."""
+    trace = Trace(f"!{name}") if random.random() < METRICS_TRACE_SAMPLE else None
+    token = _trace.set(trace)
+    commands_in_flight.inc(command=name)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        command_errors.inc(command=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        commands_in_flight.dec(command=name)
+        command_seconds.observe(elapsed, command=name)
+        _trace.reset(token)
+        if trace is not None:
+            text = trace.format(elapsed)
+            recent_traces.append(text)
+            logging.info(f"[trace] {text}")
+
+
+def track_upstream(url: str):
+    """Time one HTTP call; the upstream name is yielded for status counting."""
+    return track_call(*classify_url(url))
+
+
+@contextmanager
+def track_call(upstream: str, endpoint: str):
+    """Time one upstream call made without http_client (e.g. the Calendar SDK)."""
+    upstream_in_flight.inc(upstream=upstream)
+    started = time.perf_counter()
+    try:
+        with span(f"{upstream} {endpoint}"):
+            yield upstream
+    except Exception as e:
+        # HTTP error statuses are already counted in upstream_responses
+        if getattr(e, "status", None) is None:
+            if getattr(e, "status_code", None) is not None:
+                kind = "http"  # an SDK error reply (googleapiclient's HttpError)
+            elif isinstance(e, TimeoutError) or "Timeout" in type(e).__name__:
+                kind = "timeout"
+            else:
+                kind = "connection"
+            upstream_errors.inc(upstream=upstream, kind=kind)
+        raise
+    finally:
+        upstream_in_flight.dec(upstream=upstream)
+        upstream_seconds.observe(time.perf_counter() - started, upstream=upstream, endpoint=endpoint)
+
+
+@contextmanager
+def track_sqlite(op: str):
+    started = time.perf_counter()
+    try:
+        with span(f"sqlite {op}"):
+            yield
+    finally:
+        sqlite_seconds.observe(time.perf_counter() - started, op=op)
+
+
+def stage(name: str):
+    """Decorator timing an async agent function as a pipeline stage."""
+    def wrap(fn):
+        @wraps(fn)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                with span(name):
+                    return await fn(*args, **kwargs)
+            except Exception:
+                stage_errors.inc(stage=name)
+                raise
+            finally:
+                stage_seconds.observe(time.perf_counter() - started, stage=name)
+        return timed
+    return wrap
+
+
+# ---- export ----
+
+class MetricsServer:
+    """Serves registry.render() at http://METRICS_HOST:METRICS_PORT/metrics."""
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8",
+                                headers={"X-Prometheus-Format": "0.0.4"})
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            logging.error(f"[metrics] Could not listen on {self.host}:{self.port}: {e}")
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
+
+
+def summary() -> str:
+    """Compact text for !stats: per-command and per-upstream latency, errors, in-flight."""
+    lines = ["**Commands** (count, p50 / p95 ms, errors)"]
+    for (command,), s in sorted(command_seconds.series().items()):
+        lines.append(f"`!{command}` {s['count']}, {s['p50'] * 1000:.0f} / {s['p95'] * 1000:.0f}, "
+                     f"{command_errors.value(command=command):.0f}")
+    lines.append("**Upstreams** (count, p50 / p95 ms)")
+    per_upstream = {}
+    for (upstream, endpoint), s in upstream_seconds.series().items():
+        per_upstream.setdefault(upstream, []).append((endpoint, s))
+    for upstream, endpoints in sorted(per_upstream.items()):
+        for endpoint, s in sorted(endpoints, key=lambda e: -e[1]["count"])[:4]:
+            lines.append(f"`{upstream} {endpoint}` {s['count']}, {s['p50'] * 1000:.0f} / {s['p95'] * 1000:.0f}")
+    errors = {key: value for key, value in upstream_errors._values.items() if value}
+    if errors:
+        lines.append("**Upstream failures** " + ", ".join(f"{u} {k}: {v:.0f}" for (u, k), v in sorted(errors.items())))
+    lines.append("**Stages** (count, p50 / p95 ms)")
+    for (name,), s in sorted(stage_seconds.series().items()):
+        lines.append(f"`{name}` {s['count']}, {s['p50'] * 1000:.0f} / {s['p95'] * 1000:.0f}")
+    busy = {key[0]: value for key, value in commands_in_flight._values.items() if value}
+    if busy:
+        lines.append("**In flight** " + ", ".join(f"!{k}: {v:.0f}" for k, v in sorted(busy.items())))
+    return "\n".join(lines)
@@ -0,0 +1,238 @@
+# ratelimit.py
+import os
+import time
+import sqlite3
+import asyncio
+import threading
+from contextlib import contextmanager
+
+from cache import CACHE_DB
+from sharding import SHARDED
+
+# Shared bucket state (shard mode only) sits next to the cache entries
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", CACHE_DB)
+
+
+class TokenBucket:
+    """Token bucket with AIMD rate adaptation for upstreams that push back.
+
+    `penalize(delay)` is called on a 429: the bucket is drained, blocked for
+    the advertised Retry-After and its refill rate halved. `reward()` is
+    called on success and creeps the rate back up towards `max_rate`.
+    """
+
+    def __init__(self, rate: float, capacity: float, min_rate: float = None, max_rate: float = None,
+                 step: float = 0.5):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate if min_rate is not None else rate
+        self.max_rate = max_rate if max_rate is not None else rate
+        self.step = step
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Take tokens if available right now; never waits."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def retry_after(self, tokens: float = 1) -> float:
+        """Seconds until `tokens` could be taken."""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, (tokens - self.tokens) / self.rate)
+        return max(wait, self.blocked_until - now)
+
+    def take(self, tokens: float = 1) -> float:
+        """Take tokens and return 0.0, or take nothing and return the seconds to wait."""
+        if TokenBucket.try_acquire(self, tokens):
+            return 0.0
+        return max(TokenBucket.retry_after(self, tokens), 1e-3)
+
+    async def acquire(self, tokens: float = 1, deadline: float = None) -> bool:
+        """Wait for tokens; False, with nothing taken, if that would run past `deadline` (monotonic)."""
+        while True:
+            wait = self.take(tokens)
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def penalize(self, delay: float):
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, now + delay)
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def reward(self):
+        self.rate = min(self.max_rate, self.rate + self.step)
+
+
+class BucketStore:
+    """Token bucket state in SQLite, so every shard process draws from the same buckets.
+
+    Each operation is one short IMMEDIATE transaction, run off the event loop
+    where callers are async (`take_all_async`, `acquire`). time.monotonic() is
+    the system-wide monotonic clock, so timestamps written by one process
+    are valid in the others on the same host.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=2.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL,
+                    updated REAL,
+                    blocked_until REAL,
+                    rate REAL
+                )
+            ''')
+            self._conn = conn
+        return self._conn
+
+    @contextmanager
+    def locked(self, *buckets: "SharedTokenBucket"):
+        """Load `buckets` from the store, let the caller update them, then save them, in one transaction."""
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for bucket in buckets:
+                    row = conn.execute(
+                        "SELECT tokens, updated, blocked_until, rate FROM rate_buckets WHERE key = ?", (bucket.key,)
+                    ).fetchone()
+                    if row is not None:
+                        bucket.tokens, bucket.updated, bucket.blocked_until, bucket.rate = row
+                yield
+                conn.executemany(
+                    "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated, blocked_until, rate) VALUES (?, ?, ?, ?, ?)",
+                    [(bucket.key, bucket.tokens, bucket.updated, bucket.blocked_until, bucket.rate)
+                     for bucket in buckets]
+                )
+                self._writes += 1
+                if self._writes % 1000 == 0:
+                    # Idle buckets have refilled long ago; a missing row starts full anyway
+                    conn.execute("DELETE FROM rate_buckets WHERE updated < ?", (time.monotonic() - 3600,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_store = None
+
+
+def get_bucket_store() -> BucketStore:
+    global _store
+    if _store is None:
+        _store = BucketStore(RATE_LIMIT_DB)
+    return _store
+
+
+def close_bucket_store():
+    if _store is not None:
+        _store.close()
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket whose state lives in the BucketStore under `key`."""
+
+    def __init__(self, key: str, rate: float, capacity: float, store: BucketStore = None, **kwargs):
+        super().__init__(rate, capacity, **kwargs)
+        self.key = key
+        self.store = store or get_bucket_store()
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        with self.store.locked(self):
+            return super().try_acquire(tokens)
+
+    def retry_after(self, tokens: float = 1) -> float:
+        with self.store.locked(self):
+            return super().retry_after(tokens)
+
+    def take(self, tokens: float = 1) -> float:
+        with self.store.locked(self):
+            return super().take(tokens)
+
+    async def acquire(self, tokens: float = 1, deadline: float = None) -> bool:
+        while True:
+            wait = await asyncio.to_thread(self.take, tokens)
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def penalize(self, delay: float):
+        with self.store.locked(self):
+            super().penalize(delay)
+
+    def reward(self):
+        with self.store.locked(self):
+            super().reward()
+
+
+def take_all(buckets: list, tokens: float = 1) -> float:
+    """Take `tokens` from every bucket or from none; 0.0, or the seconds until all of them could give.
+
+    Shared buckets are checked and taken in a single transaction, so two
+    processes can't both pass the check and then overdraw.
+    """
+    shared = [bucket for bucket in buckets if isinstance(bucket, SharedTokenBucket)]
+    if not shared:
+        return _take_all(buckets, tokens)
+    with shared[0].store.locked(*shared):
+        return _take_all(buckets, tokens)
+
+
+def _take_all(buckets: list, tokens: float) -> float:
+    # Base-class methods: shared buckets are already loaded by the caller's transaction
+    wait = max(TokenBucket.retry_after(bucket, tokens) for bucket in buckets)
+    if wait > 0:
+        return wait
+    for bucket in buckets:
+        TokenBucket.try_acquire(bucket, tokens)
+    return 0.0
+
+
+async def take_all_async(buckets: list, tokens: float = 1) -> float:
+    """take_all(), run in a thread when it has to touch the BucketStore."""
+    if any(isinstance(bucket, SharedTokenBucket) for bucket in buckets):
+        return await asyncio.to_thread(take_all, buckets, tokens)
+    return take_all(buckets, tokens)
+
+
+def token_bucket(key: str, rate: float, capacity: float, **kwargs) -> TokenBucket:
+    """A bucket shared by all shard processes when sharded, else an in-process one."""
+    if SHARDED:
+        return SharedTokenBucket(key, rate, capacity, **kwargs)
+    return TokenBucket(rate, capacity, **kwargs)
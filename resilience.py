@@ -0,0 +1,316 @@
+# resilience.py
+"""Per-upstream circuit breakers, health probes and latency-adaptive timeouts.
+
+Upstreams are named as in metrics.py ("ollama", "spotify", "google_search"...).
+http_client runs every call inside `guard(upstream, latency_key)`:
+
+- After BREAKER_FAILURES failures in a row (connection errors, timeouts,
+  5xx replies) the upstream's breaker opens and calls fail at once with
+  `UpstreamUnavailable`, without touching the network.
+- After the cooldown one trial call is let through (half-open). Success
+  closes the breaker; failure reopens it with a doubled cooldown.
+- Upstreams registered with `add_probe` are also checked in the background
+  by `health`: an open upstream closes as soon as a probe succeeds, and an
+  idle one is opened by a failed probe before a user has to find out.
+- Calls that opt in with a latency key (an endpoint, or an endpoint plus
+  model/lane for Ollama, whose calls range from one-word labels to long
+  generations) get a timeout shrunk to a multiple of that key's recent p95
+  latency, never above what the caller asked for.
+
+Callers that can degrade check `available(upstream)` first and skip the
+upstream altogether (e.g. !play without Ollama treats the text as a track
+search).
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+RESILIENCE_ENABLED = os.getenv("RESILIENCE_ENABLED", "1") != "0"
+# Failures in a row that open a breaker, and how long it stays open at first
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "15"))
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "300"))
+# Background probes of registered upstreams (0 disables them)
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "10"))
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "2"))
+# Adaptive timeouts: factor x recent p95, at least the floor, at most the caller's timeout
+ADAPTIVE_TIMEOUT_FACTOR = float(os.getenv("ADAPTIVE_TIMEOUT_FACTOR", "4"))
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv("ADAPTIVE_TIMEOUT_MIN", "5"))
+ADAPTIVE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 200  # per latency key
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+STATE_VALUES = {CLOSED: 1.0, HALF_OPEN: 0.5, OPEN: 0.0}
+
+transitions = metrics.counter("bot_breaker_transitions_total", "Circuit breaker state changes",
+                              ("upstream", "state"))
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+    def __init__(self, upstream: str, retry_after: float = 0.0):
+        super().__init__(f"{upstream} is unavailable (retry in {retry_after:.0f}s)")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0           # in a row
+        self.cooldown = BREAKER_COOLDOWN
+        self.opened_at = 0.0
+        self.last_call = 0.0        # monotonic time of the last real call
+        self.rejected = 0
+        self._trial = False         # a half-open trial call is in flight
+        self._latency = {}          # latency key -> recent successful call durations
+
+    def retry_after(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    @property
+    def available(self) -> bool:
+        """False while calls would be rejected."""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return self.retry_after() == 0
+        return not self._trial
+
+    def check(self):
+        """Raise UpstreamUnavailable if a call would be rejected right now."""
+        if not self.available:
+            self.rejected += 1
+            raise UpstreamUnavailable(self.name, self.retry_after())
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        transitions.inc(upstream=self.name, state=state)
+        if state == OPEN:
+            logging.error(f"[resilience] {self.name} is down; failing fast for {self.cooldown:.0f}s")
+        elif state == CLOSED:
+            logging.warning(f"[resilience] {self.name} is back")
+
+    def _admit(self):
+        self.check()
+        if self.state == OPEN:
+            # Cooldown is over: this call is the trial
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            self._trial = True
+        self.last_call = time.monotonic()
+
+    def trip(self):
+        self._trial = False
+        self.opened_at = time.monotonic()
+        self._set_state(OPEN)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+            self.trip()
+        elif self.state == CLOSED and self.failures >= BREAKER_FAILURES:
+            self.trip()
+
+    def record_success(self, latency_key: str = None, seconds: float = None):
+        self.failures = 0
+        self._trial = False
+        self.cooldown = BREAKER_COOLDOWN
+        self._set_state(CLOSED)
+        if latency_key is not None and seconds is not None:
+            samples = self._latency.get(latency_key)
+            if samples is None:
+                samples = self._latency[latency_key] = deque(maxlen=LATENCY_SAMPLES)
+            samples.append(seconds)
+
+    def timeout(self, latency_key: str, ceiling: float) -> float:
+        """`ceiling`, shrunk to ADAPTIVE_TIMEOUT_FACTOR x the key's recent p95."""
+        samples = self._latency.get(latency_key)
+        if not samples or len(samples) < ADAPTIVE_MIN_SAMPLES:
+            return ceiling
+        ordered = sorted(samples)
+        p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+        return min(ceiling, max(ADAPTIVE_TIMEOUT_MIN, p95 * ADAPTIVE_TIMEOUT_FACTOR))
+
+    @contextmanager
+    def guard(self, latency_key: str = None):
+        """Admit one call or raise UpstreamUnavailable; the yielded dict takes the reply's "status".
+
+        Successful calls are timed under `latency_key`, if given.
+        """
+        self._admit()
+        call = {"status": None}
+        started = time.perf_counter()
+        try:
+            yield call
+        except Exception as e:
+            # aiohttp errors carry .status, googleapiclient's HttpError .status_code
+            status = getattr(e, "status", None) or getattr(e, "status_code", None)
+            if status is None or status >= 500:
+                self.record_failure()
+            else:
+                # A 4xx means the upstream answered
+                self.record_success()
+            raise
+        except BaseException:
+            # Cancelled or closed early: no verdict, but free the trial slot
+            self._trial = False
+            raise
+        status = call["status"]
+        if status is not None and status >= 500:
+            self.record_failure()
+        elif status is not None and status >= 400:
+            self.record_success()
+        else:
+            self.record_success(latency_key, time.perf_counter() - started)
+
+
+_breakers = {}  # upstream name -> CircuitBreaker
+
+
+def breaker(upstream: str) -> CircuitBreaker:
+    entry = _breakers.get(upstream)
+    if entry is None:
+        entry = _breakers[upstream] = CircuitBreaker(upstream)
+    return entry
+
+
+@contextmanager
+def guard(upstream: str, latency_key: str = None):
+    if not RESILIENCE_ENABLED:
+        yield {"status": None}
+        return
+    with breaker(upstream).guard(latency_key) as call:
+        yield call
+
+
+def available(upstream: str) -> bool:
+    """True unless `upstream`'s breaker is rejecting calls."""
+    if not RESILIENCE_ENABLED:
+        return True
+    entry = _breakers.get(upstream)
+    return entry is None or entry.available
+
+
+def check(upstream: str):
+    """Fail fast before queueing work for an upstream that is known to be down."""
+    if RESILIENCE_ENABLED:
+        breaker(upstream).check()
+
+
+def timeout_for(upstream: str, latency_key: str, ceiling: float) -> float:
+    if not RESILIENCE_ENABLED:
+        return ceiling
+    return breaker(upstream).timeout(latency_key, ceiling)
+
+
+class HealthMonitor:
+    """Probes registered upstreams every HEALTH_PROBE_INTERVAL seconds.
+
+    Only open (or, if asked for, idle) upstreams are probed; real traffic is
+    the health check for busy ones.
+    """
+
+    def __init__(self, interval: float = HEALTH_PROBE_INTERVAL):
+        self.interval = interval
+        self._probes = {}  # upstream -> (URL, probe when idle); a reply below 500 is healthy
+        self._task = None
+
+    def add_probe(self, upstream: str, url: str, idle: bool = True):
+        self._probes[upstream] = (url, idle)
+
+    async def probe(self, upstream: str) -> bool:
+        # Imported here: http_client itself depends on this module
+        import http_client
+        try:
+            res = await http_client.get(self._probes[upstream][0], timeout=HEALTH_PROBE_TIMEOUT, guarded=False)
+            return res.status < 500
+        except Exception:
+            return False
+
+    async def check_all(self):
+        now = time.monotonic()
+        for upstream, (_, idle) in list(self._probes.items()):
+            entry = breaker(upstream)
+            if entry.state == CLOSED and (not idle or now - entry.last_call < self.interval):
+                continue
+            healthy = await self.probe(upstream)
+            if healthy and entry.state != CLOSED:
+                entry.record_success()
+            elif not healthy and entry.state != OPEN:
+                entry.trip()
+            elif not healthy:
+                # Still down: keep user calls off it for another cooldown
+                entry.opened_at = time.monotonic()
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                logging.error(f"[resilience] Health check failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if RESILIENCE_ENABLED and self.interval > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+health = HealthMonitor()
+
+
+def add_probe(upstream: str, url: str, idle: bool = True):
+    """Probe `upstream` at `url` while its breaker is open, and also when idle if `idle`.
+
+    Third-party APIs are registered with idle=False, so a quiet bot doesn't
+    keep calling them.
+    """
+    health.add_probe(upstream, url, idle)
+
+
+def summary() -> str:
+    """One line for !stats: breaker state per upstream seen so far."""
+    parts = []
+    for name, entry in sorted(_breakers.items()):
+        text = f"{name} {entry.state}"
+        if entry.state == OPEN:
+            text += f" ({entry.retry_after():.0f}s)"
+        if entry.rejected:
+            text += f" rejected {entry.rejected}"
+        parts.append(text)
+    return "**Upstreams** " + (", ".join(parts) or "none called yet")
+
+
+def _collect_metrics() -> dict:
+    out = {}
+    for name, entry in _breakers.items():
+        labels = (("upstream", name),)
+        out[("bot_upstream_up", labels)] = STATE_VALUES[entry.state]
+        out[("bot_upstream_rejected", labels)] = entry.rejected
+        for latency_key in entry._latency:
+            # Adapted timeouts only; keys with too few samples use the caller's
+            adapted = entry.timeout(latency_key, float("inf"))
+            if adapted != float("inf"):
+                out[("bot_upstream_timeout_seconds", labels + (("key", latency_key),))] = adapted
+    return out
+
+
+metrics.add_collector(_collect_metrics)
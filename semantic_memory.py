@@ -0,0 +1,425 @@
+# semantic_memory.py
+import os
+import re
+import json
+import asyncio
+import logging
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+import llm
+import metrics
+from sharding import SHARDED
+from memory import DB_NAME, add_memory_listener, get_user_context
+
+# Per-user vector files live next to memory.db (memory.db -> memory_vectors/)
+SEMANTIC_DIR = os.getenv("SEMANTIC_DIR", os.path.splitext(DB_NAME)[0] + "_vectors")
+# Off by default when sharded: each process would index only the turns it saw
+SEMANTIC_MEMORY = os.getenv("SEMANTIC_MEMORY", "0" if SHARDED else "1") != "0"
+# Appends arriving within the window are embedded in one request
+SEMANTIC_BATCH_SIZE = int(os.getenv("SEMANTIC_BATCH_SIZE", "32"))
+SEMANTIC_BATCH_WINDOW = float(os.getenv("SEMANTIC_BATCH_WINDOW", "0.5"))
+SEMANTIC_SAVE_DELAY = float(os.getenv("SEMANTIC_SAVE_DELAY", "10"))
+SEMANTIC_MAX_USERS = int(os.getenv("SEMANTIC_MAX_USERS", "256"))       # matrices kept in RAM
+SEMANTIC_MAX_ROWS = int(os.getenv("SEMANTIC_MAX_ROWS", "5000"))        # per user, oldest dropped
+SEMANTIC_BACKFILL_LIMIT = int(os.getenv("SEMANTIC_BACKFILL_LIMIT", "1000"))
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.35"))
+# How long a query waits for a user's vectors to load before answering without them
+SEMANTIC_LOAD_WAIT = float(os.getenv("SEMANTIC_LOAD_WAIT", "1.0"))
+SEMANTIC_MIN_CHARS = 12
+# Bot replies that carry nothing worth recalling
+SKIP_PREFIXES = ("⚠️", "❌", "⏭️", "⏸️", "▶️")
+# A message identical to one of the last few indexed rows is not added again
+DEDUPE_WINDOW = 8
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class UserVectors:
+    """Unit-normalized float32 embeddings for one user, one row per message.
+
+    Rows live in a preallocated array that doubles when full, so appends
+    are amortized O(1) and `matrix` is a view without copying.
+    """
+
+    def __init__(self, dim: int = 0):
+        self._data = np.empty((0, dim), dtype=np.float32)
+        self.size = 0
+        self.rows = []  # (role, message) per vector
+        self.dirty = False
+        self.covered = 0  # appends numbered below this were already in the backfill
+
+    @property
+    def dim(self) -> int:
+        return self._data.shape[1]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._data[:self.size]
+
+    def add(self, vectors: np.ndarray, rows: list):
+        if self.size == 0 and self.dim != vectors.shape[1]:
+            self._data = np.empty((0, vectors.shape[1]), dtype=np.float32)
+        needed = self.size + len(rows)
+        if needed > len(self._data):
+            grown = np.empty((max(needed, 2 * len(self._data), 16), self.dim), dtype=np.float32)
+            grown[:self.size] = self.matrix
+            self._data = grown
+        self._data[self.size:needed] = vectors
+        self.size = needed
+        self.rows.extend(rows)
+        if self.size > SEMANTIC_MAX_ROWS:
+            drop = self.size - SEMANTIC_MAX_ROWS
+            self._data = self.matrix[drop:].copy()
+            self.size = len(self._data)
+            self.rows = self.rows[drop:]
+        self.dirty = True
+
+    def recent(self, n: int) -> list:
+        return self.rows[-n:]
+
+    def keep(self, mask: list):
+        """Drop the rows whose mask entry is false; rows past the mask are kept."""
+        mask = list(mask) + [True] * (self.size - len(mask))
+        self._data = self.matrix[np.asarray(mask, dtype=bool)].copy()
+        self.size = len(self._data)
+        self.rows = [row for row, kept in zip(self.rows, mask) if kept]
+        self.dirty = True
+
+    def top_k(self, query: np.ndarray, k: int) -> list:
+        """[(score, index)] of the k best rows, best first."""
+        if self.size == 0 or k <= 0:
+            return []
+        scores = self.matrix @ query
+        k = min(k, self.size)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), int(i)) for i in best]
+
+
+class SemanticIndex:
+    """Embedding index over the memory table, kept in sync through memory listeners.
+
+    New messages are embedded in small batches off the reply path. Users
+    seen for the first time are backfilled from their stored history in
+    the background; until that finishes, queries return nothing.
+    """
+
+    def __init__(self, directory: str = SEMANTIC_DIR):
+        self.directory = directory
+        self._users = OrderedDict()  # user_id -> UserVectors, LRU
+        self._loading = {}           # user_id -> load task
+        self._pending = []           # (seq, user_id, role, message) waiting to be embedded
+        self._seq = 0                # numbers appends, so a backfill knows what it already saw
+        self._resets = {}            # user_id -> times cleared or folded, so a load in flight can tell
+        self._flush_task = None
+        self._save_task = None
+        self._tasks = set()
+        self.stats = {"embedded": 0, "queries": 0, "hits": 0, "errors": 0}
+
+    # ---- files ----
+
+    def _paths(self, user_id: str) -> tuple:
+        name = re.sub(r"[^\w-]", "_", user_id)
+        base = os.path.join(self.directory, name)
+        return base + ".npy", base + ".json"
+
+    def _read(self, user_id: str):
+        vec_path, rows_path = self._paths(user_id)
+        if not os.path.exists(vec_path) or not os.path.exists(rows_path):
+            return None
+        vectors = np.load(vec_path).astype(np.float32)
+        with open(rows_path, encoding="utf-8") as f:
+            rows = [tuple(row) for row in json.load(f)]
+        # A crash between the two writes can leave them a row apart
+        n = min(len(vectors), len(rows))
+        entry = UserVectors(vectors.shape[1])
+        if n:
+            entry.add(vectors[:n], rows[:n])
+        entry.dirty = False
+        return entry
+
+    def _write(self, user_id: str, matrix: np.ndarray, rows: list):
+        os.makedirs(self.directory, exist_ok=True)
+        vec_path, rows_path = self._paths(user_id)
+        # float16 halves the file; vectors are normalized so precision loss is negligible
+        with open(vec_path + ".tmp", "wb") as f:
+            np.save(f, matrix.astype(np.float16))
+        with open(rows_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False)
+        os.replace(vec_path + ".tmp", vec_path)
+        os.replace(rows_path + ".tmp", rows_path)
+
+    def _remove(self, user_id: str):
+        for path in self._paths(user_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    # ---- loading ----
+
+    def _get(self, user_id: str) -> asyncio.Future:
+        entry = self._users.get(user_id)
+        if entry is not None:
+            self._users.move_to_end(user_id)
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(entry)
+            return future
+        task = self._loading.get(user_id)
+        if task is None:
+            task = self._spawn(self._load(user_id))
+            self._loading[user_id] = task
+            task.add_done_callback(lambda t: self._load_done(user_id, t))
+        return asyncio.shield(task)
+
+    def _load_done(self, user_id: str, task: asyncio.Task):
+        if self._loading.get(user_id) is task:
+            del self._loading[user_id]
+        # Searches stop waiting after SEMANTIC_LOAD_WAIT, so nobody else may see this
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["errors"] += 1
+            logging.warning(f"[semantic] Failed to load vectors for {user_id}: {task.exception()}")
+
+    async def _load(self, user_id: str) -> UserVectors:
+        resets = self._resets.get(user_id, 0)
+        entry = await asyncio.to_thread(self._read, user_id)
+        if entry is None:
+            entry = await self._backfill(user_id)
+        if self._resets.get(user_id, 0) != resets:
+            # Cleared or folded while loading: what was read may hold forgotten history
+            return UserVectors()
+        self._users[user_id] = entry
+        self._evict()
+        if entry.dirty:
+            self._schedule_save()
+        return entry
+
+    async def _backfill(self, user_id: str) -> UserVectors:
+        # Appends notified before this point are committed, so the read below includes them
+        covered = self._seq
+        history = await asyncio.to_thread(get_user_context, user_id, SEMANTIC_BACKFILL_LIMIT)
+        rows = [(row["role"], row["message"]) for row in history if _indexable(row["message"])]
+        entry = UserVectors()
+        entry.covered = covered
+        for i in range(0, len(rows), SEMANTIC_BATCH_SIZE):
+            chunk = rows[i:i + SEMANTIC_BATCH_SIZE]
+            vectors = await llm.embed([message for _, message in chunk], priority=llm.PRIORITY_BACKGROUND)
+            entry.add(_normalize(np.asarray(vectors, dtype=np.float32)), chunk)
+            self.stats["embedded"] += len(chunk)
+        entry.dirty = True
+        return entry
+
+    def _evict(self):
+        while len(self._users) > SEMANTIC_MAX_USERS:
+            user_id, entry = self._users.popitem(last=False)
+            if entry.dirty:
+                self._spawn(asyncio.to_thread(self._write, user_id, entry.matrix.copy(), list(entry.rows)))
+
+    # ---- incremental updates ----
+
+    def on_memory_event(self, event: str, user_id: str, role: str, message: str):
+        if event == "clear":
+            self._users.pop(user_id, None)
+            self._loading.pop(user_id, None)
+            self._resets[user_id] = self._resets.get(user_id, 0) + 1
+            self._pending = [item for item in self._pending if item[1] != user_id]
+            self._remove(user_id)
+            return
+        if event == "fold":
+            if user_id in self._loading:
+                self._loading.pop(user_id)
+                self._resets[user_id] = self._resets.get(user_id, 0) + 1
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._spawn(self._prune(user_id))
+            return
+        if not SEMANTIC_MEMORY or not _indexable(message):
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return  # outside the bot (scripts, maintenance): nothing to schedule on
+        self._pending.append((self._seq, user_id, role, message))
+        self._seq += 1
+        if len(self._pending) >= SEMANTIC_BATCH_SIZE:
+            self._spawn(self._flush())
+        elif self._flush_task is None:
+            self._flush_task = self._spawn(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(SEMANTIC_BATCH_WINDOW)
+        self._flush_task = None
+        await self._flush()
+
+    async def _flush(self):
+        batch, self._pending = self._pending[:SEMANTIC_BATCH_SIZE], self._pending[SEMANTIC_BATCH_SIZE:]
+        if not batch:
+            return
+        try:
+            vectors = _normalize(np.asarray(await llm.embed([item[3] for item in batch],
+                                                                    priority=llm.PRIORITY_BACKGROUND), dtype=np.float32))
+            self.stats["embedded"] += len(batch)
+            by_user = OrderedDict()
+            for (seq, user_id, role, message), vector in zip(batch, vectors):
+                by_user.setdefault(user_id, []).append((seq, (role, message), vector))
+            for user_id, items in by_user.items():
+                entry = await self._get(user_id)
+                recent = set(entry.recent(DEDUPE_WINDOW))
+                items = [(row, vector) for seq, row, vector in items if seq >= entry.covered and row not in recent]
+                if items and (entry.size == 0 or entry.dim == len(items[0][1])):
+                    entry.add(np.stack([vector for _, vector in items]), [row for row, _ in items])
+        except Exception as e:
+            self.stats["errors"] += 1
+            logging.warning(f"[semantic] Failed to index {len(batch)} messages: {e}")
+        self._schedule_save()
+        if self._pending and self._flush_task is None:
+            self._flush_task = self._spawn(self._flush_later())
+
+    async def _prune(self, user_id: str):
+        """Drop indexed rows that retention folded out of the memory table."""
+        try:
+            if user_id not in self._users and not os.path.exists(self._paths(user_id)[0]):
+                return
+            entry = await self._get(user_id)
+            seen = list(entry.rows)
+            kept = await asyncio.to_thread(get_user_context, user_id, SEMANTIC_MAX_ROWS)
+            if entry.rows[:len(seen)] != seen:
+                return  # trimmed meanwhile; the next fold tries again
+            # Match newest first, so a folded message repeated later keeps its newest copy
+            remaining = Counter((row["role"], row["message"]) for row in kept)
+            mask = []
+            for row in reversed(seen):
+                mask.append(remaining[row] > 0)
+                remaining[row] -= 1
+            mask.reverse()
+            if not all(mask):
+                entry.keep(mask)
+                self._schedule_save()
+        except Exception as e:
+            self.stats["errors"] += 1
+            logging.warning(f"[semantic] Failed to prune folded vectors for {user_id}: {e}")
+
+    def _schedule_save(self):
+        if self._save_task is None:
+            self._save_task = self._spawn(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(SEMANTIC_SAVE_DELAY)
+        self._save_task = None
+        dirty = [(user_id, entry) for user_id, entry in self._users.items() if entry.dirty]
+        for user_id, entry in dirty:
+            entry.dirty = False
+            try:
+                await asyncio.to_thread(self._write, user_id, entry.matrix.copy(), list(entry.rows))
+            except Exception as e:
+                entry.dirty = True
+                logging.error(f"[semantic] Failed to save vectors for {user_id}: {e}")
+
+    # ---- queries ----
+
+    async def search(self, user_id: str, text: str, k: int = 3, exclude=()) -> list:
+        """Up to k past messages most similar to `text`, as {"role", "message", "score"}.
+
+        Messages in `exclude` (typically the turns already in the prompt)
+        are skipped. Returns [] whenever the index can't answer quickly.
+        """
+        if not SEMANTIC_MEMORY:
+            return []
+        self.stats["queries"] += 1
+        try:
+            load = self._get(user_id)
+            entry = await asyncio.wait_for(load, SEMANTIC_LOAD_WAIT)
+            if entry.size == 0:
+                return []
+            query = _normalize(np.asarray((await llm.embed([text]))[0], dtype=np.float32))
+            if len(query) != entry.dim:
+                return []
+        except asyncio.TimeoutError:
+            return []
+        except Exception as e:
+            self.stats["errors"] += 1
+            logging.warning(f"[semantic] Search failed: {e}")
+            return []
+        skip = set(exclude) | {text}
+        results = []
+        for score, i in entry.top_k(query, k + len(skip)):
+            if score < SEMANTIC_MIN_SCORE:
+                break
+            role, message = entry.rows[i]
+            if message in skip:
+                continue
+            results.append({"role": role, "message": message, "score": score})
+            skip.add(message)
+            if len(results) == k:
+                break
+        self.stats["hits"] += bool(results)
+        return results
+
+    async def stop(self, timeout: float = 5.0):
+        """Embed what is still queued (up to `timeout`), then cancel the rest.
+
+        Call before the HTTP sessions close, so no embed is cut off mid-request.
+        """
+        timers = {self._flush_task, self._save_task} - {None}
+        for task in timers:
+            task.cancel()
+        self._flush_task = self._save_task = None
+
+        async def drain():
+            while self._pending:
+                await self._flush()
+            await asyncio.gather(*(self._tasks - timers), return_exceptions=True)
+
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"[semantic] {len(self._pending)} messages left unindexed at shutdown")
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def save_all(self):
+        """Write every dirty matrix now (called on shutdown)."""
+        for user_id, entry in self._users.items():
+            if entry.dirty:
+                try:
+                    self._write(user_id, entry.matrix, entry.rows)
+                    entry.dirty = False
+                except Exception as e:
+                    logging.error(f"[semantic] Failed to save vectors for {user_id}: {e}")
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "users_loaded": len(self._users),
+            "vectors_loaded": sum(entry.size for entry in self._users.values()),
+            "pending": len(self._pending),
+        }
+
+
+def _indexable(message: str) -> bool:
+    return bool(message) and len(message) >= SEMANTIC_MIN_CHARS and not message.startswith(SKIP_PREFIXES)
+
+
+semantic_index = SemanticIndex()
+add_memory_listener(semantic_index.on_memory_event)
+metrics.add_collector(lambda: {(f"bot_semantic_{key}", ()): value
+                               for key, value in semantic_index.get_stats().items()})
+
+
+def close_semantic_index():
+    semantic_index.save_all()
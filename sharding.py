@@ -0,0 +1,161 @@
+# sharding.py
+"""Sharded launch: a supervisor runs N bot processes, each owning a slice of gateway shards.
+
+    python sharding.py --processes 4                 # shard count from Discord's recommendation
+    python sharding.py --processes 2 --shards 8
+
+Each child runs app.py with SHARD_IDS, SHARD_COUNT and SHARD_PROCESS set.
+Children share state through SQLite in WAL mode: memory.db, cache.db
+(catalog/news caches and the rate-limit buckets) and reminders.db. State
+that only lives in one process is turned off or kept to process 0 (the
+leader). See `SHARDED` users in memory.py, semantic_memory.py,
+agents/qa_agent.py, ratelimit.py and app.py.
+
+A child that exits is restarted with exponential back-off. SIGINT/SIGTERM
+stop all children.
+"""
+import os
+import sys
+import signal
+import asyncio
+import logging
+import argparse
+
+# Set by the supervisor in each child; unset means a plain single-process bot
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(",") if i.strip()] or None
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_PROCESS = int(os.getenv("SHARD_PROCESS", "0"))
+SHARDED = SHARD_IDS is not None
+
+SHARD_RESTART_DELAY = float(os.getenv("SHARD_RESTART_DELAY", "5"))
+SHARD_RESTART_MAX_DELAY = float(os.getenv("SHARD_RESTART_MAX_DELAY", "300"))
+# Discord allows max_concurrency IDENTIFYs per 5 seconds
+IDENTIFY_INTERVAL = 5.0
+DISCORD_GATEWAY_BOT_URL = "https://discord.com/api/v10/gateway/bot"
+
+
+def is_leader() -> bool:
+    """True in the process that runs singleton work (reminder timer, maintenance)."""
+    return SHARD_PROCESS == 0
+
+
+def bot_options() -> dict:
+    """Extra keyword arguments for the bot class in this process."""
+    if not SHARDED:
+        return {}
+    return {"shard_ids": SHARD_IDS, "shard_count": SHARD_COUNT}
+
+
+def plan(shard_count: int, processes: int) -> list:
+    """Split shard ids 0..shard_count-1 into `processes` contiguous slices."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    slices, start = [], 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(list(range(start, end)))
+        start = end
+    return slices
+
+
+async def gateway_info(token: str) -> dict:
+    """Discord's recommended shard count and IDENTIFY concurrency for this bot."""
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        async with session.get(DISCORD_GATEWAY_BOT_URL, headers={"Authorization": f"Bot {token}"}) as res:
+            res.raise_for_status()
+            data = await res.json()
+    return {
+        "shards": data["shards"],
+        "max_concurrency": data.get("session_start_limit", {}).get("max_concurrency", 1),
+    }
+
+
+class Supervisor:
+    def __init__(self, slices: list, shard_count: int, max_concurrency: int = 1, command: list = None):
+        self.slices = slices
+        self.shard_count = shard_count
+        self.max_concurrency = max_concurrency
+        self.command = command or [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")]
+        self._procs = {}
+        self._stopping = asyncio.Event()
+
+    def _env(self, index: int) -> dict:
+        return {
+            **os.environ,
+            "SHARD_IDS": ",".join(str(i) for i in self.slices[index]),
+            "SHARD_COUNT": str(self.shard_count),
+            "SHARD_PROCESS": str(index),
+        }
+
+    async def _wait_or_stop(self, delay: float) -> bool:
+        """Sleep for `delay`; True if a stop was requested meanwhile."""
+        try:
+            await asyncio.wait_for(self._stopping.wait(), delay)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _keep_running(self, index: int):
+        delay = SHARD_RESTART_DELAY
+        while not self._stopping.is_set():
+            started = asyncio.get_running_loop().time()
+            proc = await asyncio.create_subprocess_exec(*self.command, env=self._env(index))
+            self._procs[index] = proc
+            print(f"🧩 Shard process {index} (shards {self.slices[index]}) started as pid {proc.pid}")
+            code = await proc.wait()
+            if self._stopping.is_set():
+                break
+            # A process that stayed up for a while gets a fresh back-off
+            if asyncio.get_running_loop().time() - started > SHARD_RESTART_MAX_DELAY:
+                delay = SHARD_RESTART_DELAY
+            logging.error(f"[sharding] Process {index} exited with {code}; restarting in {delay:.0f}s")
+            if await self._wait_or_stop(delay):
+                break
+            delay = min(delay * 2, SHARD_RESTART_MAX_DELAY)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stopping.set)
+            except NotImplementedError:  # Windows
+                pass
+        tasks = []
+        for index, shard_ids in enumerate(self.slices):
+            tasks.append(asyncio.ensure_future(self._keep_running(index)))
+            # Stagger launches so IDENTIFYs stay within Discord's limit
+            if index < len(self.slices) - 1 and await self._wait_or_stop(
+                    IDENTIFY_INTERVAL * len(shard_ids) / self.max_concurrency):
+                break
+        await self._stopping.wait()
+        for proc in self._procs.values():
+            if proc.returncode is None:
+                proc.terminate()
+        await asyncio.gather(*(proc.wait() for proc in self._procs.values()))
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _main(args):
+    max_concurrency = 1
+    shard_count = args.shards
+    if not shard_count:
+        info = await gateway_info(os.getenv("DISCORD_BOT_TOKEN"))
+        shard_count, max_concurrency = info["shards"], info["max_concurrency"]
+    slices = plan(shard_count, args.processes)
+    print(f"🧩 Running {shard_count} shards in {len(slices)} processes: {slices}")
+    await Supervisor(slices, shard_count, max_concurrency).run()
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=int(os.getenv("SHARD_PROCESSES", str(os.cpu_count() or 1))))
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")),
+                        help="total gateway shards (default: Discord's recommendation)")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()